@@ -0,0 +1,749 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import websocket
+
+import my_zip
+from blob_store import BlobStore
+from metrics import METRICS
+from http_download import HttpInvoiceDownloader
+from extract_index import ExtractIndex, STATUS_DONE, STATUS_EXTRACTING, STATUS_FAILED
+from download_manifest import DownloadManifest, invoice_key, STATE_DOWNLOADING, STATE_DONE, STATE_FAILED
+from month_files import month_folder_path, month_summary, complete_month, skip_month, unique_path
+from rate_limit import AdaptiveRateLimiter, RetryQueue
+from sync_state import sync_probe, month_unchanged
+from result_pages import MAX_PAGES, PAGE_INFO_JS, NEXT_PAGE_JS, PAGE_SIZE_JS
+from page_scripts import (call_js, DEFAULT_CARD, CLICK_CARD_JS, SET_MONTH_JS, SEARCH_BUTTON_JS, PACK_BUTTON_JS,
+                          INVOICE_TABLE_SELECTORS, SCRAPE_INVOICE_ROWS_JS, PAGE_SIGNATURE_JS, parse_amount)
+
+# 浏览器下载先落在下载根目录下的这个临时文件夹（以下载GUID命名），完成后再移到月份文件夹
+STAGING_FOLDER = '.downloading'
+
+
+class CdpConnection:
+    """
+    浏览器级别的CDP websocket连接，供 asyncio 使用。
+
+    websocket-client 是同步库，这里用一个读取线程接收消息，再通过 call_soon_threadsafe
+    交给事件循环：命令的返回结果设置到对应的 Future，事件分发给监听者。
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.ws = None
+        self._next_id = 0
+        self._pending = {}
+        self._listeners = {}
+        self._send_lock = threading.Lock()
+        self._reader = None
+        self._closed = False
+
+    async def connect(self, debug_port=9222, host="127.0.0.1"):
+        def open_socket():
+            version_url = f"http://{host}:{debug_port}/json/version"
+            with urllib.request.urlopen(version_url, timeout=5) as resp:
+                ws_url = json.loads(resp.read().decode('utf-8'))['webSocketDebuggerUrl']
+            # 不发送Origin头，否则未加 --remote-allow-origins 的Chrome会拒绝连接
+            ws = websocket.create_connection(ws_url, timeout=10, suppress_origin=True)
+            ws.settimeout(None)
+            return ws
+
+        self.ws = await self.loop.run_in_executor(None, open_socket)
+        self._reader = threading.Thread(target=self._read_loop, name="cdp-reader", daemon=True)
+        self._reader.start()
+
+    @property
+    def connected(self):
+        return self.ws is not None and not self._closed
+
+    def _read_loop(self):
+        while not self._closed:
+            try:
+                message = json.loads(self.ws.recv())
+            except Exception:
+                break
+            self.loop.call_soon_threadsafe(self._dispatch, message)
+        self.loop.call_soon_threadsafe(self._on_closed)
+
+    def _dispatch(self, message):
+        if 'id' in message:
+            future = self._pending.pop(message['id'], None)
+            if future is None or future.done():
+                return
+            if 'error' in message:
+                future.set_exception(RuntimeError(message['error'].get('message')))
+            else:
+                future.set_result(message.get('result', {}))
+            return
+        key = (message.get('method'), message.get('sessionId'))
+        for callback in list(self._listeners.get(key, ())):
+            callback(message.get('params', {}))
+
+    def _on_closed(self):
+        self._closed = True
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("CDP连接已断开"))
+        self._pending.clear()
+
+    async def send(self, method, params=None, session_id=None, timeout=30):
+        """发送一条CDP命令并等待返回结果"""
+        if not self.connected:
+            raise ConnectionError("CDP连接已断开")
+        self._next_id += 1
+        command_id = self._next_id
+        message = {'id': command_id, 'method': method, 'params': params or {}}
+        if session_id:
+            message['sessionId'] = session_id
+        future = self.loop.create_future()
+        self._pending[command_id] = future
+        with self._send_lock:
+            self.ws.send(json.dumps(message))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"CDP命令超时: {method}")
+        except RuntimeError as e:
+            raise RuntimeError(f"{method} 失败: {e}")
+        finally:
+            self._pending.pop(command_id, None)
+
+    def on(self, method, callback, session_id=None):
+        """监听事件，返回取消监听的函数"""
+        callbacks = self._listeners.setdefault((method, session_id), [])
+        callbacks.append(callback)
+        return lambda: callbacks.remove(callback) if callback in callbacks else None
+
+    def expect(self, method, session_id=None, predicate=None):
+        """在触发动作之前调用：返回一个在下一次匹配事件到达时完成的 Future"""
+        future = self.loop.create_future()
+
+        def callback(params):
+            if not future.done() and (predicate is None or predicate(params)):
+                future.set_result(params)
+
+        remove = self.on(method, callback, session_id)
+        future.add_done_callback(lambda _: remove())
+        return future
+
+    def close(self):
+        self._closed = True
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+            self.ws = None
+
+
+class CdpTab:
+    """通过 Target.attachToTarget(flatten) 控制的一个标签页，所有命令都带 sessionId"""
+
+    def __init__(self, connection, target_id, session_id):
+        self.connection = connection
+        self.target_id = target_id
+        self.session_id = session_id
+
+    @classmethod
+    async def open(cls, connection, url='about:blank'):
+        result = await connection.send('Target.createTarget', {'url': url})
+        target_id = result['targetId']
+        attached = await connection.send('Target.attachToTarget', {'targetId': target_id, 'flatten': True})
+        tab = cls(connection, target_id, attached['sessionId'])
+        await tab.send('Page.enable')
+        return tab
+
+    async def send(self, method, params=None, timeout=30):
+        return await self.connection.send(method, params, self.session_id, timeout)
+
+    def expect_load(self):
+        return self.connection.expect('Page.loadEventFired', self.session_id)
+
+    async def evaluate(self, script, *args, timeout=30):
+        """执行 execute_script 风格的脚本并返回结果的值"""
+        result = await self.send('Runtime.evaluate', {
+            'expression': call_js(script, *args),
+            'returnByValue': True,
+            'awaitPromise': True,
+        }, timeout)
+        if result.get('exceptionDetails'):
+            details = result['exceptionDetails']
+            raise RuntimeError(details.get('exception', {}).get('description') or details.get('text'))
+        return result.get('result', {}).get('value')
+
+    async def navigate(self, url, timeout=30):
+        loaded = self.expect_load()
+        try:
+            result = await self.send('Page.navigate', {'url': url}, timeout)
+            if result.get('errorText'):
+                raise RuntimeError(result['errorText'])
+            await asyncio.wait_for(loaded, timeout)
+        finally:
+            loaded.cancel()
+
+    async def click_and_wait(self, script, *args, timeout=5):
+        """执行一个点击脚本，脚本返回真值时等待随之而来的页面加载（没有跳转时超时后继续）"""
+        loaded = self.expect_load()
+        try:
+            clicked = await self.evaluate(script, *args)
+            if clicked:
+                try:
+                    await asyncio.wait_for(asyncio.shield(loaded), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return clicked
+        finally:
+            loaded.cancel()
+
+    async def wait_until(self, script, *args, timeout=10, interval=0.2):
+        """轮询脚本直到返回真值，超时返回最后一次的结果"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                value = await self.evaluate(script, *args)
+            except Exception:
+                value = None
+            if value or time.monotonic() >= deadline:
+                return value
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        try:
+            await self.connection.send('Target.closeTarget', {'targetId': self.target_id}, timeout=5)
+        except Exception:
+            pass
+
+
+class AsyncOrchestrator:
+    """
+    基于 asyncio 的下载核心，直接通过CDP websocket控制调试Chrome，不经过 WebDriver。
+
+    列出发票、下载、下载完成事件、解压都是事件循环里的并发任务：
+    - 每个月份在自己的标签页里 导航-点卡片-设日期-搜索-翻页，最多 month_concurrency 个月份同时进行
+    - 每读到一页就把该页的下载任务放进事件循环，翻页和下载同时进行；
+      浏览器下载最多 download_tabs 个下载标签页，HTTP下载最多 http_concurrency 个并发
+    - 浏览器下载统一落在 .downloading 临时文件夹，按 downloadWillBegin 的 frameId
+      对应到发起下载的标签页，完成后移到对应的月份文件夹
+    - 下载完成的压缩包立即在进程池里解压，最多 extract_workers 个同时进行
+    """
+
+    def __init__(self, debug_port=9222, download_path=None, download_mode="browser", http_concurrency=4,
+                 month_concurrency=2, download_tabs=2, extract_workers=None, host="127.0.0.1"):
+        """
+        :param debug_port: Chrome调试端口
+        :param download_path: 下载根目录
+        :param download_mode: "browser" 点击打包按钮下载，"http" 复用登录会话HTTP直连下载
+        :param http_concurrency: HTTP下载并发数
+        :param month_concurrency: 同时处理的月份数（每个月份一个标签页）
+        :param download_tabs: 浏览器下载时同时使用的下载标签页数
+        :param extract_workers: 同时解压的压缩包数（进程数），None 表示CPU核心数
+        """
+        self.debug_port = debug_port
+        self.host = host
+        self.download_path = download_path or os.path.join(os.getcwd(), "invoice_downloads")
+        self.download_mode = download_mode
+        self.http_concurrency = max(1, int(http_concurrency))
+        self.month_concurrency = max(1, int(month_concurrency))
+        self.download_tabs = max(1, int(download_tabs))
+        self.extract_workers = max(1, int(extract_workers or os.cpu_count() or 1))
+
+        self.staging_path = os.path.join(self.download_path, STAGING_FOLDER)
+        # 所有月份的下载共用一个限速器；失败的发票在各自月份结束前重试
+        self.rate_limiter = AdaptiveRateLimiter()
+        self.max_attempts = 3
+        # 同步模式：结果页第一页与上次同步完成时一致的月份整体跳过
+        self.sync_mode = False
+        self.month_summaries = []
+        self.extract_results = []
+        # 解压索引和去重存储在 run() 里打开
+        self.index = None
+        self.store = None
+
+        self.loop = None
+        self.cdp = None
+        self.http_downloader = None
+        self._download_waiters = {}
+        self._download_records = {}
+        self._free_tabs = None
+        self._tabs = []
+        self._extract_tasks = []
+
+    # ---------- 连接与下载事件 ----------
+
+    async def _connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.cdp = CdpConnection(self.loop)
+        await self.cdp.connect(self.debug_port, self.host)
+        print("✅ 已通过CDP连接浏览器（异步核心）")
+
+        if self.download_mode == "http":
+            await self._load_http_session()
+        else:
+            os.makedirs(self.staging_path, exist_ok=True)
+            self.cdp.on('Browser.downloadWillBegin', self._on_download_begin)
+            self.cdp.on('Browser.downloadProgress', self._on_download_progress)
+            # allowAndName：文件以GUID命名保存，由这里决定最终的文件名和月份文件夹
+            await self.cdp.send('Browser.setDownloadBehavior', {
+                'behavior': 'allowAndName',
+                'downloadPath': self.staging_path,
+                'eventsEnabled': True,
+            })
+            self._free_tabs = asyncio.Queue()
+            for _ in range(self.download_tabs):
+                tab = await CdpTab.open(self.cdp)
+                self._tabs.append(tab)
+                self._free_tabs.put_nowait(tab)
+
+    async def _load_http_session(self):
+        self.http_downloader = HttpInvoiceDownloader(None, concurrency=self.http_concurrency)
+        result = await self.cdp.send('Network.getAllCookies')
+        self.http_downloader.cookies = result.get('cookies', [])
+        version = await self.cdp.send('Browser.getVersion')
+        self.http_downloader.user_agent = version.get('userAgent')
+        print(f"🍪🍪 已从浏览器读取 {len(self.http_downloader.cookies)} 个cookie")
+        if not self.http_downloader.cookies:
+            print("⚠️ 未读取到登录cookie，HTTP下载可能失败")
+
+    def _on_download_begin(self, params):
+        waiter = self._download_waiters.pop(params.get('frameId'), None)
+        if waiter is None:
+            return
+        begun, finished = waiter
+        if begun.done():
+            return
+        self._download_records[params['guid']] = {
+            'guid': params['guid'],
+            'suggested_filename': params.get('suggestedFilename'),
+            'started': time.time(),
+            'future': finished,
+        }
+        begun.set_result(params['guid'])
+
+    def _on_download_progress(self, params):
+        record = self._download_records.get(params.get('guid'))
+        if record is None or params.get('state', 'inProgress') == 'inProgress':
+            return
+        del self._download_records[params['guid']]
+        record.update(state=params['state'], bytes=params.get('receivedBytes', 0),
+                      duration=time.time() - record['started'])
+        if not record['future'].done():
+            record['future'].set_result(record)
+
+    # ---------- 下载 ----------
+
+    async def _download_browser(self, row, month_path, begin_timeout=15, complete_timeout=300):
+        tab = await self._free_tabs.get()
+        try:
+            await tab.navigate(row['href'])
+            if not await tab.wait_until(PACK_BUTTON_JS, False, timeout=5):
+                return None, '未找到打包按钮'
+            # 下载页的主框架ID就是标签页的targetId，用它认领这个标签页发起的下载
+            begun = self.loop.create_future()
+            finished = self.loop.create_future()
+            self._download_waiters[tab.target_id] = (begun, finished)
+            await tab.evaluate(PACK_BUTTON_JS, True)
+            # 点击后迟迟没有开始下载时尽早放弃，不让这个标签页等满整个下载超时
+            try:
+                await asyncio.wait_for(begun, begin_timeout)
+            except asyncio.TimeoutError:
+                METRICS.incr('download_timeouts')
+                return None, '点击打包后没有开始下载'
+            finally:
+                self._download_waiters.pop(tab.target_id, None)
+            try:
+                record = await asyncio.wait_for(finished, complete_timeout)
+            except asyncio.TimeoutError:
+                METRICS.incr('download_timeouts')
+                return None, '下载超时'
+            if record['state'] != 'completed':
+                METRICS.incr('downloads_interrupted')
+                return None, f"下载未完成 ({record['state']})"
+
+            filename = record['suggested_filename'] or f"invoice_{row['index']}.zip"
+            target_path = unique_path(month_path, filename)
+            shutil.move(os.path.join(self.staging_path, record['guid']), target_path)
+            METRICS.incr('bytes_downloaded', record['bytes'])
+            return {'path': target_path, 'bytes': record['bytes'], 'elapsed': record['duration']}, None
+        except Exception as e:
+            return None, str(e)
+        finally:
+            self._free_tabs.put_nowait(tab)
+
+    async def _download_http(self, row, month_path):
+        record = await self.loop.run_in_executor(
+            self._io_pool, self.http_downloader.download, row['href'], month_path, row['index'])
+        if not record['success']:
+            return None, record['error']
+        return record, None
+
+    async def _download_row(self, row, month_path, manifest, limit):
+        """下载一张发票，成功后立即安排解压。返回 (row, 结果dict或None, 错误)；出错时不抛出，记为失败"""
+        try:
+            return await self._download_row_once(row, month_path, manifest, limit)
+        except Exception as e:
+            error = f"下载出错: {e}"
+            try:
+                manifest.mark(invoice_key(row), STATE_FAILED, error=error)
+            except Exception:
+                pass
+            print(f"❌❌❌❌ 第 {row['index']} 张发票下载失败: {error}")
+            return row, None, error
+
+    async def _download_row_once(self, row, month_path, manifest, limit):
+        key = invoice_key(row)
+        if not row.get('href'):
+            manifest.mark(key, STATE_FAILED, error='没有直接下载地址')
+            return row, None, '没有直接下载地址'
+
+        async with limit:
+            await asyncio.sleep(self.rate_limiter.reserve())
+            manifest.mark(key, STATE_DOWNLOADING)
+            started = time.time()
+            with METRICS.span("download_click" if self.download_mode != "http" else "async_http_download"):
+                if self.download_mode == "http":
+                    record, error = await self._download_http(row, month_path)
+                else:
+                    record, error = await self._download_browser(row, month_path)
+            if record is None:
+                self.rate_limiter.failure()
+            else:
+                self.rate_limiter.success(time.time() - started)
+
+        if record is None:
+            manifest.mark(key, STATE_FAILED, error=error)
+            print(f"❌❌❌❌ 第 {row['index']} 张发票下载失败: {error}")
+            return row, None, error
+
+        # 计算哈希写清单放到线程里，不占用事件循环
+        await self.loop.run_in_executor(self._io_pool, manifest.mark, key, STATE_DONE, record['path'])
+        print(f"✅ 第 {row['index']} 张发票下载完成: {os.path.basename(record['path'])} "
+              f"({record['bytes'] / 1024:.1f} KB, {record['elapsed']:.2f}s)")
+        self._extract_tasks.append(asyncio.ensure_future(self._extract(record['path'])))
+        return row, record, None
+
+    # ---------- 解压 ----------
+
+    async def _extract(self, zip_path):
+        """解压一个压缩包；出错时记为失败（下次运行重新解压），不影响其他任务"""
+        try:
+            await self._extract_once(zip_path)
+        except Exception as e:
+            folder_path = zip_path[:-4]
+            error = f"解压 {zip_path} 时发生错误: {e}"
+            try:
+                self.index.mark(zip_path, folder_path, STATUS_FAILED, error=error)
+            except Exception:
+                pass
+            self.extract_results.append({'zip': zip_path, 'folder': folder_path, 'crc32': None, 'files': 0,
+                                         'skipped': 0, 'bytes': 0, 'elapsed': 0.0, 'errors': [error]})
+            print(f"❌❌ 解压失败: {os.path.basename(zip_path)} - {e}")
+
+    async def _extract_once(self, zip_path):
+        folder_path = zip_path[:-4]
+        async with self._extract_limit:
+            try:
+                stat_result = os.stat(zip_path)
+            except OSError as e:
+                print(f"⚠️ 解压找不到文件: {zip_path} ({e})")
+                return
+            if self.index.is_done(zip_path, stat_result):
+                return
+            self.index.mark(zip_path, folder_path, STATUS_EXTRACTING, stat_result)
+            # 内容相同的压缩包已经解压过时直接链接那份结果
+            digest, result = await self.loop.run_in_executor(
+                self._io_pool, self.store.reuse_extraction, zip_path, folder_path)
+            if result is None:
+                result = await self.loop.run_in_executor(
+                    self._process_pool, my_zip.extract_archive_task, zip_path, folder_path)
+                my_zip.record_extract_metrics(result)
+        status = STATUS_FAILED if result['errors'] and not result['files'] else STATUS_DONE
+        if await self.loop.run_in_executor(self._io_pool, self.store.add_extraction, digest, result):
+            stat_result = None
+        self.index.mark(zip_path, folder_path, status, stat_result, crc32=result['crc32'],
+                        files=result['files'], error='; '.join(result['errors']) or None)
+        if result.get('corrupt'):
+            # 下载不完整：隔离后下次运行重新下载
+            await self.loop.run_in_executor(self._io_pool, my_zip.quarantine_archive,
+                                            zip_path, result['errors'][0], self.store, digest)
+        self.extract_results.append(result)
+
+        name = os.path.basename(zip_path)
+        if result.get('reused'):
+            print(f"🔗🔗 {name} 与已解压的压缩包内容相同，直接链接（{result['files']} 个文件）")
+        elif status == STATUS_DONE:
+            print(f"📦📦 解压完成: {name}（{result['files']} 个文件）")
+        else:
+            print(f"❌❌ 解压失败: {name} - {'; '.join(result['errors'])}")
+
+    # ---------- 列出发票 ----------
+
+    async def _scrape_rows(self, tab, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result = await tab.evaluate(SCRAPE_INVOICE_ROWS_JS, INVOICE_TABLE_SELECTORS) or {}
+                rows = result.get('rows') or []
+            except Exception as e:
+                print(f"⚠️ JS读取发票列表失败: {e}")
+                rows = []
+            # 表格是异步渲染的，没读到就短暂轮询
+            if rows or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.3)
+        for row in rows:
+            row['amount'] = parse_amount(row.get('amount_text'))
+        return rows
+
+    async def _wait_for_change(self, tab, old_signature, timeout=15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                signature = await tab.evaluate(PAGE_SIGNATURE_JS)
+            except Exception:
+                signature = None
+            if signature and signature != old_signature and not signature.startswith('0|'):
+                return True
+            await asyncio.sleep(0.2)
+        return False
+
+    async def _open_month(self, tab, target_url, card, year, month):
+        """导航-点卡片-设日期-搜索，停在该月份的结果页"""
+        with METRICS.span("navigate_to_page"):
+            await tab.navigate(target_url)
+        with METRICS.span("click_etc_card"):
+            if not await tab.click_and_wait(CLICK_CARD_JS, card or DEFAULT_CARD):
+                raise RuntimeError(f"未找到{card or DEFAULT_CARD}卡片")
+        with METRICS.span("set_date_js_calendar"):
+            await tab.wait_until(SET_MONTH_JS, f"{year}{month:02d}", timeout=10)
+        with METRICS.span("search_invoices"):
+            if not await tab.click_and_wait(SEARCH_BUTTON_JS):
+                raise RuntimeError("未找到可点击的搜索按钮")
+
+    async def _walk_pages(self, tab, listing):
+        """
+        逐页产出发票快照（异步生成器），序号在各页之间连续编号。
+        最后一页也读完时把 listing['complete'] 设为 True，提前停止翻页时保持 False。
+        """
+        signature = await tab.evaluate(PAGE_SIGNATURE_JS)
+        size = await tab.evaluate(PAGE_SIZE_JS)
+        if size and size.get('changed'):
+            print(f"📄📄 每页条数: {size['from']} -> {size['to']}")
+            await self._wait_for_change(tab, signature)
+
+        index_offset = 0
+        page = 1
+        seen_signatures = set()
+        rows = await self._scrape_rows(tab)
+        while rows:
+            info = await tab.evaluate(PAGE_INFO_JS) or {}
+            for row in rows:
+                row['page'] = page
+                row['page_index'] = row['index']
+                row['index'] = index_offset + row['index']
+            yield rows, info
+
+            signature = await tab.evaluate(PAGE_SIGNATURE_JS)
+            seen_signatures.add(signature)
+            if not info.get('has_next'):
+                listing['complete'] = True
+                return
+            if page >= MAX_PAGES:
+                return
+            with METRICS.span("next_page"):
+                if not await tab.evaluate(NEXT_PAGE_JS) or not await self._wait_for_change(tab, signature):
+                    print(f"⚠️ 第 {page + 1} 页加载超时，停止翻页")
+                    return
+            index_offset += len(rows)
+            page += 1
+            rows = await self._scrape_rows(tab)
+            if await tab.evaluate(PAGE_SIGNATURE_JS) in seen_signatures:
+                print("⚠️ 翻页后仍是已读过的结果页，停止翻页")
+                return
+
+    # ---------- 月份 ----------
+
+    async def _process_month(self, target_url, card, year, month):
+        label = f"{card} " if card else ""
+        started = time.time()
+        month_path = month_folder_path(self.download_path, year, month, card)
+        os.makedirs(month_path, exist_ok=True)
+        manifest = DownloadManifest(month_path, self.store)
+        manifest.collapse_duplicates()
+
+        page_stats = []
+        stated_total = None
+        downloads = []
+        already_done = []
+        probe = None
+        watermark = None
+        listing = {'complete': False, 'error': None}
+        tab = await CdpTab.open(self.cdp)
+        try:
+            print(f"📅📅📅📅 开始处理 {label}{year}年{month:02d}月 的发票")
+            await self._open_month(tab, target_url, card, year, month)
+            # 这一页的下载在事件循环里进行，同时翻到下一页继续读取
+            async for rows, info in self._walk_pages(tab, listing):
+                if probe is None:
+                    # 第一页的快照作为水位；同步模式下与上次一致就不再翻页
+                    probe = sync_probe(rows, info)
+                    watermark = month_unchanged(month_path, probe) if self.sync_mode else None
+                    if watermark:
+                        break
+                if stated_total is None:
+                    stated_total = info.get('total')
+                page_stats.append({'page': rows[0]['page'], 'rows': len(rows)})
+                # 别的文件夹下载过、直接从存储链接过来的压缩包也要解压
+                for zip_path in manifest.sync_rows(rows):
+                    self._extract_tasks.append(asyncio.ensure_future(self._extract(zip_path)))
+                for row in rows:
+                    if manifest.is_done(invoice_key(row)):
+                        already_done.append(row)
+                    else:
+                        downloads.append(asyncio.ensure_future(
+                            self._download_row(row, month_path, manifest, self._download_limit)))
+        except Exception as e:
+            listing['error'] = e
+            print(f"❌❌❌❌ {label}{year}年{month:02d}月 - 读取发票列表失败: {e}")
+        finally:
+            await tab.close()
+
+        if watermark:
+            return self._record_month(skip_month(year, month, month_path, watermark, card, label), started)
+
+        results = await asyncio.gather(*downloads)
+        retry_queue = RetryQueue(self.max_attempts)
+        results = await self._retry_failed(results, retry_queue, month_path, manifest)
+        total_count = len(results) + len(already_done)
+        if not total_count:
+            print(f"❌❌❌❌ {label}{year}年{month:02d}月 - 未找到可下载的发票")
+            return self._record_month(month_summary(year, month, month_path, 0, 0, 0.0, stated_total,
+                                                    card_name=card), started)
+        if already_done:
+            print(f"⏭⏭ {label}{year}年{month:02d}月 - 已下载 {len(already_done)} 张，跳过")
+
+        invoice_details = []
+        for row in already_done:
+            if row['amount'] > 0:
+                invoice_details.append({'index': row['index'], 'amount': row['amount'], 'status': '成功（已下载）'})
+        for row, record, error in results:
+            if row['amount'] > 0:
+                status = '失败'
+                if record:
+                    status = '成功（重试）' if row['index'] in retry_queue.recovered else '成功'
+                detail = {'index': row['index'], 'amount': row['amount'], 'status': status}
+                if record:
+                    detail.update(bytes=record['bytes'], duration=record['elapsed'],
+                                  filename=os.path.basename(record['path']))
+                invoice_details.append(detail)
+        invoice_details.sort(key=lambda detail: detail['index'])
+
+        success_count = len(already_done) + sum(1 for _, record, _ in results if record)
+        total_amount = sum(detail['amount'] for detail in invoice_details)
+        page_summary = {'pages': page_stats, 'rows': total_count, 'stated_total': stated_total,
+                        'complete': listing['complete']}
+        pacing = dict(retry_queue.summary(), rate=self.rate_limiter.stats())
+        # 读取发票列表出错时不记录水位，下次同步重新检查这个月份
+        summary = complete_month(self.download_path, year, month, month_path, total_amount, invoice_details,
+                                 success_count, total_count, page_summary, pacing,
+                                 probe if listing['error'] is None else None, card, label)
+        return self._record_month(summary, started)
+
+    async def _retry_failed(self, results, retry_queue, month_path, manifest):
+        """月份结束前逐轮重试下载失败的发票，返回更新后的 [(row, record, error)]"""
+        by_index = {row['index']: (row, record, error) for row, record, error in results}
+        for row, record, error in results:
+            if record is None:
+                # 没有直接下载地址的发票无法重试，只记入最终失败列表
+                retry_queue.add(row, error, retryable=bool(row.get('href')))
+        while True:
+            rows = retry_queue.next_round()
+            if not rows:
+                break
+            retried = await asyncio.gather(*(self._download_row(row, month_path, manifest, self._download_limit)
+                                             for row in rows))
+            for row, record, error in retried:
+                retry_queue.record(row, record is not None, error)
+                by_index[row['index']] = (row, record, error)
+        return [by_index[index] for index in sorted(by_index)]
+
+    def _record_month(self, summary, started):
+        summary['elapsed'] = time.time() - started
+        self.month_summaries.append(summary)
+        return summary
+
+    async def _month_task(self, target_url, card, year, month):
+        started = time.time()
+        async with self._month_limit:
+            try:
+                with METRICS.span("process_single_month"):
+                    return await self._process_month(target_url, card, year, month)
+            except Exception as e:
+                # 一个月份出错不影响其他月份，记为没有下载成功
+                label = f"{card} " if card else ""
+                print(f"❌❌❌❌ {label}{year}年{month:02d}月 - 处理失败: {e}")
+                month_path = month_folder_path(self.download_path, year, month, card)
+                return self._record_month(month_summary(year, month, month_path, 0, 0, 0.0, card_name=card), started)
+
+    # ---------- 入口 ----------
+
+    async def run(self, target_url, month_list, cards=None):
+        """
+        下载 cards × month_list 的全部发票并解压。
+
+        :param target_url: 卡片列表页地址
+        :param month_list: [(year, month), ...]
+        :param cards: 卡片名称列表；None 表示只下载默认卡片，月份文件夹不按卡片分开
+        :return: 每个月份的汇总列表
+        """
+        download_concurrency = self.http_concurrency if self.download_mode == "http" else self.download_tabs
+        self._month_limit = asyncio.Semaphore(self.month_concurrency)
+        self._download_limit = asyncio.Semaphore(download_concurrency)
+        self._extract_limit = asyncio.Semaphore(self.extract_workers)
+        self._io_pool = ThreadPoolExecutor(max_workers=self.http_concurrency, thread_name_prefix="async-io")
+        self._process_pool = ProcessPoolExecutor(max_workers=self.extract_workers)
+        os.makedirs(self.download_path, exist_ok=True)
+        self.index = ExtractIndex(self.download_path)
+        self.store = BlobStore(self.download_path)
+        started = time.perf_counter()
+        try:
+            try:
+                await self._connect()
+            except Exception as e:
+                print(f"❌❌ 浏览器连接失败: {e}")
+                return []
+            jobs = [(card, year, month) for card in (cards or [None]) for year, month in month_list]
+            print(f"🚀🚀 异步下载 {len(jobs)} 个月份任务（同时 {self.month_concurrency} 个月份，"
+                  f"{self.download_mode} 下载并发 {download_concurrency}，解压并发 {self.extract_workers}）")
+            # 每个任务自己处理错误，这里用 return_exceptions 兜底，保证关闭进程池前所有任务都已结束
+            await asyncio.gather(*(self._month_task(target_url, card, year, month)
+                                   for card, year, month in jobs), return_exceptions=True)
+            # 解压任务在下载过程中已经开始，这里只等最后几个收尾
+            await asyncio.gather(*self._extract_tasks, return_exceptions=True)
+        finally:
+            for tab in self._tabs:
+                await tab.close()
+            if self.cdp:
+                self.cdp.close()
+            self._io_pool.shutdown()
+            self._process_pool.shutdown()
+            self.index.close()
+            self.store.close()
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+
+        files = sum(r['files'] for r in self.extract_results)
+        print(f"✅ 异步下载结束: {len(self.month_summaries)} 个月份，"
+              f"下载 {sum(s['success_count'] for s in self.month_summaries)} 张，"
+              f"解压 {len(self.extract_results)} 个压缩包（{files} 个文件），"
+              f"用时 {time.perf_counter() - started:.1f}s")
+        self.month_summaries.sort(key=lambda s: (s['card'] or '', s['year'], s['month']))
+        return self.month_summaries
+
+    def run_sync(self, target_url, month_list, cards=None):
+        """同步调用入口：在新的事件循环里运行 run()"""
+        return asyncio.run(self.run(target_url, month_list, cards))
@@ -0,0 +1,272 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from urllib.parse import quote
+
+import urllib3
+
+import my_zip
+from http_download import HttpInvoiceDownloader
+from mock_portal import MockPortal, INVOICE_LIST_PATH, DEFAULT_CARDS
+
+DEFAULT_COUNTS = (10, 100, 1000)
+RESULTS_FILENAME = "benchmark_results.jsonl"
+
+# 每种压测的主要指标，以及数值越大越好还是越小越好
+PRIMARY_METRICS = {
+    'browser': [('invoices_per_min', True), ('roundtrips_per_invoice', False)],
+    'http': [('invoices_per_min', True)],
+    'extract': [('mb_per_s', True)],
+}
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """压测时屏蔽每张发票的打印输出，只保留结果表格"""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def count_roundtrips(driver):
+    """
+    统计 WebDriver 命令次数（每次查找元素、点击、执行脚本都是一次和浏览器的往返）。
+
+    :return: dict，其中 'commands' 随命令实时累加
+    """
+    counter = {'commands': 0}
+    original = driver.execute
+
+    def execute(driver_command, params=None):
+        counter['commands'] += 1
+        return original(driver_command, params)
+
+    driver.execute = execute
+    return counter
+
+
+def bench_browser(portal, counts, debug_port=9222, download_mode="browser", http_concurrency=4, verbose=False):
+    """
+    用 InvoiceDownloader 驱动调试Chrome访问模拟网站，完整走一遍 导航-点卡片-设日期-搜索-下载。
+    需要已用 --remote-debugging-port 启动的Chrome。
+    """
+    import main as app  # 需要 selenium，只有浏览器压测才导入
+
+    root = tempfile.mkdtemp(prefix="bench_browser_")
+    downloader = app.InvoiceDownloader(debug_port, root, download_mode, http_concurrency)
+    results = []
+    try:
+        if not downloader.connect_browser():
+            print("❌❌ 浏览器压测跳过：无法连接调试Chrome")
+            return results
+        counter = count_roundtrips(downloader.driver)
+
+        # 每个规模用不同的月份，避免下载清单把上一轮的发票当成已下载
+        for month, count in enumerate(counts, 1):
+            portal.invoices_per_month = count
+            commands_before = counter['commands']
+            started = time.perf_counter()
+            with quiet(not verbose):
+                downloader.navigate_to_page(portal.target_url)
+                downloader.click_etc_card()
+                downloader.process_single_month(2024, month)
+            elapsed = time.perf_counter() - started
+            summary = downloader.month_summaries[-1] if downloader.month_summaries else {}
+            downloaded = summary.get('success_count', 0)
+            commands = counter['commands'] - commands_before
+            results.append({
+                'bench': 'browser',
+                'mode': download_mode,
+                'invoices': count,
+                'downloaded': downloaded,
+                'elapsed': elapsed,
+                'invoices_per_min': downloaded * 60 / elapsed if elapsed > 0 else 0.0,
+                'roundtrips': commands,
+                'roundtrips_per_invoice': commands / count if count else 0.0,
+            })
+    finally:
+        with quiet(not verbose):
+            downloader.close()
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def bench_http(portal, counts, concurrency=4, verbose=False):
+    """不经过浏览器：读取模拟网站的发票列表，用 HttpInvoiceDownloader 并发下载全部压缩包"""
+    http = urllib3.PoolManager()
+    results = []
+    for count in counts:
+        portal.invoices_per_month = count
+        root = tempfile.mkdtemp(prefix="bench_http_")
+        try:
+            started = time.perf_counter()
+            # 直接请求一页显示全部发票，只测下载本身
+            list_url = f"{portal.base_url}{INVOICE_LIST_PATH}?card={quote(DEFAULT_CARDS[0])}&month=202410&pageSize={count}"
+            html = http.request('GET', list_url).data.decode('utf-8')
+            jobs = [(i, portal.base_url + href)
+                    for i, href in enumerate(re.findall(r'href="([^"]*/downloadPage/[^"]+)"', html), 1)]
+
+            downloader = HttpInvoiceDownloader(None, concurrency=concurrency)
+            with quiet(not verbose):
+                records = downloader.download_many(jobs, root)
+            elapsed = time.perf_counter() - started
+            downloaded = sum(1 for r in records if r['success'])
+            total_bytes = sum(r['bytes'] for r in records)
+            results.append({
+                'bench': 'http',
+                'concurrency': concurrency,
+                'invoices': count,
+                'downloaded': downloaded,
+                'elapsed': elapsed,
+                'invoices_per_min': downloaded * 60 / elapsed if elapsed > 0 else 0.0,
+                'mb_per_s': total_bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0,
+            })
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def bench_extract(portal, counts, workers=1, verbose=False):
+    """生成 count 个嵌套压缩包后用 my_zip.main 解压，记录写盘速度（MB/s）"""
+    results = []
+    for count in counts:
+        root = tempfile.mkdtemp(prefix="bench_extract_")
+        try:
+            input_bytes = portal.write_archives(root, count)
+            started = time.perf_counter()
+            with quiet(not verbose):
+                extracted = my_zip.main(root, workers=workers)
+            elapsed = time.perf_counter() - started
+            output_bytes = sum(r['bytes'] for r in extracted)
+            results.append({
+                'bench': 'extract',
+                'workers': workers,
+                'invoices': count,
+                'archives': len(extracted),
+                'errors': sum(len(r['errors']) for r in extracted),
+                'elapsed': elapsed,
+                'input_mb': input_bytes / (1024 * 1024),
+                'mb_per_s': output_bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0,
+            })
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def result_key(result):
+    """同一种压测、同样规模和参数的结果才互相比较"""
+    return (result['bench'], result['invoices'], result.get('mode'),
+            result.get('concurrency'), result.get('workers'))
+
+
+def load_previous(path):
+    """读取历史结果，每个 result_key 只保留最近一次"""
+    previous = {}
+    if not os.path.exists(path):
+        return previous
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            previous[result_key(result)] = result
+    return previous
+
+
+def find_regressions(results, previous, threshold=0.15):
+    """与上一次同条件的结果比较，主要指标变差超过 threshold 的记为退步"""
+    regressions = []
+    for result in results:
+        before = previous.get(result_key(result))
+        if not before:
+            continue
+        for metric, higher_is_better in PRIMARY_METRICS[result['bench']]:
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+                regressions.append((result, metric, old, new, change))
+    return regressions
+
+
+def print_results(results):
+    print("\n📊📊 压测结果:")
+    print(f"   {'类型':<8}{'规模':>8}{'用时(s)':>10}{'张/分钟':>10}{'MB/s':>9}{'往返/张':>9}")
+    for r in results:
+        per_min = f"{r['invoices_per_min']:.1f}" if 'invoices_per_min' in r else '-'
+        speed = f"{r['mb_per_s']:.2f}" if 'mb_per_s' in r else '-'
+        trips = f"{r['roundtrips_per_invoice']:.1f}" if 'roundtrips_per_invoice' in r else '-'
+        print(f"   {r['bench']:<10}{r['invoices']:>8}{r['elapsed']:>10.2f}{per_min:>10}{speed:>9}{trips:>9}")
+
+
+def append_results(path, results, run_id):
+    with open(path, 'a', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(dict(result, run=run_id, ts=time.time()), ensure_ascii=False) + "\n")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="离线压测：在本地模拟票根网上测量下载和解压的吞吐量")
+    parser.add_argument('--counts', default=','.join(str(c) for c in DEFAULT_COUNTS),
+                        help="发票数量，逗号分隔（10 到 10000），默认 10,100,1000")
+    parser.add_argument('--bench', default='http,extract',
+                        help="要运行的压测：browser,http,extract（browser 需要调试Chrome）")
+    parser.add_argument('--debug-port', type=int, default=9222, help="浏览器压测使用的Chrome调试端口")
+    parser.add_argument('--mode', default='browser', choices=['browser', 'http'], help="浏览器压测的下载方式")
+    parser.add_argument('--concurrency', type=int, default=4, help="HTTP下载并发数")
+    parser.add_argument('--workers', type=int, default=1, help="解压进程数")
+    parser.add_argument('--latency', type=float, default=0.0, help="模拟网站每个请求的延迟（秒）")
+    parser.add_argument('--page-size', type=int, default=None, help="模拟网站查询结果每页条数（默认不分页）")
+    parser.add_argument('--pdf-size', type=int, default=32 * 1024, help="每个发票PDF的大小（字节）")
+    parser.add_argument('--results', default=RESULTS_FILENAME, help="结果追加写入的JSON-lines文件")
+    parser.add_argument('--threshold', type=float, default=0.15, help="判定退步的变化比例")
+    parser.add_argument('--check', action='store_true', help="有退步时以非0状态码退出（用于CI）")
+    parser.add_argument('--verbose', action='store_true', help="显示下载和解压过程的输出")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    counts = [int(c) for c in args.counts.split(',') if c.strip()]
+    benches = [b.strip() for b in args.bench.split(',') if b.strip()]
+    run_id = time.strftime('%Y%m%d_%H%M%S')
+
+    results = []
+    with MockPortal(latency=args.latency, pdf_size=args.pdf_size, page_size=args.page_size) as portal:
+        print(f"🧪🧪 模拟票根网: {portal.target_url}")
+        if 'browser' in benches:
+            results += bench_browser(portal, counts, args.debug_port, args.mode, args.concurrency, args.verbose)
+        if 'http' in benches:
+            results += bench_http(portal, counts, args.concurrency, args.verbose)
+        if 'extract' in benches:
+            results += bench_extract(portal, counts, args.workers, args.verbose)
+
+    print_results(results)
+    regressions = find_regressions(results, load_previous(args.results), args.threshold)
+    append_results(args.results, results, run_id)
+    print(f"📄📄 结果已追加到: {args.results}")
+
+    for result, metric, old, new, change in regressions:
+        print(f"⚠️ 性能退步: {result['bench']} × {result['invoices']} 的 {metric} "
+              f"{old:.2f} -> {new:.2f} ({change:+.0%})")
+    if regressions and args.check:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # 解压压测会用到进程池
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,317 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import threading
+
+import my_zip
+from metrics import METRICS
+from extract_index import ExtractIndex, STATUS_DONE
+from download_manifest import DownloadManifest, file_sha256, STATE_DONE
+
+# 下载根目录下的内容寻址存储：.blobs/<哈希前两位>/<sha256>.zip|.pdf
+BLOB_FOLDER = '.blobs'
+STORE_FILENAME = '.blob_store.db'
+# 放进存储的文件类型：下载的压缩包和解压出来的发票PDF
+STORED_EXTENSIONS = ('.zip', '.pdf')
+
+
+def link_or_copy(source, target):
+    """硬链接，文件系统不支持时复制"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def same_file(stat_a, stat_b):
+    return (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino)
+
+
+class BlobStore:
+    """
+    下载文件的内容寻址存储，放在下载根目录下。
+
+    - .blobs 里每份内容只存一个文件，以 SHA-256 命名；月份文件夹里的压缩包和解压出来的PDF
+      都是指向它的硬链接，YYYYMM/<压缩包名>/ 的目录结构不变，内容相同的文件在磁盘上只占一份空间
+    - .blob_store.db 记录 发票标识 -> 压缩包哈希 和 压缩包哈希 -> 解压文件夹：
+      别的月份/卡片已经下载过的发票直接链接过来，不再下载；内容相同的压缩包直接链接已有的解压结果，不再解压
+    - 文件系统不支持硬链接（FAT32/exFAT U盘等）时自动停用，文件保持原样
+    """
+
+    def __init__(self, root, filename=STORE_FILENAME):
+        self.root = os.path.abspath(root)
+        self.blob_root = os.path.join(self.root, BLOB_FOLDER)
+        self.db_path = os.path.join(self.root, filename)
+        self.linkable = True
+        # 下载线程和后台解压线程会同时访问，用锁保护同一个连接
+        self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS invoices (
+                invoice_id TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                filename TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS extractions (
+                sha256 TEXT PRIMARY KEY,
+                folder TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def _rel(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root).replace('\\', '/')
+
+    def blob_path(self, digest, ext):
+        return os.path.join(self.blob_root, digest[:2], digest + ext.lower())
+
+    def add(self, path, digest=None):
+        """
+        把文件放进存储：存储里还没有这份内容时登记为新的存储文件，已有时把 path 换成指向它的硬链接。
+
+        :return: 省下的字节数（path 换成了硬链接时为文件大小，否则为 0）
+        """
+        if not self.linkable:
+            return 0
+        try:
+            stat_result = os.stat(path)
+            digest = digest or file_sha256(path)
+        except OSError:
+            return 0
+        blob = self.blob_path(digest, os.path.splitext(path)[1])
+        try:
+            blob_stat = os.stat(blob)
+        except FileNotFoundError:
+            blob_stat = None
+        try:
+            if blob_stat is None:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(path, blob)
+                    return 0
+                except FileExistsError:
+                    # 另一个线程刚放进了同样的内容
+                    blob_stat = os.stat(blob)
+            if same_file(stat_result, blob_stat) or blob_stat.st_size != stat_result.st_size:
+                return 0
+            tmp_path = f"{path}.{threading.get_ident()}.link"
+            os.link(blob, tmp_path)
+        except OSError as e:
+            self.linkable = False
+            print(f"⚠️ 下载目录不支持硬链接，不使用去重存储: {e}")
+            return 0
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # 文件正被其他程序打开（例如PDF阅读器），这次先不替换
+            os.remove(tmp_path)
+            return 0
+        METRICS.incr('dedup_bytes_saved', stat_result.st_size)
+        return stat_result.st_size
+
+    def remember_invoice(self, invoice_id, digest, filename):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO invoices (invoice_id, sha256, filename) VALUES (?, ?, ?)",
+                              (invoice_id, digest, filename))
+            self.conn.commit()
+
+    def restore_invoice(self, invoice_id, month_path):
+        """
+        别的月份文件夹或卡片文件夹已经下载过这张发票时，把压缩包（和已有的解压结果）链接到 month_path，不再下载。
+
+        :return: (文件名, sha256)，存储里没有这张发票时返回 None
+        """
+        if not self.linkable:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT sha256, filename FROM invoices WHERE invoice_id = ?",
+                                    (invoice_id,)).fetchone()
+        if row is None:
+            return None
+        digest, filename = row
+        blob = self.blob_path(digest, os.path.splitext(filename)[1])
+        target = os.path.join(month_path, filename)
+        try:
+            if os.path.exists(target):
+                # 同名文件已经在这里：内容相同才算已下载
+                if not same_file(os.stat(target), os.stat(blob)) and file_sha256(target) != digest:
+                    return None
+            else:
+                link_or_copy(blob, target)
+        except OSError:
+            return None
+        if not os.path.isdir(target[:-4]):
+            self.reuse_extraction(target, target[:-4], digest)
+        METRICS.incr('downloads_deduplicated')
+        return filename, digest
+
+    def reuse_extraction(self, zip_path, folder_path, digest=None):
+        """
+        解压前调用：内容相同的压缩包已经在别处解压过时，把那份解压结果硬链接到 folder_path，不再解压。
+
+        :return: (digest, result)，result 与 my_zip.extract_archive_task 的返回格式相同；
+                 没有可以复用的解压结果时 result 为 None
+        """
+        digest = digest or file_sha256(zip_path)
+        with self.lock:
+            row = self.conn.execute("SELECT folder FROM extractions WHERE sha256 = ?", (digest,)).fetchone()
+        source = os.path.join(self.root, row[0]) if row else None
+        if (source is None or not os.path.isdir(source)
+                or os.path.normcase(source) == os.path.normcase(os.path.abspath(folder_path))):
+            return digest, None
+
+        started = time.perf_counter()
+        result = {'zip': zip_path, 'folder': folder_path, 'crc32': None, 'files': 0, 'skipped': 0,
+                  'bytes': 0, 'elapsed': 0.0, 'errors': [], 'reused': True}
+        for dirpath, _, filenames in os.walk(source):
+            target_dir = os.path.join(folder_path, os.path.relpath(dirpath, source))
+            os.makedirs(target_dir, exist_ok=True)
+            for name in filenames:
+                target = os.path.join(target_dir, name)
+                if os.path.exists(target):
+                    os.remove(target)
+                link_or_copy(os.path.join(dirpath, name), target)
+                result['files'] += 1
+                result['bytes'] += os.path.getsize(target)
+        result['elapsed'] = time.perf_counter() - started
+        if not result['files']:
+            return digest, None
+        METRICS.incr('extractions_reused')
+        return digest, result
+
+    def add_extraction(self, digest, result):
+        """
+        解压成功后调用：登记解压结果，压缩包和解压出来的PDF放进存储（与已有文件内容相同的改为硬链接）。
+
+        :return: 压缩包本身是否换成了硬链接（换了之后修改时间会变，解压索引要用新的 os.stat）
+        """
+        if result['errors'] and not result['files']:
+            return False
+        relinked = self.add(result['zip'], digest) > 0
+        if result.get('reused'):
+            # 解压结果本来就是已有文件的硬链接，只需要把压缩包本身放进存储
+            return relinked
+        for dirpath, _, filenames in os.walk(result['folder']):
+            for name in filenames:
+                if name.lower().endswith('.pdf'):
+                    self.add(os.path.join(dirpath, name))
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO extractions (sha256, folder) VALUES (?, ?)",
+                              (digest, self._rel(result['folder'])))
+            self.conn.commit()
+        return relinked
+
+    def discard(self, digest):
+        """
+        压缩包校验失败时调用：删除存储里这份损坏的内容和指向它的发票记录，
+        以后不会再把它链接到别的文件夹，这些发票会重新下载。
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM invoices WHERE sha256 = ?", (digest,))
+            self.conn.execute("DELETE FROM extractions WHERE sha256 = ?", (digest,))
+            self.conn.commit()
+        try:
+            os.remove(self.blob_path(digest, '.zip'))
+        except OSError:
+            pass
+
+    def compact(self):
+        """
+        整理已有的下载目录：月份文件夹里的压缩包和发票PDF逐个放进存储，内容相同的改成指向同一份的硬链接，
+        下载清单里的发票和完整的解压文件夹登记进存储；最后删除已经没有任何文件引用的存储文件。
+
+        :return: dict(files, linked, saved_bytes, removed_blobs, elapsed)
+        """
+        started = time.perf_counter()
+        stats = {'files': 0, 'linked': 0, 'saved_bytes': 0, 'removed_blobs': 0}
+        index = ExtractIndex(self.root)
+        try:
+            for entry in my_zip.iter_archive_dirs(self.root):
+                if not my_zip.MONTH_FOLDER.match(entry.name):
+                    continue
+                self._compact_month(entry.path, index, stats)
+                if not self.linkable:
+                    break
+        finally:
+            index.close()
+
+        # 月份文件夹已经删掉的内容：存储里只剩自己这一个链接
+        if os.path.isdir(self.blob_root):
+            for dirpath, _, filenames in os.walk(self.blob_root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if os.stat(path).st_nlink <= 1:
+                        os.remove(path)
+                        stats['removed_blobs'] += 1
+        stats['elapsed'] = time.perf_counter() - started
+        return stats
+
+    def _compact_month(self, month_path, index, stats):
+        manifest = DownloadManifest(month_path)
+        known = {}
+        for key, entry in manifest.invoices.items():
+            filename, digest = entry.get('file'), entry.get('sha256')
+            if not filename or not digest or not os.path.isfile(os.path.join(month_path, filename)):
+                continue
+            known[filename] = digest
+            if entry.get('state') == STATE_DONE and not key.startswith('#'):
+                self.remember_invoice(key, digest, filename)
+
+        for dirpath, dirnames, filenames in os.walk(month_path):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            top_level = dirpath == month_path
+            for name in filenames:
+                if name.startswith('.') or not name.lower().endswith(STORED_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, name)
+                digest = (known.get(name) if top_level else None) or file_sha256(path)
+                record = index.get(path) if top_level else None
+                saved = self.add(path, digest)
+                stats['files'] += 1
+                if saved:
+                    stats['linked'] += 1
+                    stats['saved_bytes'] += saved
+                    if record and record['status'] == STATUS_DONE:
+                        # 换成硬链接后修改时间变了，解压索引同步更新，避免下次重新解压
+                        index.mark(path, path[:-4], STATUS_DONE, files=record['files'])
+                if top_level and name.lower().endswith('.zip') and os.path.isdir(path[:-4]) \
+                        and my_zip.outputs_complete(path, path[:-4]):
+                    with self.lock:
+                        self.conn.execute("INSERT OR IGNORE INTO extractions (sha256, folder) VALUES (?, ?)",
+                                          (digest, self._rel(path[:-4])))
+                        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def compact(root):
+    """整理下载目录并打印省下的空间"""
+    if not os.path.isdir(root):
+        print(f"❌❌ 目录不存在: {root}")
+        return None
+    store = BlobStore(root)
+    try:
+        stats = store.compact()
+    finally:
+        store.close()
+    print(f"🗜🗜 整理完成: 检查 {stats['files']} 个压缩包和PDF，{stats['linked']} 个重复文件改为硬链接，"
+          f"省下 {stats['saved_bytes'] / (1024 * 1024):.2f} MB，清理 {stats['removed_blobs']} 个无用的存储文件，"
+          f"用时 {stats['elapsed']:.1f}s")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把下载目录里内容相同的压缩包和PDF改为硬链接，回收磁盘空间")
+    parser.add_argument('--root', default='invoice_downloads', help="下载目录")
+    args = parser.parse_args(argv)
+    return 0 if compact(args.root) is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
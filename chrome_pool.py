@@ -0,0 +1,415 @@
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import websocket
+
+from metrics import METRICS
+
+# 托管的Chrome从这个端口开始依次分配调试端口（避开手动启动调试Chrome时常用的9222）
+BASE_PORT = 9300
+# 已登录票根网的用户数据目录（与README里手动启动调试Chrome时的 --user-data-dir 相同）
+DEFAULT_PROFILE = r"C:\ChromeDebug"
+
+# 找不到 CHROME_PATH 时依次尝试的安装位置
+CHROME_CANDIDATES = (
+    r"C:\Program Files\Google\Chrome\Application\chrome.exe",
+    r"C:\Program Files (x86)\Google\Chrome\Application\chrome.exe",
+    os.path.expandvars(r"%LOCALAPPDATA%\Google\Chrome\Application\chrome.exe"),
+    "/Applications/Google Chrome.app/Contents/MacOS/Google Chrome",
+)
+
+# Storage.setCookies 接受的字段（Storage.getCookies 返回的其余字段是只读的）
+COOKIE_PARAM_KEYS = ('name', 'value', 'domain', 'path', 'secure', 'httpOnly', 'sameSite', 'expires', 'priority')
+
+
+def find_chrome(chrome_path=None):
+    """chrome.exe 的位置：参数、CHROME_PATH 环境变量、常见安装位置、PATH，都找不到时返回 None"""
+    for candidate in (chrome_path, os.environ.get('CHROME_PATH')) + CHROME_CANDIDATES:
+        if candidate and os.path.isfile(candidate):
+            return candidate
+    for name in (chrome_path, 'chrome', 'google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser'):
+        found = name and shutil.which(name)
+        if found:
+            return found
+    return None
+
+
+def port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(('127.0.0.1', port))
+            return True
+        except OSError:
+            return False
+
+
+def _call(ws_url, method, params=None, timeout=10):
+    """打开一次性的CDP连接执行一条命令，超时或出错时抛异常"""
+    # 不发送Origin头，否则未加 --remote-allow-origins 的Chrome会拒绝连接
+    ws = websocket.create_connection(ws_url, timeout=timeout, suppress_origin=True)
+    try:
+        ws.send(json.dumps({'id': 1, 'method': method, 'params': params or {}}))
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            message = json.loads(ws.recv())
+            if message.get('id') != 1:
+                continue
+            if 'error' in message:
+                raise RuntimeError(f"{method} 失败: {message['error'].get('message')}")
+            return message.get('result', {})
+        raise TimeoutError(f"CDP命令超时: {method}")
+    finally:
+        ws.close()
+
+
+def cdp_command(port, method, params=None, timeout=10):
+    """在浏览器级别的CDP连接上执行一条命令"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/json/version", timeout=timeout) as resp:
+        ws_url = json.loads(resp.read().decode('utf-8'))['webSocketDebuggerUrl']
+    return _call(ws_url, method, params, timeout)
+
+
+def open_url(port, url, timeout=10):
+    """让浏览器的第一个标签页打开网址（热备浏览器预先打开发票页面，连接、缓存和登录会话都已就绪）"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/json/list", timeout=timeout) as resp:
+        pages = [target for target in json.loads(resp.read().decode('utf-8')) if target.get('type') == 'page']
+    if not pages:
+        return False
+    _call(pages[0]['webSocketDebuggerUrl'], 'Page.navigate', {'url': url}, timeout)
+    return True
+
+
+def copy_cookies(source_port, target_port, timeout=10):
+    """
+    把一个浏览器的全部Cookie（包括只存在内存里的会话Cookie）复制到另一个浏览器，共用同一个登录会话。
+
+    :return: 复制的Cookie数量
+    """
+    cookies = cdp_command(source_port, 'Storage.getCookies', timeout=timeout).get('cookies', [])
+    params = []
+    for cookie in cookies:
+        param = {key: cookie[key] for key in COOKIE_PARAM_KEYS if key in cookie}
+        if cookie.get('session') or param.get('expires', -1) < 0:
+            param.pop('expires', None)
+        params.append(param)
+    if params:
+        cdp_command(target_port, 'Storage.setCookies', {'cookies': params}, timeout=timeout)
+    return len(params)
+
+
+class ChromeProcess:
+    """一个由程序启动的Chrome进程：固定的调试端口和用户数据目录"""
+
+    def __init__(self, chrome_path, port, user_data_dir, headless=True):
+        self.chrome_path = chrome_path
+        self.port = port
+        self.user_data_dir = user_data_dir
+        self.headless = headless
+        self.process = None
+        self.failures = 0  # 连续健康检查失败的次数
+        self.restarts = 0
+
+    def launch(self, timeout=30):
+        """启动Chrome并等待调试端口可用"""
+        os.makedirs(self.user_data_dir, exist_ok=True)
+        args = [
+            self.chrome_path,
+            f"--remote-debugging-port={self.port}",
+            f"--user-data-dir={self.user_data_dir}",
+            "--remote-allow-origins=*",
+            "--no-first-run",
+            "--no-default-browser-check",
+            # 后台标签页也要全速运行（并行标签页、下载专用标签页）
+            "--disable-background-timer-throttling",
+            "--disable-renderer-backgrounding",
+        ]
+        if self.headless:
+            args.append("--headless=new")
+        args.append("about:blank")
+        self.process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                code = self.process.returncode
+                self.process = None
+                raise RuntimeError(f"Chrome启动后立即退出（退出码 {code}），"
+                                   f"用户数据目录可能正被其他Chrome使用: {self.user_data_dir}")
+            if self.responsive(timeout=2):
+                self.failures = 0
+                return
+            time.sleep(0.3)
+        self.terminate()
+        raise TimeoutError(f"Chrome在 {timeout} 秒内没有打开调试端口 {self.port}")
+
+    def responsive(self, timeout=5):
+        """进程还在，并且在 timeout 秒内响应了CDP命令"""
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            cdp_command(self.port, 'Browser.getVersion', timeout=timeout)
+            return True
+        except Exception:
+            return False
+
+    def terminate(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait(5)
+        self.process = None
+
+
+class ChromePool:
+    """
+    程序自己启动并管理的一组无界面Chrome，代替手动在命令提示符里启动的调试Chrome。
+
+    - 第一个浏览器直接使用已登录的用户数据目录，其余浏览器各用一个 <目录>-poolN，
+      启动后从已经在运行的浏览器复制Cookie，所有浏览器共用同一个登录会话
+    - 另外保持 spares 个热备浏览器（已启动、已复制Cookie、已打开发票页面），某个浏览器卡死时立即换上
+    - 后台线程定期做健康检查：连续两次无响应的浏览器直接结束进程，正在等它的WebDriver调用会立即出错，
+      下载任务随后调用 recover 换用热备浏览器；坏掉的浏览器在后台重启，成为新的热备
+    """
+
+    def __init__(self, size=1, user_data_dir=DEFAULT_PROFILE, spares=1, headless=True, chrome_path=None,
+                 base_port=BASE_PORT, warm_url=None, check_interval=15):
+        """
+        :param size: 同时用于下载的浏览器数量
+        :param user_data_dir: 已登录票根网的用户数据目录
+        :param spares: 热备浏览器数量
+        :param headless: False 时显示浏览器窗口（登录会话过期、需要重新登录时使用）
+        :param chrome_path: chrome.exe 的位置，None 时自动查找
+        :param base_port: 从这个端口开始分配调试端口
+        :param warm_url: 热备浏览器预先打开的页面（一般是发票卡片列表页）
+        :param check_interval: 健康检查的间隔（秒）
+        """
+        self.size = max(1, int(size))
+        self.spare_count = max(0, int(spares))
+        self.user_data_dir = os.path.abspath(user_data_dir)
+        self.headless = headless
+        self.chrome_path = chrome_path
+        self.base_port = base_port
+        self.warm_url = warm_url
+        self.check_interval = check_interval
+
+        self._members = {}       # 端口 -> ChromeProcess
+        self._active = []        # 正在用于下载的浏览器端口，顺序即分配给下载任务的顺序
+        self._spares = []        # 热备浏览器端口
+        self._restarting = set()
+        self._moved = {}         # 被换下的端口 -> 换上的端口（共用一个浏览器的标签页任务都能找到新浏览器）
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._monitor = None
+
+    @property
+    def ports(self):
+        """用于下载的调试端口（传给 MonthWorkerPool / InvoiceDownloader）"""
+        with self._lock:
+            return list(self._active)
+
+    def _profile_dir(self, slot):
+        if slot == 0:
+            return self.user_data_dir
+        return f"{self.user_data_dir.rstrip(os.sep)}-pool{slot + 1}"
+
+    def _allocate_ports(self, count):
+        ports = []
+        port = self.base_port
+        while len(ports) < count:
+            if port_free(port):
+                ports.append(port)
+            port += 1
+        return ports
+
+    def start(self):
+        """启动全部浏览器和健康检查线程，返回用于下载的端口列表"""
+        self.chrome_path = find_chrome(self.chrome_path)
+        if not self.chrome_path:
+            raise FileNotFoundError("找不到Chrome，请填写chrome.exe的位置（或设置CHROME_PATH环境变量）")
+        started = time.perf_counter()
+        ports = self._allocate_ports(self.size + self.spare_count)
+        members = [ChromeProcess(self.chrome_path, port, self._profile_dir(slot), self.headless)
+                   for slot, port in enumerate(ports)]
+        for member in members:
+            self._members[member.port] = member
+
+        # 先启动使用已登录目录的浏览器，其余浏览器同时启动并从它复制Cookie
+        members[0].launch()
+        self._active.append(members[0].port)
+        with ThreadPoolExecutor(max_workers=max(1, len(members) - 1)) as executor:
+            launched = list(executor.map(self._prepare, members[1:]))
+        for member, ok in zip(members[1:], launched):
+            if not ok:
+                continue
+            if len(self._active) < self.size:
+                self._active.append(member.port)
+            else:
+                self._spares.append(member.port)
+        if self.warm_url:
+            for port in self._spares:
+                self._warm(port)
+
+        METRICS.observe('chrome_pool_start', time.perf_counter() - started)
+        mode = "无界面" if self.headless else "有界面"
+        print(f"🌐🌐 已启动 {len(self._active) + len(self._spares)} 个{mode}Chrome: 下载用端口 {self._active}，"
+              f"热备 {self._spares}，用时 {time.perf_counter() - started:.1f}s")
+
+        self._monitor = threading.Thread(target=self._monitor_loop, name="chrome-pool-monitor", daemon=True)
+        self._monitor.start()
+        return self.ports
+
+    def _cookie_source(self, exclude):
+        """复制Cookie的来源：正在下载的浏览器优先（会话Cookie最新），其次热备浏览器"""
+        with self._lock:
+            candidates = [port for port in self._active + self._spares if port != exclude]
+        for port in candidates:
+            if port not in self._restarting and self._members[port].responsive(timeout=3):
+                return port
+        return None
+
+    def _prepare(self, member):
+        """启动（或重启）一个浏览器并复制登录会话，失败时返回False"""
+        try:
+            member.launch()
+        except Exception as e:
+            print(f"❌❌ Chrome {member.port} 启动失败: {e}")
+            return False
+        source = self._cookie_source(member.port)
+        if source is not None:
+            try:
+                copy_cookies(source, member.port)
+            except Exception as e:
+                print(f"⚠️ Chrome {member.port} 复制登录会话失败: {e}")
+        return True
+
+    def _warm(self, port):
+        try:
+            open_url(port, self.warm_url)
+        except Exception as e:
+            print(f"⚠️ 热备Chrome {port} 预先打开页面失败: {e}")
+
+    def share_cookies(self):
+        """把第一个浏览器的Cookie复制给其余浏览器（在有界面的浏览器里重新登录之后调用）"""
+        with self._lock:
+            ports = self._active + self._spares
+        for port in ports[1:]:
+            try:
+                count = copy_cookies(ports[0], port)
+                print(f"🍪🍪 Chrome {port}: 已复制 {count} 个Cookie")
+            except Exception as e:
+                print(f"⚠️ Chrome {port} 复制登录会话失败: {e}")
+
+    def healthy(self, port):
+        """端口对应的浏览器还能响应（下载任务失败后用来判断是不是浏览器的问题）"""
+        with self._lock:
+            member = self._members.get(self._follow(port))
+        return member is not None and member.responsive()
+
+    def _follow(self, port):
+        while port in self._moved:
+            port = self._moved[port]
+        return port
+
+    def recover(self, port):
+        """
+        下载任务发现自己的浏览器坏了时调用：换上热备浏览器（没有热备时原地重启），返回可用的调试端口。
+        同一个浏览器里的多个标签页任务都会调用，只有第一次真正切换，之后都返回同一个新端口。
+        """
+        with self._lock:
+            port = self._follow(port)
+            member = self._members[port]
+            if port not in self._active or member.responsive():
+                return port
+            spare = self._spares.pop(0) if self._spares else None
+            if spare is None:
+                # 没有热备：原地重启，期间其他调用者在锁外等待
+                print(f"🔁🔁 Chrome {port} 无响应，重新启动")
+                member.terminate()
+                member.restarts += 1
+                METRICS.incr('chrome_restarts')
+                self._prepare(member)
+                return port
+            self._active[self._active.index(port)] = spare
+            self._moved.pop(spare, None)
+            self._moved[port] = spare
+            self._restarting.add(port)
+        print(f"🔁🔁 Chrome {port} 无响应，换用热备 Chrome {spare}，原浏览器在后台重启")
+        METRICS.incr('chrome_failovers')
+        # 热备启动后下载用的浏览器可能又拿到了新的会话Cookie
+        source = self._cookie_source(spare)
+        if source is not None:
+            try:
+                copy_cookies(source, spare)
+            except Exception:
+                pass
+        threading.Thread(target=self._restart_as_spare, args=(member,), daemon=True).start()
+        return spare
+
+    def _restart_as_spare(self, member):
+        """重启一个浏览器，成功后放回热备"""
+        with self._lock:
+            if member.port in self._active:
+                return
+            self._restarting.add(member.port)
+            if member.port in self._spares:
+                self._spares.remove(member.port)
+        ok = False
+        try:
+            member.terminate()
+            member.restarts += 1
+            METRICS.incr('chrome_restarts')
+            ok = self._prepare(member)
+            if ok and self.warm_url:
+                self._warm(member.port)
+        finally:
+            with self._lock:
+                self._restarting.discard(member.port)
+                if ok:
+                    self._spares.append(member.port)
+
+    def _monitor_loop(self):
+        while not self._stop.wait(self.check_interval):
+            with self._lock:
+                ports = [port for port in self._members if port not in self._restarting]
+            for port in ports:
+                if self._stop.is_set():
+                    return
+                member = self._members[port]
+                if member.responsive():
+                    member.failures = 0
+                    continue
+                member.failures += 1
+                with self._lock:
+                    active = port in self._active
+                if not active:
+                    # 热备或之前重启失败的浏览器：后台重启
+                    self._restart_as_spare(member)
+                elif member.failures >= 2 and member.process is not None:
+                    # 卡死的浏览器直接结束，等它的WebDriver调用立即出错，由下载任务换用热备
+                    print(f"⚠️ Chrome {port} 连续 {member.failures} 次健康检查无响应，结束进程")
+                    member.terminate()
+
+    def close(self):
+        self._stop.set()
+        if self._monitor:
+            self._monitor.join(timeout=10)
+        restarts = sum(member.restarts for member in self._members.values())
+        for member in self._members.values():
+            member.terminate()
+        if self._members:
+            print(f"🔚🔚 已关闭 {len(self._members)} 个托管的Chrome（重启 {restarts} 次）")
+        self._members.clear()
+        self._active.clear()
+        self._spares.clear()
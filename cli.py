@@ -0,0 +1,271 @@
+import time
+
+# 从这里开始计算启动用时（不含解释器本身的启动）
+STARTED = time.perf_counter()
+
+import os
+import re
+import sys
+import argparse
+import multiprocessing
+
+from month_input import parse_month_input, get_month_range, split_month_list
+
+DEFAULT_ROOT = "invoice_downloads"
+
+
+def split_values(text):
+    """逗号分隔的参数值（端口、卡片名称）"""
+    return [value.strip() for value in re.split(r'[,，]', text) if value.strip()]
+
+
+def report_startup(args, command):
+    """--timing 时打印从启动到开始执行命令的用时（包括按需导入的模块）"""
+    if args.timing:
+        print(f"⏱⏱ {command}: 启动用时 {(time.perf_counter() - STARTED) * 1000:.0f} ms")
+
+
+def months_from_args(args):
+    """
+    下载的月份：位置参数（可以用逗号分隔多个）或 --from/--to 连续范围。
+
+    :return: [(year, month), ...]
+    """
+    month_list = []
+    for month_str in split_month_list(' '.join(args.months)):
+        month_list.append(parse_month_input(month_str))
+    if args.start:
+        start_year, start_month = parse_month_input(args.start)
+        end_year, end_month = parse_month_input(args.end or args.start)
+        if (start_year, start_month) > (end_year, end_month):
+            raise ValueError("起始月份不能晚于结束月份")
+        month_list += get_month_range(start_year, start_month, end_year, end_month)
+    for year, month in month_list:
+        if not 1 <= month <= 12:
+            raise ValueError(f"月份无效: {year}{month:02d}")
+    if not month_list and args.sync:
+        # 同步默认只看本月
+        today = time.localtime()
+        month_list.append((today.tm_year, today.tm_mon))
+    # 去重并保持顺序
+    return list(dict.fromkeys(month_list))
+
+
+def cmd_download(args):
+    try:
+        month_list = months_from_args(args)
+    except ValueError as e:
+        print(f"❌❌ 日期解析错误: {e}")
+        return 2
+    if not month_list:
+        print("❌❌ 请指定要下载的月份，例如: download 202410 202411 或 download --from 202401 --to 202412")
+        return 2
+
+    # 只有下载才需要 selenium 和浏览器相关的模块
+    import main as app
+    from metrics import METRICS
+    from extract_pipeline import ExtractionPipeline
+    report_startup(args, args.command)
+
+    root = os.path.abspath(args.root)
+    os.makedirs(root, exist_ok=True)
+    target_url = args.url or app.DEFAULT_TARGET_URL
+    ports = [int(port) for port in split_values(args.ports)] if args.ports else [args.port]
+    cards = split_values(args.cards) if args.cards else None
+    chrome_pool = None
+    if args.launch:
+        chrome_pool = app.start_chrome_pool(args.launch, args.chrome_profile, args.chrome_path, target_url,
+                                            not args.show_browser, args.spares)
+        if chrome_pool is None:
+            return 1
+        ports = chrome_pool.ports
+    action = "同步" if args.sync else "下载"
+    print(f"🚀🚀 {action} {len(month_list)} 个月份: {', '.join(f'{y}{m:02d}' for y, m in month_list)}")
+
+    pipeline = None
+    if not args.no_extract and not args.async_core:
+        pipeline = ExtractionPipeline(root, args.workers)
+    downloader = None
+    success = False
+    try:
+        if args.async_core:
+            # 异步核心自己解压，也支持多卡片
+            downloader = app.InvoiceDownloader(ports[0], root, args.mode, args.http_concurrency)
+            downloader.async_core = True
+            downloader.month_concurrency = args.async_months
+            downloader.extract_workers = args.workers
+            downloader.sync_mode = args.sync
+            success = downloader.run_async_core(target_url, month_list, cards)
+        elif cards or args.all_cards:
+            profiles = [{'name': None, 'debug_ports': ports, 'cards': cards, 'target_url': target_url}]
+            success = app.batch_download_sweep(target_url, month_list, root, profiles, args.tabs,
+                                               args.mode, args.http_concurrency, pipeline, args.sync, chrome_pool)
+        elif len(ports) * args.tabs > 1 or chrome_pool:
+            # 托管的Chrome一律交给任务池，浏览器卡死时才能换用热备浏览器
+            success = app.batch_download_parallel(target_url, month_list, root, ports, args.tabs,
+                                                  args.mode, args.http_concurrency, pipeline, args.sync, chrome_pool)
+        else:
+            downloader = app.InvoiceDownloader(ports[0], root, args.mode, args.http_concurrency)
+            downloader.extract_pipeline = pipeline
+            downloader.sync_mode = args.sync
+            success = downloader.batch_download_multiple_months(target_url, month_list)
+
+        if not args.no_extract:
+            app.extract_downloads(pipeline, args.workers, root, args.sync)
+            pipeline = None
+    finally:
+        if pipeline:
+            pipeline.close()
+        if downloader:
+            downloader.close()
+        if chrome_pool:
+            chrome_pool.close()
+        METRICS.export(root)
+    return 0 if success else 1
+
+
+def cmd_extract(args):
+    import my_zip
+    import pdf_index
+    import reconcile
+    report_startup(args, "extract")
+
+    if not os.path.isdir(args.root):
+        print(f"❌❌ 目录不存在: {args.root}")
+        return 2
+    results = my_zip.main(args.root, workers=args.workers)
+    if not args.no_index:
+        pdf_index.update_index(args.root, args.workers)
+        reconcile.reconcile_tree(args.root)
+    return 1 if any(r['errors'] and not r['files'] for r in results) else 0
+
+
+def cmd_verify(args):
+    import my_zip
+    report_startup(args, "verify")
+
+    if not os.path.isdir(args.root):
+        print(f"❌❌ 目录不存在: {args.root}")
+        return 2
+    corrupt = my_zip.verify_tree(args.root, args.workers)
+    return 1 if corrupt else 0
+
+
+def cmd_compact(args):
+    import blob_store
+    report_startup(args, "compact")
+
+    stats = blob_store.compact(args.root)
+    return 0 if stats is not None else 2
+
+
+def cmd_report(args):
+    import invoice_records
+    report_startup(args, "report")
+
+    start = end = None
+    try:
+        if args.start:
+            start = "%d%02d" % parse_month_input(args.start)
+            end = "%d%02d" % parse_month_input(args.end or args.start)
+    except ValueError as e:
+        print(f"❌❌ 日期解析错误: {e}")
+        return 2
+    rows = invoice_records.summarize(args.root, start, end, args.card)
+    return 0 if rows else 1
+
+
+def cmd_search(args):
+    import pdf_index
+    report_startup(args, "search")
+
+    if not os.path.isdir(args.root):
+        print(f"❌❌ 目录不存在: {args.root}")
+        return 2
+    if args.update:
+        pdf_index.update_index(args.root, args.workers)
+    results = pdf_index.search(args.root, ' '.join(args.query), args.limit)
+    return 0 if results else 1
+
+
+def add_download_arguments(parser, months_help="月份 YYYYMM，可以写多个或用逗号分隔"):
+    """download 和 sync 共用的参数"""
+    parser.add_argument('months', nargs='*', help=months_help)
+    parser.add_argument('--from', dest='start', help="连续月份范围的起始月份")
+    parser.add_argument('--to', dest='end', help="连续月份范围的结束月份（包含），默认与起始月份相同")
+    parser.add_argument('--root', default=DEFAULT_ROOT, help="下载目录")
+    parser.add_argument('--url', default=None, help="发票卡片列表页地址")
+    parser.add_argument('--port', type=int, default=9222, help="Chrome调试端口")
+    parser.add_argument('--ports', default=None, help="并行下载使用的多个调试端口，逗号分隔")
+    parser.add_argument('--tabs', type=int, default=1, help="每个Chrome实例中并行的标签页数")
+    parser.add_argument('--mode', default='browser', choices=['browser', 'http'], help="下载方式")
+    parser.add_argument('--http-concurrency', type=int, default=4, help="HTTP直连下载的并发数")
+    parser.add_argument('--cards', default=None, help="要下载的卡片，逗号分隔（按卡片分文件夹保存）")
+    parser.add_argument('--all-cards', action='store_true', help="下载卡片列表页上的全部卡片")
+    parser.add_argument('--async-core', action='store_true', help="使用异步核心（直接通过CDP控制浏览器）")
+    parser.add_argument('--async-months', type=int, default=2, help="异步核心同时处理的月份数")
+    parser.add_argument('--workers', type=int, default=None, help="解压进程数，默认使用全部CPU核心")
+    parser.add_argument('--no-extract', action='store_true', help="只下载，不解压")
+    parser.add_argument('--launch', type=int, default=0, metavar='N',
+                        help="由程序启动N个无界面Chrome下载（不需要手动启动调试Chrome），忽略 --port/--ports")
+    parser.add_argument('--spares', type=int, default=1, help="--launch 时额外启动的热备Chrome数量")
+    parser.add_argument('--chrome-profile', default=r"C:\ChromeDebug", help="--launch 时使用的已登录用户数据目录")
+    parser.add_argument('--chrome-path', default=None, help="chrome.exe 的位置，默认自动查找")
+    parser.add_argument('--show-browser', action='store_true', help="--launch 时显示浏览器窗口")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="发票批量下载命令行（不带参数运行 main.py 为交互菜单）。适合定时任务：不需要任何输入，退出码 0 表示成功")
+    parser.add_argument('--timing', action='store_true', help="打印启动用时")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    download = commands.add_parser('download', help="下载指定月份的发票，完成后解压、建索引、对账")
+    add_download_arguments(download)
+    download.set_defaults(func=cmd_download, sync=False)
+
+    sync = commands.add_parser('sync', help="同步新发票：与上次同步相比没有变化的月份直接跳过，有变化时只下载新增的发票")
+    add_download_arguments(sync, "要同步的月份，默认为本月")
+    sync.set_defaults(func=cmd_download, sync=True)
+
+    extract = commands.add_parser('extract', help="解压下载目录里新的压缩包，并更新发票索引和对账结果")
+    extract.add_argument('--root', default=DEFAULT_ROOT, help="下载目录")
+    extract.add_argument('--workers', type=int, default=None, help="解压和解析PDF的进程数")
+    extract.add_argument('--no-index', action='store_true', help="只解压，不更新发票索引和对账结果")
+    extract.set_defaults(func=cmd_extract)
+
+    verify = commands.add_parser('verify', help="检查已下载的压缩包是否完整，损坏的移到 .quarantine 并在下次运行时重新下载")
+    verify.add_argument('--root', default=DEFAULT_ROOT, help="下载目录")
+    verify.add_argument('--workers', type=int, default=None, help="检查压缩包的进程数")
+    verify.set_defaults(func=cmd_verify)
+
+    compact = commands.add_parser('compact', help="内容相同的压缩包和PDF改为硬链接，回收重复下载占用的磁盘空间")
+    compact.add_argument('--root', default=DEFAULT_ROOT, help="下载目录")
+    compact.set_defaults(func=cmd_compact)
+
+    report = commands.add_parser('report', help="汇总任意月份范围的发票数量和金额（不扫描下载目录）")
+    report.add_argument('start', nargs='?', help="起始月份，不填表示全部")
+    report.add_argument('end', nargs='?', help="结束月份（包含），默认与起始月份相同")
+    report.add_argument('--root', default=DEFAULT_ROOT, help="下载目录")
+    report.add_argument('--card', default=None, help="只汇总某张卡片（卡片文件夹名）")
+    report.set_defaults(func=cmd_report)
+
+    search = commands.add_parser('search', help="按发票号码、销售方、车牌号、金额、日期搜索已下载的发票")
+    search.add_argument('query', nargs='+', help="搜索关键词，多个关键词同时满足")
+    search.add_argument('--root', default=DEFAULT_ROOT, help="下载目录")
+    search.add_argument('--limit', type=int, default=20, help="最多显示的结果数")
+    search.add_argument('--update', action='store_true', help="搜索前先更新索引")
+    search.add_argument('--workers', type=int, default=None, help="解析PDF的进程数")
+    search.set_defaults(func=cmd_search)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    # 解压和解析PDF会用到进程池
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+# 发票下载状态
+STATE_PENDING = 'pending'
+STATE_DOWNLOADING = 'downloading'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+MANIFEST_FILENAME = '.manifest.json'
+
+# Chrome 重名下载生成的文件名：xxx (1).zip
+_DUPLICATE_NAME = re.compile(r'^(?P<stem>.*) \((?P<n>\d+)\)(?P<ext>\.zip)$', re.I)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def invoice_key(row):
+    """发票在清单里的稳定标识：优先使用页面上的发票标识，没有时退回序号"""
+    return row.get('invoice_id') or f"#{row['index']}"
+
+
+class DownloadManifest:
+    """
+    月份文件夹里的下载清单（.manifest.json），按发票标识记录下载状态、文件路径和哈希。
+
+    中途崩溃后重新运行时，已完成的发票直接跳过，只重试未完成和失败的；
+    Chrome 重复下载产生的 xxx (1).zip 会被识别并合并。
+    """
+
+    def __init__(self, month_path, store=None):
+        """
+        :param month_path: 月份文件夹
+        :param store: BlobStore；下载完成的压缩包放进内容寻址存储，其他文件夹下载过的发票直接链接过来
+        """
+        self.month_path = month_path
+        self.path = os.path.join(month_path, MANIFEST_FILENAME)
+        self.store = store
+        self.invoices = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.invoices = json.load(f).get('invoices', {})
+        except Exception as e:
+            print(f"⚠️ 下载清单读取失败，将重新记录: {e}")
+            self.invoices = {}
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'updated': time.strftime('%Y-%m-%d %H:%M:%S'), 'invoices': self.invoices},
+                      f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def sync_rows(self, rows):
+        """
+        把本次页面上读到的发票登记进清单，新发票状态为 pending。
+        有存储时，别的月份/卡片文件夹已经下载过的发票直接从存储链接过来，记为已完成。
+
+        :return: 从存储链接过来的压缩包路径（需要解压）
+        """
+        restored = []
+        with self._lock:
+            for row in rows:
+                key = invoice_key(row)
+                entry = self.invoices.setdefault(key, {'state': STATE_PENDING})
+                entry['index'] = row['index']
+                entry['amount'] = row.get('amount', 0.0)
+                entry['href'] = row.get('href')
+                if self.store is None or key.startswith('#') or self.is_done(key):
+                    continue
+                found = self.store.restore_invoice(key, self.month_path)
+                if found:
+                    entry.update(state=STATE_DONE, file=found[0], sha256=found[1], error=None,
+                                 updated=time.time(), restored=True)
+                    restored.append(os.path.join(self.month_path, found[0]))
+            self._save()
+        if restored:
+            print(f"🔗🔗 {len(restored)} 张发票已在其他文件夹下载过，直接从存储链接，不再下载")
+        return restored
+
+    def get(self, key):
+        return self.invoices.get(key)
+
+    def is_done(self, key):
+        """已下载完成，并且文件仍在（文件名未知的旧记录只看状态）"""
+        entry = self.invoices.get(key)
+        if not entry or entry.get('state') != STATE_DONE:
+            return False
+        filename = entry.get('file')
+        return not filename or os.path.exists(os.path.join(self.month_path, filename))
+
+    def mark(self, key, state, file_path=None, error=None, **extra):
+        """更新发票状态；完成时记录文件名和SHA-256"""
+        file_hash = None
+        if state == STATE_DONE and file_path and os.path.exists(file_path):
+            file_hash = file_sha256(file_path)
+        with self._lock:
+            entry = self.invoices.setdefault(key, {})
+            entry['state'] = state
+            entry['updated'] = time.time()
+            entry['error'] = error
+            if state == STATE_DOWNLOADING:
+                entry['attempts'] = entry.get('attempts', 0) + 1
+            if file_path:
+                entry['file'] = os.path.basename(file_path)
+            if file_hash:
+                entry['sha256'] = file_hash
+            entry.update(extra)
+            self._save()
+        if file_hash and self.store is not None:
+            self.store.add(file_path, file_hash)
+            if not key.startswith('#'):
+                self.store.remember_invoice(key, file_hash, os.path.basename(file_path))
+
+    def counts(self):
+        result = {}
+        for entry in self.invoices.values():
+            result[entry.get('state')] = result.get(entry.get('state'), 0) + 1
+        return result
+
+    def collapse_duplicates(self):
+        """
+        合并 Chrome 重复下载产生的 xxx (1).zip：
+        与原文件内容相同则删除重复文件（及其解压文件夹），原文件不存在时改名为原文件名。
+
+        :return: 清理掉的重复文件数量
+        """
+        removed = 0
+        changed = False
+        hashes = {}
+
+        def cached_hash(path):
+            if path not in hashes:
+                hashes[path] = file_sha256(path)
+            return hashes[path]
+
+        for name in sorted(os.listdir(self.month_path)):
+            match = _DUPLICATE_NAME.match(name)
+            if not match:
+                continue
+            dup_path = os.path.join(self.month_path, name)
+            base_name = match.group('stem') + match.group('ext')
+            base_path = os.path.join(self.month_path, base_name)
+            if not os.path.isfile(dup_path):
+                continue
+
+            if not os.path.exists(base_path):
+                os.replace(dup_path, base_path)
+                self._rename_file(name, base_name)
+                changed = True
+                print(f"🧹🧹 重复下载改名: {name} -> {base_name}")
+                continue
+
+            if cached_hash(dup_path) != cached_hash(base_path):
+                continue
+            os.remove(dup_path)
+            dup_folder = dup_path[:-4]
+            if os.path.isdir(dup_folder):
+                shutil.rmtree(dup_folder, ignore_errors=True)
+            self._rename_file(name, base_name)
+            removed += 1
+            changed = True
+            print(f"🧹🧹 删除重复下载: {name}")
+
+        if changed:
+            self.save()
+        return removed
+
+    def _rename_file(self, old_name, new_name):
+        with self._lock:
+            for entry in self.invoices.values():
+                if entry.get('file') == old_name:
+                    entry['file'] = new_name
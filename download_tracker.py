@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import threading
+import urllib.request
+
+import websocket
+
+
+class DownloadTracker:
+    """
+    通过Chrome调试端口的CDP连接监听下载事件，判断每张发票的压缩包何时下载完成。
+
+    selenium 的 execute_cdp_cmd 只能发命令、收不到事件，所以这里直接连接浏览器级别的
+    websocket，用 Browser.setDownloadBehavior 设置下载目录并打开
+    Browser.downloadWillBegin / Browser.downloadProgress 事件。
+    """
+
+    def __init__(self, debug_port=9222, host="127.0.0.1"):
+        self.debug_port = debug_port
+        self.host = host
+        self.ws = None
+        self.download_path = None
+
+        self._next_id = 0
+        self._responses = {}
+        self._cond = threading.Condition()
+        self._reader = None
+        self._closed = False
+
+        # guid -> 下载记录，按开始顺序保存在 _order 里
+        self.downloads = {}
+        self._order = []
+
+    def connect(self):
+        """连接浏览器的CDP websocket，失败时返回False（调用方退回固定等待）"""
+        try:
+            version_url = f"http://{self.host}:{self.debug_port}/json/version"
+            with urllib.request.urlopen(version_url, timeout=5) as resp:
+                ws_url = json.loads(resp.read().decode('utf-8'))['webSocketDebuggerUrl']
+            # 不发送Origin头，否则未加 --remote-allow-origins 的Chrome会拒绝连接
+            self.ws = websocket.create_connection(ws_url, timeout=10, suppress_origin=True)
+            self.ws.settimeout(None)
+            self._reader = threading.Thread(target=self._read_loop, daemon=True)
+            self._reader.start()
+            print("🛰🛰 已连接Chrome下载事件监听")
+            return True
+        except Exception as e:
+            print(f"⚠️ 无法连接Chrome下载事件监听，将使用固定等待: {e}")
+            self.ws = None
+            return False
+
+    @property
+    def connected(self):
+        return self.ws is not None and not self._closed
+
+    def _read_loop(self):
+        while not self._closed:
+            try:
+                message = json.loads(self.ws.recv())
+            except Exception:
+                break
+            with self._cond:
+                if 'id' in message:
+                    self._responses[message['id']] = message
+                else:
+                    self._handle_event(message.get('method'), message.get('params', {}))
+                self._cond.notify_all()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def send(self, method, params=None, timeout=10):
+        """发送一条CDP命令并等待返回结果"""
+        with self._cond:
+            self._next_id += 1
+            command_id = self._next_id
+        self.ws.send(json.dumps({'id': command_id, 'method': method, 'params': params or {}}))
+        deadline = time.time() + timeout
+        with self._cond:
+            while command_id not in self._responses:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._closed:
+                    raise TimeoutError(f"CDP命令超时: {method}")
+                self._cond.wait(remaining)
+            response = self._responses.pop(command_id)
+        if 'error' in response:
+            raise RuntimeError(f"{method} 失败: {response['error'].get('message')}")
+        return response.get('result', {})
+
+    def set_download_path(self, download_path):
+        """设置下载目录并打开下载事件"""
+        self.send('Browser.setDownloadBehavior', {
+            'behavior': 'allow',
+            'downloadPath': download_path,
+            'eventsEnabled': True,
+        })
+        self.download_path = download_path
+
+    def _handle_event(self, method, params):
+        # 调用方已持有 self._cond
+        if method == 'Browser.downloadWillBegin':
+            guid = params['guid']
+            self.downloads[guid] = {
+                'guid': guid,
+                'url': params.get('url'),
+                'suggested_filename': params.get('suggestedFilename'),
+                'download_path': self.download_path,
+                'state': 'inProgress',
+                'bytes': 0,
+                'total_bytes': 0,
+                'started': time.time(),
+                'finished': None,
+                'duration': None,
+                'filename': None,
+            }
+            self._order.append(guid)
+        elif method == 'Browser.downloadProgress':
+            record = self.downloads.get(params.get('guid'))
+            if record is None:
+                return
+            record['bytes'] = params.get('receivedBytes', record['bytes'])
+            record['total_bytes'] = params.get('totalBytes', record['total_bytes'])
+            state = params.get('state', 'inProgress')
+            if state != 'inProgress' and record['finished'] is None:
+                record['state'] = state
+                record['finished'] = time.time()
+                record['duration'] = record['finished'] - record['started']
+                record['filename'] = self._final_filename(record, params.get('filePath'))
+
+    def _final_filename(self, record, file_path):
+        """确定下载完成后的实际文件名（Chrome重名时会改成 xxx (1).zip）"""
+        if file_path:
+            return os.path.basename(file_path)
+        suggested = record['suggested_filename']
+        folder = record['download_path']
+        if not suggested or not folder or not os.path.isdir(folder):
+            return suggested
+        stem, ext = os.path.splitext(suggested)
+        candidates = [
+            os.path.join(folder, name) for name in os.listdir(folder)
+            if name.startswith(stem) and name.endswith(ext)
+        ]
+        if not candidates:
+            return suggested
+        return os.path.basename(max(candidates, key=os.path.getmtime))
+
+    def mark(self):
+        """记录当前已开始的下载数量，配合 wait_for_next 找到之后开始的那个下载"""
+        with self._cond:
+            return len(self._order)
+
+    def wait_for_next(self, marker, begin_timeout=15, complete_timeout=300):
+        """
+        等待 marker 之后开始的第一个下载结束。
+
+        :return: 下载记录dict；超时未开始或未完成时返回None
+        """
+        deadline = time.time() + begin_timeout
+        with self._cond:
+            while len(self._order) <= marker:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._closed:
+                    return None
+                self._cond.wait(remaining)
+            record = self.downloads[self._order[marker]]
+
+            deadline = time.time() + complete_timeout
+            while record['finished'] is None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._closed:
+                    return None
+                self._cond.wait(remaining)
+            return dict(record)
+
+    def close(self):
+        self._closed = True
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+            self.ws = None
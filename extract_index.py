@@ -0,0 +1,105 @@
+import os
+import time
+import sqlite3
+import threading
+
+# 解压状态
+STATUS_PENDING = 'pending'
+STATUS_EXTRACTING = 'extracting'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class ExtractIndex:
+    """
+    记录每个压缩包的解压状态（SQLite），让重复运行只处理新增、变化或上次没解压完的压缩包。
+
+    - archives 表：压缩包相对路径、大小、修改时间、CRC32、状态
+    - dirs 表：月份文件夹的修改时间。文件夹里增删文件都会改变它，
+      没变化且其中压缩包都已完成时，整个文件夹连 listdir 都不用做。
+    """
+
+    def __init__(self, target_directory, filename='.extract_index.db'):
+        self.root = os.path.abspath(target_directory)
+        self.db_path = os.path.join(self.root, filename)
+        # 后台解压线程和下载线程会同时访问，用锁保护同一个连接
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS archives (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                crc32 TEXT,
+                status TEXT,
+                folder TEXT,
+                files INTEGER DEFAULT 0,
+                error TEXT,
+                updated REAL
+            );
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER
+            );
+        """)
+        self.conn.commit()
+
+    def _rel(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root).replace('\\', '/')
+
+    def get(self, zip_path):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, crc32, status, files FROM archives WHERE path = ?", (self._rel(zip_path),)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'size': row[0], 'mtime_ns': row[1], 'crc32': row[2], 'status': row[3], 'files': row[4]}
+
+    def is_done(self, zip_path, stat_result):
+        """压缩包已完成解压且自上次以来没有变化"""
+        record = self.get(zip_path)
+        return (record is not None and record['status'] == STATUS_DONE
+                and record['size'] == stat_result.st_size and record['mtime_ns'] == stat_result.st_mtime_ns)
+
+    def mark(self, zip_path, folder_path, status, stat_result=None, crc32=None, files=0, error=None):
+        """更新压缩包的解压状态"""
+        if stat_result is None:
+            stat_result = os.stat(zip_path)
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO archives (path, size, mtime_ns, crc32, status, folder, files, error, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    size = excluded.size, mtime_ns = excluded.mtime_ns,
+                    crc32 = COALESCE(excluded.crc32, archives.crc32),
+                    status = excluded.status, folder = excluded.folder,
+                    files = excluded.files, error = excluded.error, updated = excluded.updated
+            """, (self._rel(zip_path), stat_result.st_size, stat_result.st_mtime_ns, crc32, status,
+                  self._rel(folder_path), files, error, time.time()))
+            self.conn.commit()
+
+    def dir_unchanged(self, dir_path, mtime_ns):
+        """月份文件夹自上次完整处理后没有任何变化"""
+        with self.lock:
+            row = self.conn.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (self._rel(dir_path),)).fetchone()
+        return row is not None and row[0] == mtime_ns
+
+    def mark_dir(self, dir_path):
+        """月份文件夹里的压缩包都处理完毕后记录它的修改时间"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dirs (path, mtime_ns) VALUES (?, ?)",
+                (self._rel(dir_path), os.stat(dir_path).st_mtime_ns)
+            )
+            self.conn.commit()
+
+    def forget_dir(self, dir_path):
+        with self.lock:
+            self.conn.execute("DELETE FROM dirs WHERE path = ?", (self._rel(dir_path),))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
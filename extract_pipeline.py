@@ -0,0 +1,140 @@
+import os
+import time
+import queue
+import threading
+
+import my_zip
+from blob_store import BlobStore
+from extract_index import ExtractIndex, STATUS_DONE, STATUS_EXTRACTING, STATUS_FAILED
+
+
+class ExtractionPipeline:
+    """
+    下载和解压流水线：每下载完一个压缩包就放进有界队列，由后台线程立即解压。
+
+    浏览器/网络和CPU/磁盘两个阶段同时进行，最后一张发票下载完几秒内解压也就结束了，
+    不用再在全部下载完成后重新扫描整个目录。
+    """
+
+    def __init__(self, download_root, workers=2, max_pending=32):
+        """
+        :param download_root: 下载根目录（invoice_downloads），解压索引也放在这里
+        :param workers: 后台解压线程数，None 表示使用全部CPU核心（与 my_zip.main 相同）
+        :param max_pending: 队列上限，解压跟不上时下载会在提交处等待
+        """
+        self.download_root = download_root
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.index = ExtractIndex(download_root)
+        # 内容相同的压缩包直接链接已有的解压结果
+        self.store = BlobStore(download_root)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.results = []
+        self._submitted = set()
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"extract-worker-{i + 1}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, zip_path):
+        """提交一个已下载完成的压缩包，重复提交会被忽略"""
+        if not zip_path or not zip_path.lower().endswith('.zip'):
+            return False
+        zip_path = os.path.abspath(zip_path)
+        with self._lock:
+            if zip_path in self._submitted:
+                return False
+            self._submitted.add(zip_path)
+        self.queue.put(zip_path)
+        return True
+
+    def submit_folder(self, month_path):
+        """把月份文件夹里还没提交过的压缩包都提交（用于无法得知文件名的下载方式）"""
+        if not month_path or not os.path.isdir(month_path):
+            return 0
+        count = 0
+        for name in os.listdir(month_path):
+            path = os.path.join(month_path, name)
+            if name.lower().endswith('.zip') and os.path.isfile(path) and self.submit(path):
+                count += 1
+        return count
+
+    def _worker(self):
+        while True:
+            zip_path = self.queue.get()
+            try:
+                if zip_path is None:
+                    return
+                try:
+                    self._extract(zip_path)
+                except Exception as e:
+                    # 出错也不能让线程退出，否则队列满了以后下载线程会一直卡在 submit
+                    self._fail(zip_path, e)
+            finally:
+                self.queue.task_done()
+
+    def _extract(self, zip_path):
+        folder_path = zip_path[:-4]
+        try:
+            stat_result = os.stat(zip_path)
+        except OSError as e:
+            print(f"⚠️ 后台解压找不到文件: {zip_path} ({e})")
+            return
+        if self.index.is_done(zip_path, stat_result):
+            return
+
+        self.index.mark(zip_path, folder_path, STATUS_EXTRACTING, stat_result)
+        digest, result = self.store.reuse_extraction(zip_path, folder_path)
+        if result is None:
+            result = my_zip.extract_archive_task(zip_path, folder_path)
+            my_zip.record_extract_metrics(result)
+        status = STATUS_FAILED if result['errors'] and not result['files'] else STATUS_DONE
+        if self.store.add_extraction(digest, result):
+            stat_result = None
+        self.index.mark(zip_path, folder_path, status, stat_result, crc32=result['crc32'],
+                        files=result['files'], error='; '.join(result['errors']) or None)
+        if result.get('corrupt'):
+            # 下载不完整：隔离后下次运行重新下载
+            my_zip.quarantine_archive(zip_path, result['errors'][0], self.store, digest)
+        with self._lock:
+            self.results.append(result)
+
+        name = os.path.basename(zip_path)
+        if result.get('reused'):
+            print(f"🔗🔗 后台解压: {name} 与已解压的压缩包内容相同，直接链接（{result['files']} 个文件）")
+        elif status == STATUS_DONE:
+            print(f"📦📦 后台解压完成: {name}（{result['files']} 个文件）")
+        else:
+            print(f"❌❌ 后台解压失败: {name} - {'; '.join(result['errors'])}")
+
+    def _fail(self, zip_path, error):
+        """解压过程中出现意外错误：记为失败，下次运行重新解压"""
+        folder_path = zip_path[:-4]
+        result = {'zip': zip_path, 'folder': folder_path, 'crc32': None, 'files': 0, 'skipped': 0,
+                  'bytes': 0, 'elapsed': 0.0, 'errors': [f"解压 {zip_path} 时发生错误: {error}"]}
+        try:
+            self.index.mark(zip_path, folder_path, STATUS_FAILED, error=result['errors'][0])
+        except Exception as e:
+            print(f"⚠️ 解压索引更新失败: {e}")
+        with self._lock:
+            self.results.append(result)
+        print(f"❌❌ 后台解压失败: {os.path.basename(zip_path)} - {error}")
+
+    def close(self):
+        """等待队列中剩余的压缩包解压完毕并停止后台线程，返回全部解压结果"""
+        wait_started = time.perf_counter()
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.index.close()
+        self.store.close()
+
+        files = sum(r['files'] for r in self.results)
+        failed = sum(1 for r in self.results if r['errors'] and not r['files'])
+        print(f"✅ 后台解压结束: {len(self.results)} 个压缩包，{files} 个文件，失败 {failed} 个；"
+              f"下载结束后额外等待 {time.perf_counter() - wait_started:.1f}s")
+        return self.results
@@ -0,0 +1,287 @@
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from html import unescape
+from urllib.parse import urljoin, urlparse, unquote
+
+import urllib3
+
+from metrics import METRICS
+from month_files import unique_path
+
+
+class HttpInvoiceDownloader:
+    """
+    复用调试Chrome里已经登录的会话，直接通过HTTP连接池下载发票压缩包。
+
+    浏览器只负责登录和列出发票，真正的下载不再需要打开新标签页、点击打包按钮。
+    """
+
+    def __init__(self, driver, concurrency=4, timeout=60, chunk_size=256 * 1024):
+        """
+        :param driver: 已连接的selenium WebDriver，用来读取cookie和User-Agent
+        :param concurrency: 同时下载的发票数量（同时也是连接池大小）
+        :param timeout: 单次请求的读取超时（秒）
+        :param chunk_size: 写文件时每次读取的字节数
+        """
+        self.driver = driver
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+        self.http = urllib3.PoolManager(
+            num_pools=4,
+            maxsize=self.concurrency,
+            block=True,
+            retries=urllib3.Retry(total=2, backoff_factor=0.5, redirect=5),
+        )
+        self.cookies = []
+        self.user_agent = None
+        # 同一个文件名可能被多个线程同时写入，生成文件名时需要加锁
+        self._name_lock = threading.Lock()
+        # 可选的 AdaptiveRateLimiter：每张发票下载前取令牌，出错时退避
+        self.rate_limiter = None
+
+    def load_session_from_driver(self):
+        """从浏览器里取出一次cookie和User-Agent，后续所有请求共用"""
+        try:
+            # Network.getAllCookies 可以拿到所有域名（包括HttpOnly）的cookie
+            result = self.driver.execute_cdp_cmd('Network.getAllCookies', {})
+            self.cookies = result.get('cookies', [])
+        except Exception:
+            self.cookies = self.driver.get_cookies()
+
+        try:
+            self.user_agent = self.driver.execute_script("return navigator.userAgent;")
+        except Exception:
+            self.user_agent = None
+
+        print(f"🍪🍪 已从浏览器读取 {len(self.cookies)} 个cookie")
+        return len(self.cookies) > 0
+
+    def _cookie_header(self, url):
+        """按域名和路径挑出适用于该URL的cookie"""
+        parsed = urlparse(url)
+        host = parsed.hostname or ''
+        path = parsed.path or '/'
+        pairs = []
+        for cookie in self.cookies:
+            domain = (cookie.get('domain') or '').lstrip('.')
+            if domain and not (host == domain or host.endswith('.' + domain)):
+                continue
+            if not path.startswith(cookie.get('path') or '/'):
+                continue
+            if cookie.get('secure') and parsed.scheme != 'https':
+                continue
+            pairs.append(f"{cookie['name']}={cookie['value']}")
+        return '; '.join(pairs)
+
+    def _headers(self, url, referer=None):
+        headers = {'Cookie': self._cookie_header(url)}
+        if self.user_agent:
+            headers['User-Agent'] = self.user_agent
+        if referer:
+            headers['Referer'] = referer
+        return headers
+
+    def _get(self, url, referer=None):
+        """流式GET：响应体由调用方读取，用完后 release_conn"""
+        return self.http.request(
+            'GET', url,
+            headers=self._headers(url, referer),
+            preload_content=False,
+            timeout=urllib3.Timeout(connect=10, read=self.timeout),
+        )
+
+    def open_package(self, download_page_url):
+        """
+        打开 /downloadPage/ 页面（纯HTTP，不经过浏览器）。下载页本身就返回压缩包时直接使用这个响应，
+        不再请求第二次；否则从 no-invoice 打包按钮上解析出真正的压缩包地址再请求。
+
+        :return: (压缩包URL, 响应, 错误)；成功时调用方负责 release_conn，失败时前两项为 None
+        """
+        resp = self._get(download_page_url)
+        if resp.status != 200:
+            resp.release_conn()
+            return None, None, f"下载页 HTTP {resp.status}"
+        if is_archive_response(resp):
+            return download_page_url, resp, None
+        try:
+            html = resp.read().decode('utf-8', errors='ignore')
+        finally:
+            resp.release_conn()
+        package_url = parse_package_url(html, download_page_url)
+        if not package_url:
+            return None, None, '未能从下载页解析出打包下载地址'
+        return package_url, self._get(package_url, referer=download_page_url), None
+
+    def download(self, download_page_url, dest_dir, index):
+        """
+        下载单张发票的压缩包。
+
+        :return: dict，包含 index/success/path/bytes/elapsed/error
+        """
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        started = time.time()
+        record = {'index': index, 'success': False, 'path': None,
+                  'bytes': 0, 'elapsed': 0.0, 'error': None}
+        try:
+            package_url, resp, error = self.open_package(download_page_url)
+            if resp is None:
+                record['error'] = error
+                return record
+
+            part_path = None
+            try:
+                if resp.status != 200:
+                    record['error'] = f"HTTP {resp.status}"
+                    return record
+
+                filename = filename_from_response(resp, package_url, index)
+                with self._name_lock:
+                    target_path = unique_path(dest_dir, filename)
+                    # 先占位，防止其他线程拿到同一个文件名
+                    part_path = target_path + '.part'
+                    open(part_path, 'wb').close()
+
+                written = 0
+                with open(part_path, 'wb') as f:
+                    for chunk in resp.stream(self.chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+                os.replace(part_path, target_path)
+                part_path = None
+            finally:
+                resp.release_conn()
+                # 下载中断时删掉未完成的文件，否则重试时会占着文件名，生成 (1)、(2) 的新文件名
+                if part_path:
+                    try:
+                        os.remove(part_path)
+                    except OSError:
+                        pass
+
+            record.update(success=True, path=target_path, bytes=written)
+            METRICS.incr('bytes_downloaded', written)
+            return record
+        except Exception as e:
+            record['error'] = str(e)
+            return record
+        finally:
+            record['elapsed'] = time.time() - started
+            METRICS.observe('http_download', record['elapsed'], error=record['error'])
+            if self.rate_limiter:
+                if record['success']:
+                    self.rate_limiter.success(record['elapsed'])
+                else:
+                    self.rate_limiter.failure()
+
+    def download_many(self, jobs, dest_dir, on_complete=None):
+        """
+        并发下载多张发票。
+
+        :param jobs: [(index, download_page_url), ...]
+        :param dest_dir: 月份下载目录（YYYYMM）
+        :param on_complete: 可选回调，每张发票下载成功后立即以结果dict调用（在下载线程中执行）
+        :return: 与jobs顺序一致的结果列表
+        """
+        os.makedirs(dest_dir, exist_ok=True)
+        started = time.time()
+
+        def task(url, index):
+            record = self.download(url, dest_dir, index)
+            if record['success'] and on_complete is not None:
+                on_complete(record)
+            return record
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = [pool.submit(task, url, index) for index, url in jobs]
+            results = []
+            for future in futures:
+                record = future.result()
+                if record['success']:
+                    print(f"✅ 第 {record['index']} 张发票 - HTTP下载完成 "
+                          f"({record['bytes'] / 1024:.1f} KB, {record['elapsed']:.2f}s)")
+                else:
+                    print(f"❌❌❌❌ 第 {record['index']} 张发票 - HTTP下载失败: {record['error']}")
+                results.append(record)
+
+        elapsed = time.time() - started
+        ok = sum(1 for r in results if r['success'])
+        if results and elapsed > 0:
+            print(f"🚀🚀 HTTP下载 {ok}/{len(results)} 张，用时 {elapsed:.1f}s，"
+                  f"约 {ok * 60 / elapsed:.1f} 张/分钟")
+        return results
+
+
+# 打包按钮上可能携带地址的属性
+_URL_ATTRS = ('data-url', 'data-href', 'href', 'formaction', 'action')
+
+
+def parse_package_url(html, page_url):
+    """从下载页HTML里解析 no-invoice 按钮对应的压缩包地址"""
+    tag_match = re.search(r"<[^>]*\bid\s*=\s*['\"]no-invoice['\"][^>]*>", html, re.I)
+    if tag_match:
+        tag = tag_match.group(0)
+        for attr in _URL_ATTRS:
+            m = re.search(rf"\b{attr}\s*=\s*['\"]([^'\"]+)['\"]", tag, re.I)
+            if m and not m.group(1).lower().startswith('javascript'):
+                return urljoin(page_url, unescape(m.group(1)))
+        onclick = re.search(r"\bonclick\s*=\s*(['\"])(.*?)\1", tag, re.I | re.S)
+        if onclick:
+            url = _first_url_literal(unescape(onclick.group(2)))
+            if url:
+                return urljoin(page_url, url)
+
+    # 按钮通过脚本绑定事件时，在绑定 no-invoice 的脚本附近找地址
+    script_match = re.search(r"no-invoice.{0,800}", html, re.S)
+    if script_match:
+        url = _first_url_literal(script_match.group(0))
+        if url:
+            return urljoin(page_url, url)
+    return None
+
+
+def _first_url_literal(text):
+    """在一段JS里找第一个像下载地址的字符串常量"""
+    for m in re.finditer(r"['\"]((?:https?://|/)[^'\"\s]+)['\"]", text):
+        url = m.group(1)
+        if 'download' in url.lower() or url.lower().endswith('.zip'):
+            return url
+    return None
+
+
+def is_archive_response(resp):
+    """响应本身就是压缩包（而不是下载页HTML）"""
+    content_type = (resp.headers.get('Content-Type') or '').lower()
+    if 'zip' in content_type or 'octet-stream' in content_type:
+        return True
+    return 'attachment' in (resp.headers.get('Content-Disposition') or '').lower()
+
+
+def filename_from_response(resp, url, index):
+    """优先使用Content-Disposition里的文件名，和浏览器下载的文件名保持一致"""
+    disposition = resp.headers.get('Content-Disposition', '')
+    m = re.search(r"filename\*\s*=\s*[^']*''([^;]+)", disposition, re.I)
+    if m:
+        name = unquote(m.group(1).strip().strip('"'))
+    else:
+        m = re.search(r"filename\s*=\s*\"?([^\";]+)\"?", disposition, re.I)
+        if m:
+            name = m.group(1).strip()
+            try:
+                # 服务器常把UTF-8文件名直接塞进头里，http库按latin-1解码了
+                name = name.encode('latin-1').decode('utf-8')
+            except (UnicodeEncodeError, UnicodeDecodeError):
+                pass
+            name = unquote(name)
+        else:
+            name = os.path.basename(urlparse(url).path) or ''
+    name = re.sub(r'[\\/:*?"<>|]', '_', name).strip()
+    if not name:
+        name = f"invoice_{index}.zip"
+    if not name.lower().endswith('.zip'):
+        name += '.zip'
+    return name
@@ -0,0 +1,217 @@
+import os
+import csv
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+from metrics import METRICS
+from download_manifest import DownloadManifest
+
+RECORDS_FILENAME = '.invoice_records.db'
+
+# 每张发票一条记录的字段（CSV表头、JSON-lines 的键、records 表的列）
+RECORD_FIELDS = ('card', 'month', 'index', 'invoice_id', 'amount', 'status', 'success',
+                 'filename', 'path', 'bytes', 'duration', 'run_id', 'recorded')
+
+
+def build_records(year, month, month_path, invoice_details, card=None):
+    """
+    把统计文件里的发票明细转成结构化记录；发票标识和文件名从下载清单补全（已下载过的发票明细里没有文件名）。
+
+    :return: [dict(RECORD_FIELDS), ...]
+    """
+    by_index = {}
+    for key, entry in DownloadManifest(month_path).invoices.items():
+        if entry.get('index') is not None:
+            by_index[entry['index']] = (key, entry)
+
+    records = []
+    recorded = time.strftime('%Y-%m-%d %H:%M:%S')
+    for detail in invoice_details:
+        key, entry = by_index.get(detail['index'], (None, {}))
+        filename = detail.get('filename') or entry.get('file')
+        records.append({
+            'card': card or '',
+            'month': f"{year}{month:02d}",
+            'index': detail['index'],
+            'invoice_id': key,
+            'amount': round(detail['amount'], 2),
+            'status': detail['status'],
+            'success': detail['status'].startswith('成功'),
+            'filename': filename,
+            'path': os.path.join(month_path, filename) if filename else None,
+            'bytes': detail.get('bytes'),
+            'duration': round(detail['duration'], 3) if detail.get('duration') is not None else None,
+            'run_id': METRICS.run_id,
+            'recorded': recorded,
+        })
+    return records
+
+
+def write_month_records(month_path, year, month, records):
+    """
+    写出月份文件夹里的 YYYYMM_发票明细.csv（带BOM，Excel可以直接打开）和 YYYYMM_发票明细.jsonl。
+
+    :return: (csv_path, jsonl_path)
+    """
+    stem = os.path.join(month_path, f"{year}{month:02d}_发票明细")
+    with open(stem + '.csv', 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+    with open(stem + '.jsonl', 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return stem + '.csv', stem + '.jsonl'
+
+
+class RecordStore:
+    """
+    所有月份的发票记录（SQLite），放在下载根目录下。
+
+    每个 卡片×月份 处理完就整体替换该月的记录，重复运行不会重复累计；
+    汇总任意月份范围时直接查询这里，不需要重新扫描下载目录或解析统计文件。
+    多个下载任务可以同时写入（每次写入单独连接，SQLite 负责加锁）。
+    """
+
+    def __init__(self, root, filename=RECORDS_FILENAME):
+        self.root = os.path.abspath(root)
+        self.db_path = os.path.join(self.root, filename)
+        self.conn = sqlite3.connect(self.db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS records (
+                card TEXT NOT NULL,
+                month TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                invoice_id TEXT,
+                amount REAL,
+                status TEXT,
+                success INTEGER,
+                filename TEXT,
+                path TEXT,
+                bytes INTEGER,
+                duration REAL,
+                run_id TEXT,
+                recorded TEXT,
+                PRIMARY KEY (card, month, idx)
+            );
+            CREATE INDEX IF NOT EXISTS records_month ON records (month);
+        """)
+        self.conn.commit()
+
+    def replace_month(self, card, month, records):
+        """用本次的记录替换某个 卡片×月份 的全部记录"""
+        with self.conn:
+            self.conn.execute("DELETE FROM records WHERE card = ? AND month = ?", (card or '', month))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(r['card'], r['month'], r['index'], r['invoice_id'], r['amount'], r['status'], int(r['success']),
+                  r['filename'], r['path'], r['bytes'], r['duration'], r['run_id'], r['recorded'])
+                 for r in records]
+            )
+
+    def summary(self, start=None, end=None, card=None):
+        """
+        按 卡片×月份 汇总。
+
+        :param start: 起始月份 'YYYYMM'，None 表示不限
+        :param end: 结束月份 'YYYYMM'（包含），None 表示不限
+        :param card: 只汇总某张卡片（卡片文件夹名）；None 表示全部
+        :return: [dict(card, month, count, downloaded, amount, downloaded_amount, bytes), ...]
+        """
+        conditions = []
+        params = []
+        if start:
+            conditions.append("month >= ?")
+            params.append(start)
+        if end:
+            conditions.append("month <= ?")
+            params.append(end)
+        if card is not None:
+            conditions.append("card = ?")
+            params.append(card)
+        sql = """
+            SELECT card, month, COUNT(*), SUM(success), ROUND(SUM(amount), 2),
+                   ROUND(SUM(CASE WHEN success THEN amount ELSE 0 END), 2), COALESCE(SUM(bytes), 0)
+            FROM records
+        """
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " GROUP BY card, month ORDER BY card, month"
+        keys = ('card', 'month', 'count', 'downloaded', 'amount', 'downloaded_amount', 'bytes')
+        return [dict(zip(keys, row)) for row in self.conn.execute(sql, params)]
+
+    def close(self):
+        self.conn.close()
+
+
+def record_month(root, year, month, month_path, invoice_details, card=None):
+    """
+    月份处理结束时调用：写出该月的CSV和JSON-lines明细，并更新下载根目录下的累计记录。
+
+    :param root: 下载根目录
+    :param card: 卡片名称（按卡片分文件夹时），None 表示默认卡片
+    """
+    try:
+        card_folder = os.path.basename(os.path.dirname(os.path.normpath(month_path))) if card else ''
+        records = build_records(year, month, month_path, invoice_details, card_folder)
+        csv_path, _ = write_month_records(month_path, year, month, records)
+        store = RecordStore(root)
+        try:
+            store.replace_month(card_folder, f"{year}{month:02d}", records)
+        finally:
+            store.close()
+        print(f"📄📄 发票明细已生成: {csv_path}（.jsonl 同名）")
+        return records
+    except Exception as e:
+        print(f"❌❌ 发票明细写入失败: {e}")
+        return []
+
+
+def print_summary(rows, elapsed=None):
+    """打印汇总表格和合计"""
+    print(f"   {'卡片':<10}{'月份':<8}{'发票':>6}{'已下载':>8}{'开票金额':>14}{'已下载金额':>14}")
+    for r in rows:
+        print(f"   {r['card'] or '-':<10}{r['month']:<8}{r['count']:>8}{r['downloaded']:>8}"
+              f"{r['amount']:>16.2f}{r['downloaded_amount']:>16.2f}")
+    count = sum(r['count'] for r in rows)
+    downloaded = sum(r['downloaded'] for r in rows)
+    amount = sum(r['amount'] for r in rows)
+    downloaded_amount = sum(r['downloaded_amount'] for r in rows)
+    took = f"，查询用时 {elapsed * 1000:.1f} ms" if elapsed is not None else ""
+    print(f"📊📊 合计: {len(rows)} 个月份，发票 {count} 张，已下载 {downloaded} 张，"
+          f"开票金额 ￥{amount:.2f}，已下载金额 ￥{downloaded_amount:.2f}{took}")
+
+
+def summarize(root, start=None, end=None, card=None):
+    """汇总任意月份范围（查询累计记录，不扫描下载目录）"""
+    if not os.path.exists(os.path.join(root, RECORDS_FILENAME)):
+        print(f"❌❌ 没有发票记录: {os.path.join(root, RECORDS_FILENAME)}（下载过的月份才会有记录）")
+        return []
+    store = RecordStore(root)
+    try:
+        started = time.perf_counter()
+        rows = store.summary(start, end, card)
+        print_summary(rows, time.perf_counter() - started)
+    finally:
+        store.close()
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="汇总已下载发票的累计记录，例如: python invoice_records.py 202401 202412")
+    parser.add_argument('start', nargs='?', help="起始月份 YYYYMM，不填表示全部")
+    parser.add_argument('end', nargs='?', help="结束月份 YYYYMM（包含），不填则与起始月份相同")
+    parser.add_argument('--root', default='invoice_downloads', help="下载目录")
+    parser.add_argument('--card', default=None, help="只汇总某张卡片（卡片文件夹名）")
+    args = parser.parse_args(argv)
+    summarize(args.root, args.start, args.end or args.start, args.card)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
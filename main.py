@@ -1,30 +1,108 @@
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.common.keys import Keys
 import time
 import os
 import sys
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import my_zip
+import pdf_index
+import reconcile
+from http_download import HttpInvoiceDownloader
+from download_tracker import DownloadTracker
+from selector_cache import SelectorCache
+from parallel_months import MonthWorkerPool
+from chrome_pool import ChromePool, DEFAULT_PROFILE
+from blob_store import BlobStore
+from result_pages import ResultPageWalker
+from async_core import AsyncOrchestrator
+from rate_limit import AdaptiveRateLimiter, RetryQueue
+from extract_pipeline import ExtractionPipeline
+from metrics import METRICS
+from download_manifest import (DownloadManifest, invoice_key,
+                               STATE_DOWNLOADING, STATE_DONE, STATE_FAILED)
+from month_files import month_folder_path, write_amount_report, complete_month, skip_month
+from page_scripts import (DEFAULT_CARD, LIST_CARDS_JS, INVOICE_TABLE_SELECTORS, SCRAPE_INVOICE_ROWS_JS,
+                          PAGE_SIGNATURE_JS, SET_MONTH_JS, SEARCH_BUTTON_JS, parse_amount)
+from sync_state import sync_probe, month_unchanged
+from month_input import parse_month_input, get_month_range, split_month_list
+
+# selenium 导入要约0.3秒，解压、搜索、汇总和异步核心都用不到：连接浏览器时才由 load_selenium 导入
+webdriver = Options = By = WebDriverWait = EC = ActionChains = Keys = None
+
+def load_selenium():
+    """导入 selenium，作为本模块的全局名称供 InvoiceDownloader 使用"""
+    global webdriver, Options, By, WebDriverWait, EC, ActionChains, Keys
+    if webdriver is not None:
+        return
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.common.action_chains import ActionChains
+    from selenium.webdriver.common.keys import Keys
+
+# 发票卡片列表页
+DEFAULT_TARGET_URL = "https://pss.txffp.com/pss/app/login/invoice/query/card/PERSONAL"
 
 class InvoiceDownloader:
-    def __init__(self, debug_port=9222, download_path=None):
-        self.chrome_options = Options()
-        self.chrome_options.add_experimental_option("debuggerAddress", f"127.0.0.1:{debug_port}")
+    def __init__(self, debug_port=9222, download_path=None, download_mode="browser", http_concurrency=4, shared_browser=False):
+        self.debug_port = debug_port
         
         # 存储基础下载路径，实际下载路径会根据月份动态创建
         self.base_download_path = download_path
         
-        # 初始化时不设置具体下载路径，将在处理每个月份时动态设置
-        prefs = {
-            "download.prompt_for_download": False,
-            "download.directory_upgrade": True,
-            "safebrowsing.enabled": True
-        }
-        self.chrome_options.add_experimental_option("prefs", prefs)
+        # 与其他下载任务共用同一个Chrome（并行标签页）时，浏览器的下载目录是全局的，
+        # 只能用HTTP直连下载，并且不能再修改浏览器的下载目录
+        self.shared_browser = shared_browser
+        if shared_browser:
+            download_mode = "http"
+        
+        # 下载方式: "browser" 为浏览器点击下载，"http" 为复用登录会话直接HTTP下载
+        self.download_mode = download_mode
+        self.http_concurrency = http_concurrency
+        self.http_downloader = None
+        
+        # CDP下载事件监听，连接成功后用下载完成事件代替固定等待
+        self.download_tracker = None
+        self.last_download_record = None
+        
+        # 下载完成的压缩包交给后台解压流水线（为None时在全部下载结束后统一解压）
+        self.extract_pipeline = None
+        
+        # 去重存储：下载的压缩包放进下载根目录的 .blobs，其他月份/卡片下载过的发票直接链接过来
+        self.blob_store = BlobStore(download_path) if download_path else None
+        
+        # 为True时 batch_download* 交给异步核心（直接通过CDP并发列出、下载、解压），不再使用WebDriver
+        self.async_core = False
+        self.month_concurrency = 2
+        self.extract_workers = None
+        
+        # 窗口管理：主窗口（发票列表）、下载专用标签页、临时弹出的标签页
+        self.main_window = None
+        self.download_window = None
+        self._current_window = None
+        self._popup_windows = set()
+        self.invoice_latencies = []  # 当前月份每张发票的下载用时
+        
+        # 自适应限速代替固定等待：网站响应快时逐步提速，超时或出错时指数退避
+        self.rate_limiter = AdaptiveRateLimiter()
+        # 每张发票最多下载的次数，失败的发票在月份结束前统一重试
+        self.max_attempts = 3
+        self.last_download_error = None
+        
+        # 本次运行已处理月份的汇总（并行下载时用于合并结果）
+        self.month_summaries = []
+        
+        # 多卡片下载时当前处理的卡片，设置后月份文件夹放在 <下载目录>/<卡片>/ 下
+        self.card_name = None
+        
+        # 同步模式：结果页与上次同步完成时一致的月份整体跳过，只下载新增的发票
+        self.sync_mode = False
+        self.sync_probe = None
+        
+        # 记住每个步骤上次成功的选择器，优先用短超时尝试
+        cache_dir = download_path or os.getcwd()
+        self.selectors = SelectorCache(os.path.join(cache_dir, ".selector_cache.json"))
         
         self.driver = None
         self.wait = None
@@ -33,9 +111,8 @@ class InvoiceDownloader:
     def set_download_path_for_month(self, year, month):
         """为特定月份设置下载路径"""
         if self.base_download_path:
-            # 创建月份格式的文件夹名称 (YYYYMM)
-            month_folder = f"{year}{month:02d}"
-            month_download_path = os.path.join(self.base_download_path, month_folder)
+            # 月份文件夹 (YYYYMM)，多卡片下载时放在卡片文件夹下
+            month_download_path = month_folder_path(self.base_download_path, year, month, self.card_name)
             
             # 创建文件夹（如果不存在）
             os.makedirs(month_download_path, exist_ok=True)
@@ -48,7 +125,19 @@ class InvoiceDownloader:
                 "safebrowsing.enabled": True
             }
             
+            if self.shared_browser:
+                return month_download_path
+            
             # 由于Chrome选项在启动后不能直接修改，我们需要通过CDP命令来更新下载路径
+            if self.download_tracker and self.download_tracker.connected:
+                try:
+                    # 在监听事件的同一个CDP连接上设置下载目录，才能收到下载进度事件
+                    self.download_tracker.set_download_path(month_download_path)
+                    print(f"📁📁📁📁 下载路径已设置为: {month_download_path}")
+                    return month_download_path
+                except Exception as e:
+                    print(f"⚠️ 下载事件监听设置失败，改用页面级下载设置: {e}")
+            
             if self.driver:
                 try:
                     self.driver.execute_cdp_cmd('Page.setDownloadBehavior', {
@@ -63,20 +152,46 @@ class InvoiceDownloader:
         
         return None
 
+    @METRICS.timed()
+    def chrome_options(self):
+        """连接调试Chrome的选项；初始化时不设置具体下载路径，将在处理每个月份时动态设置"""
+        options = Options()
+        options.add_experimental_option("debuggerAddress", f"127.0.0.1:{self.debug_port}")
+        prefs = {
+            "download.prompt_for_download": False,
+            "download.directory_upgrade": True,
+            "safebrowsing.enabled": True
+        }
+        options.add_experimental_option("prefs", prefs)
+        return options
+    
     def connect_browser(self):
         try:
-            self.driver = webdriver.Chrome(options=self.chrome_options)
+            # 异步核心只用CDP，不会走到这里，也就不用导入 selenium
+            load_selenium()
+            self.driver = webdriver.Chrome(options=self.chrome_options())
             self.wait = WebDriverWait(self.driver, 20)
             self.actions = ActionChains(self.driver)
+            self.main_window = self.driver.current_window_handle
+            self._current_window = self.main_window
             print("✅ 浏览器连接成功")
+            
+            if not self.shared_browser:
+                tracker = DownloadTracker(self.debug_port)
+                if tracker.connect():
+                    self.download_tracker = tracker
             return True
         except Exception as e:
             print(f"❌❌ 浏览器连接失败: {e}")
             return False
     
+    @METRICS.timed()
     def navigate_to_page(self, url):
         try:
+            self.rate_limiter.acquire()
             print(f"🌐🌐 正在导航到: {url}")
+            if self.main_window:
+                self.switch_window(self.main_window)
             self.driver.get(url)
             self.wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
             print("✅ 页面加载成功")
@@ -85,55 +200,51 @@ class InvoiceDownloader:
             print(f"❌❌ 页面导航失败: {e}")
             return False
     
-    def click_etc_card(self):
+    @METRICS.timed()
+    def click_etc_card(self, card_name=DEFAULT_CARD):
         try:
-            # 使用更精确的选择器
-            card_xpath = "//a[contains(@href, '广西ETC') or .//dt[contains(text(), '广西ETC')] or contains(text(), '广西ETC')]"
-            card_element = self.wait.until(
-                EC.element_to_be_clickable((By.XPATH, card_xpath))
+            name = xpath_literal(card_name)
+            # 名称完全一致的卡片优先，避免 “广西ETC” 点到 “广西ETC2”
+            exact = self.driver.find_elements(
+                By.XPATH, f"//a[.//dt[normalize-space(.)={name}] or normalize-space(.)={name}]"
             )
+            if exact:
+                card_element = exact[0]
+            else:
+                # 使用更精确的选择器
+                card_xpath = f"//a[contains(@href, {name}) or .//dt[contains(text(), {name})] or contains(text(), {name})]"
+                card_element = self.wait.until(
+                    EC.element_to_be_clickable((By.XPATH, card_xpath))
+                )
             card_element.click()
-            print("✅ 已点击广西ETC卡片")
+            print(f"✅ 已点击{card_name}卡片")
             time.sleep(3)
             return True
         except Exception as e:
-            print(f"❌❌ 点击ETC卡失败: {e}")
+            print(f"❌❌ 点击{card_name}卡片失败: {e}")
             return False
     
+    def list_cards(self, timeout=10):
+        """读取卡片列表页上的全部卡片名称（需要已经打开卡片列表页）"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                cards = self.driver.execute_script(LIST_CARDS_JS) or []
+            except Exception as e:
+                print(f"⚠️ 读取卡片列表失败: {e}")
+                cards = []
+            if cards or time.time() >= deadline:
+                return cards
+            time.sleep(0.3)
+    
    
     
+    @METRICS.timed()
     def set_date_js_calendar(self, year, month):
         """使用JavaScript直接调用WdatePicker"""
         try:
-            # 构建目标日期字符串
-            target_date = f"{year}-{month:02d}"
-            
-            # 直接调用WdatePicker的setDate方法
-            js_code = f"""
-            // 创建日期对象
-            var targetDate = new Date({year}, {month-1}, 1);
-            
-            // 查找WdatePicker输入框
-            var monthInput = document.getElementById('month');
-            if (monthInput) {{
-                // 设置值
-                monthInput.value = '{year}{month:02d}';
-                
-                // 触发所有必要的事件
-                var events = ['input', 'change', 'blur'];
-                events.forEach(function(eventType) {{
-                    var event = new Event(eventType, {{ bubbles: true }});
-                    monthInput.dispatchEvent(event);
-                }});
-                
-                // 调用可能的回调函数
-                if (window.WdatePicker && window.WdatePicker.onpicked) {{
-                    window.WdatePicker.onpicked.call(monthInput);
-                }}
-            }}
-            """
-            
-            self.driver.execute_script(js_code)
+            # 直接给WdatePicker输入框赋值并触发事件
+            self.driver.execute_script(SET_MONTH_JS, f"{year}{month:02d}")
             print(f"✅ 已通过JS设置日期: {year}年{month}月")
             time.sleep(2)
             return True
@@ -155,6 +266,7 @@ class InvoiceDownloader:
         print("❌❌ 所有日期设置方法都失败了")
         return False
     
+    @METRICS.timed()
     def search_invoices(self):
         try:
             # 尝试多种搜索按钮定位方式
@@ -166,34 +278,25 @@ class InvoiceDownloader:
                 "input[value*='搜索']",  # 包含搜索文本
             ]
             
-            for selector in search_selectors:
+            search_button = self.selectors.find(
+                self.driver, "search_button", [(By.CSS_SELECTOR, selector) for selector in search_selectors]
+            )
+            old_page = self.driver.find_element(By.TAG_NAME, "html")
+            old_signature = self.page_signature()
+            if search_button:
                 try:
-                    search_button = self.wait.until(
-                        EC.element_to_be_clickable((By.CSS_SELECTOR, selector))
-                    )
                     search_button.click()
                     print("🔍🔍 正在搜索发票...")
-                    time.sleep(5)
+                    self.wait_for_search_results(old_page, old_signature)
                     return True
-                except:
-                    continue
+                except Exception as e:
+                    print(f"⚠️ 点击搜索按钮失败，尝试JS点击: {e}")
             
             # 如果以上都失败，尝试通过JavaScript点击
-            js_code = """
-            var searchBtn = document.getElementById('titSeach') || 
-                          document.getElementById('seach') ||
-                          document.querySelector('.taiji_search_submit');
-            if (searchBtn) {
-                searchBtn.click();
-                return true;
-            }
-            return false;
-            """
-            
-            result = self.driver.execute_script(js_code)
+            result = self.driver.execute_script(SEARCH_BUTTON_JS)
             if result:
                 print("🔍🔍 已通过JS点击搜索按钮")
-                time.sleep(5)
+                self.wait_for_search_results(old_page, old_signature)
                 return True
             else:
                 print("❌❌ 未找到可点击的搜索按钮")
@@ -203,27 +306,30 @@ class InvoiceDownloader:
             print(f"❌❌ 搜索失败: {e}")
             return False
     
+    def wait_for_search_results(self, old_page, old_signature, timeout=5):
+        """点击搜索后等到页面跳转或结果变化为止（最多 timeout 秒），而不是固定等待5秒"""
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=0.2).until(
+                lambda d: EC.staleness_of(old_page)(d) or self.page_signature() != old_signature
+            )
+        except Exception:
+            pass
+    
+    @METRICS.timed()
     def get_invoice_tables(self):
         try:
             # 等待发票表格加载
             time.sleep(3)
             
             # 多种选择器尝试
-            table_selectors = [
-                "table.table_wdfp",
-                "table.table",
-                ".table_wdfp",
-                "table"
-            ]
+            table_selectors = INVOICE_TABLE_SELECTORS
             
-            for selector in table_selectors:
-                try:
-                    invoice_tables = self.driver.find_elements(By.CSS_SELECTOR, selector)
-                    if invoice_tables:
-                        print(f"📋📋 找到 {len(invoice_tables)} 个发票条目")
-                        return invoice_tables
-                except:
-                    continue
+            invoice_tables = self.selectors.find_all(
+                self.driver, "invoice_table", [(By.CSS_SELECTOR, selector) for selector in table_selectors]
+            )
+            if invoice_tables:
+                print(f"📋📋 找到 {len(invoice_tables)} 个发票条目")
+                return invoice_tables
             
             print("❌❌ 未找到发票表格")
             return []
@@ -232,144 +338,289 @@ class InvoiceDownloader:
             print(f"❌❌ 获取发票表格失败: {e}")
             return []
 
-    def generate_amount_report(self, year, month, download_path, total_amount, invoice_details, success_count, total_count):
+    @METRICS.timed()
+    def generate_amount_report(self, year, month, download_path, total_amount, invoice_details, success_count, total_count,
+                               page_summary=None, pacing=None):
         """生成金额统计文件"""
+        return write_amount_report(year, month, download_path, total_amount, invoice_details, success_count,
+                                   total_count, page_summary, pacing)
+    
+    def extract_invoice_amount(self, table_element, index):
+        """从发票条目中提取开票金额"""
+        amount = 0.0
         try:
-            # 创建统计文件名
-            report_filename = f"{year}{month:02d}_发票统计.txt"
-            report_filepath = os.path.join(download_path, report_filename)
-            
-            with open(report_filepath, 'w', encoding='utf-8') as f:
-                f.write(f"发票统计报告 - {year}年{month:02d}月\n")
-                f.write("=" * 50 + "\n")
-                f.write(f"统计时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write(f"发票总数: {total_count} 张\n")
-                f.write(f"下载成功: {success_count} 张\n")
-                f.write(f"下载失败: {total_count - success_count} 张\n")
-                f.write(f"开票总金额: ￥{total_amount:.2f}\n")
-                f.write("\n" + "=" * 50 + "\n")
-                f.write("发票明细:\n")
-                f.write("-" * 50 + "\n")
-                
-                for detail in invoice_details:
-                    f.write(f"第{detail['index']}张发票: ￥{detail['amount']:.2f} - {detail['status']}\n")
-            
-            print(f"📄📄📄📄 金额统计文件已生成: {report_filepath}")
-            return True
+            # 多种方式查找金额元素
+            amount_selectors = [
+                ".//th[contains(., '开票金额')]//span",
+                ".//span[contains(@class, 'inv_deta_list_divc01')]",
+                ".//span[contains(text(), '￥')]",
+                ".//th[contains(., '金额')]//span"
+            ]
             
+            amount_element = self.selectors.find_in(
+                table_element, "amount", [(By.XPATH, selector) for selector in amount_selectors],
+                accept=lambda el: '￥' in el.text
+            )
+            if amount_element:
+                amount_text = amount_element.text.strip()
+                amount = parse_amount(amount_text)
+                print(f"💰💰 第 {index} 张发票 - 开票金额: {amount_text}")
         except Exception as e:
-            print(f"❌❌❌❌ 生成金额统计文件失败: {e}")
-            return False
+            print(f"⚠️ 第 {index} 张发票 - 金额提取失败: {e}")
+            amount = 0.0
+        return amount
+    
+    def find_download_link(self, table_element):
+        """在发票条目中查找下载链接，找不到返回None"""
+        # 多种方式查找下载链接
+        link_selectors = [
+            ".//a[contains(@href, '/downloadPage/')]",
+            ".//a[contains(text(), '下载')]",
+            ".//a[contains(@onclick, 'download')]",
+            ".//button[contains(text(), '下载')]"
+        ]
+        
+        return self.selectors.find_in(
+            table_element, "download_link", [(By.XPATH, selector) for selector in link_selectors]
+        )
+    
+    @METRICS.timed()
+    def scrape_invoice_rows(self, timeout=10):
+        """
+        一次 execute_script 读取整页发票条目的快照。
+
+        :return: [{'index', 'amount', 'amount_text', 'href', 'invoice_id'}, ...]
+        """
+        table_candidates = [(By.CSS_SELECTOR, selector) for selector in INVOICE_TABLE_SELECTORS]
+        ordered = [value for _, value in self.selectors.ordered("invoice_table", table_candidates)]
+        deadline = time.time() + timeout
+        rows = []
+        matched = None
+        while True:
+            try:
+                result = self.driver.execute_script(SCRAPE_INVOICE_ROWS_JS, ordered) or {}
+                rows = result.get('rows') or []
+                matched = result.get('selector')
+            except Exception as e:
+                print(f"⚠️ JS读取发票列表失败: {e}")
+                rows = []
+            # 表格是异步渲染的，没读到就短暂轮询，而不是固定等待
+            if rows or time.time() >= deadline:
+                break
+            time.sleep(0.3)
+        
+        self.selectors.record("invoice_table", (By.CSS_SELECTOR, matched) if matched else None)
+        for row in rows:
+            row['amount'] = parse_amount(row.get('amount_text'))
+        
+        if rows:
+            print(f"📋📋 找到 {len(rows)} 个发票条目")
+        else:
+            print("❌❌ 未找到发票表格")
+        return rows
+    
+    def page_signature(self):
+        """当前结果页的指纹，用来判断页面是否变化（变化时才需要重新读取快照）"""
+        try:
+            return self.driver.execute_script(PAGE_SIGNATURE_JS)
+        except Exception:
+            return None
+    
+    @METRICS.timed()
+    def download_invoice_row(self, row):
+        """按快照中的一行下载发票，不再访问表格里的WebElement"""
+        self.last_download_record = None
+        self.last_download_error = None
+        index = row['index']
+        amount = row['amount']
+        print(f"\n⬇⬇⬇⬇️ 开始处理第 {index} 张发票")
+        if amount > 0:
+            print(f"💰💰 第 {index} 张发票 - 开票金额: {row['amount_text']}")
+        
+        if row.get('href'):
+            return self._download_in_tab(index, amount, href=row['href'])
+        
+        # 下载链接不是普通href（例如onclick触发），只能退回到实时元素点击（按在当前页中的位置）
+        position = row.get('page_index', index)
+        current_tables = self.get_invoice_tables()
+        if position - 1 < len(current_tables):
+            success, _ = self.download_single_invoice(current_tables[position - 1], index)
+            return success, amount
+        print(f"❌❌❌❌ 第 {index} 张发票 - 未找到下载链接")
+        self.last_download_error = '未找到下载链接'
+        return False, amount
     
+    @METRICS.timed()
     def download_single_invoice(self, table_element, index):
+        self.last_download_record = None
+        self.last_download_error = None
+        print(f"\n⬇⬇⬇⬇️ 开始处理第 {index} 张发票")
         try:
-            print(f"\n⬇⬇⬇⬇️ 开始处理第 {index} 张发票")
-            
             # 提取开票金额
-            amount = 0.0
-            try:
-                # 多种方式查找金额元素
-                amount_selectors = [
-                    ".//th[contains(., '开票金额')]//span",
-                    ".//span[contains(@class, 'inv_deta_list_divc01')]",
-                    ".//span[contains(text(), '￥')]",
-                    ".//th[contains(., '金额')]//span"
-                ]
-                
-                for selector in amount_selectors:
-                    try:
-                        amount_element = table_element.find_element(By.XPATH, selector)
-                        amount_text = amount_element.text.strip()
-                        if '￥' in amount_text:
-                            amount_str = amount_text.replace('￥', '').strip()
-                            amount = float(amount_str)
-                            print(f"💰💰 第 {index} 张发票 - 开票金额: {amount_text}")
-                            break
-                    except:
-                        continue
-            except Exception as e:
-                print(f"⚠️ 第 {index} 张发票 - 金额提取失败: {e}")
-                amount = 0.0
-            
-            # 多种方式查找下载链接
-            link_selectors = [
-                ".//a[contains(@href, '/downloadPage/')]",
-                ".//a[contains(text(), '下载')]",
-                ".//a[contains(@onclick, 'download')]",
-                ".//button[contains(text(), '下载')]"
-            ]
+            amount = self.extract_invoice_amount(table_element, index)
             
-            download_link = None
-            for selector in link_selectors:
-                try:
-                    download_link = table_element.find_element(By.XPATH, selector)
-                    break
-                except:
-                    continue
+            download_link = self.find_download_link(table_element)
             
             if not download_link:
                 print(f"❌❌❌❌ 第 {index} 张发票 - 未找到下载链接")
+                self.last_download_error = '未找到下载链接'
                 return False, amount
+        except Exception as e:
+            print(f"❌❌❌❌ 第 {index} 张发票下载失败: {e}")
+            self.last_download_error = str(e)
+            return False, 0.0
+        
+        return self._download_in_tab(index, amount, link=download_link)
+    
+    def _ensure_download_tab(self):
+        """下载专用标签页：每个会话只创建一次，之后每张发票都在这个标签页里打开"""
+        if self.download_window is None:
+            self.driver.switch_to.new_window('tab')
+            self.download_window = self.driver.current_window_handle
+            self._current_window = self.download_window
+        return self.download_window
+    
+    def switch_window(self, handle):
+        """集中管理窗口切换，已经在目标窗口时不再发送切换命令"""
+        if self._current_window != handle:
+            self.driver.switch_to.window(handle)
+            self._current_window = handle
+    
+    def restore_main_window(self):
+        """出错后关闭本会话临时打开的窗口并回到主窗口"""
+        try:
+            handles = self.driver.window_handles
+            for handle in list(self._popup_windows):
+                if handle in handles:
+                    self.driver.switch_to.window(handle)
+                    self.driver.close()
+                self._popup_windows.discard(handle)
+            if self.download_window not in handles:
+                self.download_window = None
+            target = self.main_window if self.main_window in handles else handles[0]
+            self.driver.switch_to.window(target)
+            self._current_window = target
+        except Exception:
+            self._current_window = None
+    
+    def _download_in_tab(self, index, amount, link=None, href=None):
+        """在下载专用标签页打开下载页并点击打包按钮；link为页面元素，href为快照里的地址"""
+        started = time.time()
+        try:
+            if href is None and link is not None:
+                href = link.get_attribute('href')
+                if href and href.strip().lower().startswith('javascript'):
+                    href = None
+            if href is None:
+                # 只能通过点击触发的链接，仍然走弹出新标签页的方式
+                return self._download_via_popup(index, amount, link), amount
             
-            main_window = self.driver.current_window_handle
-            
-            # 在新标签页中打开下载链接
-            self.driver.execute_script("arguments[0].target='_blank';", download_link)
-            download_link.click()
-            
-            print(f"🖱🖱🖱🖱🖱🖱🖱🖱🖱️ 第 {index} 张发票 - 已点击下载链接")
-            time.sleep(2)
-            
-            # 切换到新标签页
-            all_windows = self.driver.window_handles
-            new_window = [w for w in all_windows if w != main_window]
+            self._ensure_download_tab()
+            self.switch_window(self.download_window)
+            self.driver.get(href)
+            print(f"✅ 第 {index} 张发票 - 已在下载标签页打开下载页面")
             
-            if new_window:
-                self.driver.switch_to.window(new_window[0])
-                print(f"✅ 第 {index} 张发票 - 已切换到下载页面")
-                
-                # 尝试找到打包下载按钮
-                download_buttons = [
-                    ("ID", "no-invoice"),
-                    ("CSS", "input[value*='打包']"),
-                    ("CSS", "button[contains(text(), '打包')]"),
-                    ("CSS", "input[type='button']"),
-                    ("CSS", "button")
-                ]
-                
-                for selector_type, selector_value in download_buttons:
-                    try:
-                        if selector_type == "ID":
-                            download_btn = self.driver.find_element(By.ID, selector_value)
-                        else:
-                            download_btn = self.driver.find_element(By.CSS_SELECTOR, selector_value)
-                        
-                        download_btn.click()
-                        print(f"📦📦📦📦 第 {index} 张发票 - 已点击下载按钮")
-                        break
-                    except:
-                        continue
-                
-                time.sleep(2)
-                
-                # 关闭当前标签页并返回主窗口
-                self.driver.close()
-                self.driver.switch_to.window(main_window)
-                print(f"✅ 第 {index} 张发票下载完成")
-                return True, amount
-            else:
-                print(f"❌❌❌❌ 第 {index} 张发票 - 未打开新标签页")
-                return False, amount
+            with METRICS.span("download_click"):
+                success = self._click_pack_and_wait(index)
+            self.switch_window(self.main_window)
+            return success, amount
                 
         except Exception as e:
             print(f"❌❌❌❌ 第 {index} 张发票下载失败: {e}")
+            self.last_download_error = str(e)
             # 确保返回主窗口
+            self.restore_main_window()
+            return False, amount
+        finally:
+            self.invoice_latencies.append(time.time() - started)
+    
+    def _download_via_popup(self, index, amount, link):
+        """点击链接弹出新标签页下载，完成后关闭该标签页"""
+        windows_before = set(self.driver.window_handles)
+        
+        # 在新标签页中打开下载链接
+        self.driver.execute_script("arguments[0].target='_blank';", link)
+        link.click()
+        
+        print(f"🖱🖱🖱🖱🖱🖱🖱🖱🖱️ 第 {index} 张发票 - 已点击下载链接")
+        try:
+            WebDriverWait(self.driver, 10).until(lambda d: len(d.window_handles) > len(windows_before))
+        except Exception:
+            pass
+        
+        # 切换到新标签页
+        new_window = [w for w in self.driver.window_handles if w not in windows_before]
+        if not new_window:
+            print(f"❌❌❌❌ 第 {index} 张发票 - 未打开新标签页")
+            self.last_download_error = '未打开新标签页'
+            return False
+        
+        self._popup_windows.add(new_window[0])
+        self.switch_window(new_window[0])
+        print(f"✅ 第 {index} 张发票 - 已切换到下载页面")
+        try:
+            WebDriverWait(self.driver, 10).until(
+                lambda d: d.execute_script("return document.readyState") == "complete"
+            )
+        except Exception:
+            pass
+        
+        success = self._click_pack_and_wait(index)
+        
+        # 关闭当前标签页并返回主窗口
+        self.driver.close()
+        self._popup_windows.discard(new_window[0])
+        self._current_window = None
+        self.switch_window(self.main_window)
+        return success
+    
+    def _click_pack_and_wait(self, index):
+        """在当前下载页点击打包按钮，并等待下载完成（无下载事件时固定等待）"""
+        tracker = self.download_tracker if self.download_tracker and self.download_tracker.connected else None
+        marker = tracker.mark() if tracker else None
+        
+        # 尝试找到打包下载按钮
+        download_buttons = [
+            (By.ID, "no-invoice"),
+            (By.CSS_SELECTOR, "input[value*='打包']"),
+            (By.XPATH, "//button[contains(text(), '打包')]"),
+            (By.CSS_SELECTOR, "input[type='button']"),
+            (By.CSS_SELECTOR, "button")
+        ]
+        
+        download_btn = self.selectors.find(self.driver, "pack_button", download_buttons, timeout=5)
+        if download_btn:
             try:
-                self.driver.switch_to.window(self.driver.window_handles[0])
-            except:
-                pass
-            return False, 0.0
+                download_btn.click()
+                print(f"📦📦📦📦 第 {index} 张发票 - 已点击下载按钮")
+            except Exception as e:
+                print(f"⚠️ 第 {index} 张发票 - 点击打包按钮失败: {e}")
+        elif tracker:
+            # 下载页上没有打包按钮，通常是网站返回了出错或繁忙页面
+            self.last_download_error = '下载页没有打包按钮'
+            print(f"❌❌❌❌ 第 {index} 张发票 - 下载页没有打包按钮")
+            return False
+        
+        if not tracker:
+            time.sleep(2)
+            print(f"✅ 第 {index} 张发票下载完成")
+            return True
+        
+        # 等待这次点击触发的下载真正完成，而不是固定等待
+        record = tracker.wait_for_next(marker)
+        if not record or record['state'] != 'completed':
+            METRICS.incr('download_timeouts' if not record else 'downloads_interrupted')
+            state = record['state'] if record else '超时'
+            print(f"❌❌❌❌ 第 {index} 张发票 - 下载未完成 ({state})")
+            self.last_download_error = f"下载未完成 ({state})"
+            return False
+        self.last_download_record = record
+        METRICS.incr('bytes_downloaded', record['bytes'])
+        print(f"✅ 第 {index} 张发票下载完成: {record['filename']} "
+              f"({record['bytes'] / 1024:.1f} KB, {record['duration']:.2f}s)")
+        return True
 
+    @METRICS.timed()
     def process_single_month(self, year, month):
         """处理单个月份的发票下载"""
         print(f"\n{'='*60}")
@@ -378,6 +629,7 @@ class InvoiceDownloader:
         
         # 首先设置该月份的下载路径
         month_download_path = self.set_download_path_for_month(year, month)
+        self.invoice_latencies = []
         
         # 设置日期
         if not self.set_date(year, month):
@@ -387,48 +639,338 @@ class InvoiceDownloader:
             print(f"❌❌❌❌ {year}年{month:02d}月 - 搜索失败")
             return False
         
-        invoice_tables = self.get_invoice_tables()
-        if not invoice_tables:
-            print(f"❌❌❌❌ {year}年{month:02d}月 - 未找到可下载的发票")
-            return False
+        # 发票多的月份结果是分页的：先把每页条数调到最大，再逐页读取快照
+        pages = ResultPageWalker(self)
+        pages.maximize_page_size()
+        
+        # 第一页的轻量快照，月份结束时作为水位保存；同步模式下与上次水位一致就不再翻页和下载
+        self.sync_probe = sync_probe(self.scrape_invoice_rows(), pages.page_info())
+        if self.sync_mode:
+            watermark = month_unchanged(month_download_path, self.sync_probe)
+            if watermark:
+                return self.skip_synced_month(year, month, month_download_path, watermark)
         
-        print(f"🎯🎯🎯🎯 {year}年{month:02d}月 - 开始批量下载，共 {len(invoice_tables)} 张发票")
+        # 下载清单：重新运行时跳过已完成的发票，并合并重复下载的文件
+        manifest = DownloadManifest(month_download_path, self.blob_store)
+        manifest.collapse_duplicates()
+        # 下载失败的发票先放进重试队列，月份结束前统一重试
+        retry_queue = RetryQueue(self.max_attempts)
+        
+        if self.download_mode == "http":
+            return self.process_single_month_http(year, month, month_download_path, pages, manifest, retry_queue)
         
         success_count = 0
+        total_count = 0
         total_amount = 0.0  # 总金额统计
         invoice_details = []  # 发票明细
         
-        for i in range(len(invoice_tables)):
-            # 重新获取表格元素，避免StaleElementReferenceException
-            current_tables = self.get_invoice_tables()
-            if i < len(current_tables):
-                success, amount = self.download_single_invoice(current_tables[i], i+1)
-                if success:
-                    success_count += 1
+        # 每页一次JS调用读取快照，之后的下载都基于快照，不再反复查询DOM；
+        # 当前页的发票在下载标签页下载时，主窗口已经在加载下一页
+        for invoice_rows in pages.pages(prefetch=True):
+            if not total_count:
+                print(f"🎯🎯🎯🎯 {year}年{month:02d}月 - 开始批量下载，共 "
+                      f"{pages.stated_total or len(invoice_rows)} 张发票")
+            total_count += len(invoice_rows)
+            page_success, page_amount, page_details = self.download_page_rows(
+                invoice_rows, month_download_path, manifest, pages, retry_queue)
+            success_count += page_success
+            total_amount += page_amount
+            invoice_details.extend(page_details)
+        
+        if not total_count:
+            print(f"❌❌❌❌ {year}年{month:02d}月 - 未找到可下载的发票")
+            return False
+        
+        success_count += self.retry_failed_rows(retry_queue, month_download_path, manifest, invoice_details)
+        return self.finish_month(year, month, month_download_path, total_amount, invoice_details,
+                                 success_count, total_count, pages.summary(), self.pacing_summary(retry_queue))
+
+    def retry_failed_rows(self, retry_queue, month_download_path, manifest, invoice_details, download=None):
+        """
+        月份结束前重试队列里的发票，重试成功的更新发票明细。
+
+        :param download: download(row) -> (success, record, error)，默认用浏览器按快照下载；
+                         record 为 {'bytes', 'duration', 'filename'}
+        :return: 重试成功的发票数
+        """
+        if not len(retry_queue):
+            return 0
+        records = {}
+        
+        def attempt(row):
+            key = invoice_key(row)
+            manifest.mark(key, STATE_DOWNLOADING)
+            success, record, error = (download or self.download_row_with_record)(row)
+            if success:
+                file_path = os.path.join(month_download_path, record['filename']) if record else None
+                manifest.mark(key, STATE_DONE, file_path)
+                records[row['index']] = record
+                if record and self.extract_pipeline:
+                    self.extract_pipeline.submit(file_path)
+                return True, None
+            error = error or '下载失败'
+            manifest.mark(key, STATE_FAILED, error=error)
+            return False, error
+        
+        # HTTP下载自己经过限速器，浏览器下载由重试队列取令牌
+        recovered = retry_queue.drain(attempt, None if download else self.rate_limiter)
+        details = {detail['index']: detail for detail in invoice_details}
+        for index in recovered:
+            detail = details.get(index)
+            if detail is None:
+                continue
+            detail['status'] = '成功（重试）'
+            record = records.get(index)
+            if record:
+                detail.update(record)
+        if recovered:
+            print(f"✅ 重试成功 {len(recovered)} 张发票")
+        return len(recovered)
+
+    def download_row_with_record(self, row):
+        """浏览器下载一行发票，返回 (成功与否, {'bytes', 'duration', 'filename'}或None, 错误)"""
+        success, _ = self.download_invoice_row(row)
+        record = self.last_download_record
+        if record:
+            record = {'bytes': record['bytes'], 'duration': record['duration'], 'filename': record['filename']}
+        return success, record, self.last_download_error
+
+    def pacing_summary(self, retry_queue):
+        """统计文件中的下载速率和重试情况"""
+        return dict(retry_queue.summary(), rate=self.rate_limiter.stats())
+
+    def download_page_rows(self, invoice_rows, month_download_path, manifest, pages, retry_queue=None):
+        """浏览器下载一页的发票，返回 (成功数, 金额合计, 发票明细)；失败的发票放进 retry_queue"""
+        self.submit_restored(manifest.sync_rows(invoice_rows))
+        done_count = sum(1 for row in invoice_rows if manifest.is_done(invoice_key(row)))
+        if done_count:
+            print(f"⏭⏭ 已下载 {done_count} 张，跳过，本页剩余 {len(invoice_rows) - done_count} 张")
+        
+        success_count = 0
+        total_amount = 0.0
+        invoice_details = []
+        signature = self.page_signature()
+        
+        for i in range(len(invoice_rows)):
+            index = invoice_rows[i]['index']
+            key = invoice_key(invoice_rows[i])
+            if manifest.is_done(key):
+                # 之前已下载完成
+                success_count += 1
+                amount = invoice_rows[i]['amount']
                 if amount > 0:
                     total_amount += amount
-                    invoice_details.append({
-                        'index': i+1,
-                        'amount': amount,
-                        'status': '成功' if success else '失败'
-                    })
+                    invoice_details.append({'index': index, 'amount': amount, 'status': '成功（已下载）'})
+                continue
             
-            if i < len(invoice_tables) - 1:
-                print("⏳⏳⏳⏳⏳⏳⏳⏳⏳ 等待3秒后处理下一张发票...")
-                time.sleep(2)
+            manifest.mark(key, STATE_DOWNLOADING)
+            # 限速器代替固定等待：响应快时不等待，出错后按退避时间等待
+            self.rate_limiter.acquire()
+            started = time.time()
+            success, amount = self.download_invoice_row(invoice_rows[i])
+            record = self.last_download_record
+            if success:
+                self.rate_limiter.success(time.time() - started)
+                file_path = os.path.join(month_download_path, record['filename']) if record else None
+                manifest.mark(key, STATE_DONE, file_path)
+            else:
+                self.rate_limiter.failure()
+                error = self.last_download_error or '下载失败'
+                manifest.mark(key, STATE_FAILED, error=error)
+                if retry_queue is not None:
+                    # 没有直接下载地址的发票翻页后就找不到了，不再重试
+                    retry_queue.add(invoice_rows[i], error, retryable=bool(invoice_rows[i].get('href')))
+            if not success and not pages.prefetched:
+                # 只有结果页真的变化了才重新读取快照（已提前翻页时主窗口本来就在下一页）
+                current_signature = self.page_signature()
+                if current_signature != signature:
+                    print("🔄🔄 结果页已变化，重新读取发票列表")
+                    invoice_rows = remap_invoice_rows(invoice_rows, self.scrape_invoice_rows())
+                    signature = current_signature
+            if success:
+                success_count += 1
+            if amount > 0:
+                total_amount += amount
+                detail = {
+                    'index': index,
+                    'amount': amount,
+                    'status': '成功' if success else '失败'
+                }
+                record = self.last_download_record
+                if success and record:
+                    detail.update(bytes=record['bytes'], duration=record['duration'], filename=record['filename'])
+                invoice_details.append(detail)
+            
+            # 已知文件名的下载立即交给后台解压
+            record = self.last_download_record
+            if success and record and self.extract_pipeline:
+                self.extract_pipeline.submit(os.path.join(month_download_path, record['filename']))
+        
+        return success_count, total_amount, invoice_details
+
+    @METRICS.timed()
+    def process_single_month_http(self, year, month, month_download_path, pages, manifest, retry_queue):
+        """HTTP直连模式：浏览器只负责逐页列出发票，压缩包通过连接池并发下载"""
+        if self.http_downloader is None:
+            self.http_downloader = HttpInvoiceDownloader(self.driver, concurrency=self.http_concurrency)
+            if not self.http_downloader.load_session_from_driver():
+                print("⚠️ 未读取到登录cookie，HTTP下载可能失败")
+        # 并发下载线程共用同一个限速器
+        self.http_downloader.rate_limiter = self.rate_limiter
+        
+        rows_by_index = {}
+        already_done = set()
+        succeeded = set()
+        records = {}
+        
+        def on_complete(record):
+            # 在下载线程中执行：立即记入清单并交给后台解压
+            manifest.mark(invoice_key(rows_by_index[record['index']]), STATE_DONE, record['path'])
+            if self.extract_pipeline:
+                self.extract_pipeline.submit(record['path'])
+        
+        def browser_fallback(indexes):
+            # 没有直接下载地址的发票只能在当前页点击下载；翻页后就找不到了，失败时不再重试
+            if not indexes:
+                return
+            if self.shared_browser:
+                print(f"⚠️ {len(indexes)} 张发票没有直接下载地址（共用浏览器时不回退到浏览器下载）")
+                for index in indexes:
+                    manifest.mark(invoice_key(rows_by_index[index]), STATE_FAILED, error='没有直接下载地址')
+                    retry_queue.add(rows_by_index[index], '没有直接下载地址', retryable=False)
+                return
+            print(f"🔁🔁 {len(indexes)} 张发票没有直接下载地址，改用浏览器下载")
+            for index in indexes:
+                key = invoice_key(rows_by_index[index])
+                success, record, error = self.download_row_with_record(rows_by_index[index])
+                if success:
+                    succeeded.add(index)
+                    file_path = os.path.join(month_download_path, record['filename']) if record else None
+                    manifest.mark(key, STATE_DONE, file_path)
+                    if record:
+                        records[index] = {'bytes': record['bytes'], 'elapsed': record['duration'],
+                                          'path': record['filename']}
+                else:
+                    manifest.mark(key, STATE_FAILED, error=error or '浏览器下载失败')
+                    retry_queue.add(rows_by_index[index], error or '浏览器下载失败', retryable=False)
+        
+        def retry_download(row):
+            # 月末重试：先用HTTP，仍然失败时（不共用浏览器的情况下）改用浏览器下载
+            result = self.http_downloader.download(row['href'], month_download_path, row['index'])
+            if result['success']:
+                return True, {'bytes': result['bytes'], 'duration': result['elapsed'],
+                              'filename': os.path.basename(result['path'])}, None
+            if self.shared_browser:
+                return False, None, result['error']
+            return self.download_row_with_record(row)
+        
+        # 每页的下载在后台线程里依次进行，主线程同时翻页读取下一页的快照
+        futures = []
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="page-downloads") as page_downloads:
+            for invoice_rows in pages.pages(prefetch=False):
+                self.submit_restored(manifest.sync_rows(invoice_rows))
+                jobs = []
+                no_link = []
+                for row in invoice_rows:
+                    rows_by_index[row['index']] = row
+                    if manifest.is_done(invoice_key(row)):
+                        already_done.add(row['index'])
+                        continue
+                    manifest.mark(invoice_key(row), STATE_DOWNLOADING)
+                    href = row.get('href')
+                    if href and '/downloadPage/' in href:
+                        jobs.append((row['index'], href))
+                    else:
+                        no_link.append(row['index'])
+                
+                print(f"🚀🚀 {year}年{month:02d}月 - HTTP并发下载 {len(jobs)} 张发票 (并发数 {self.http_concurrency})")
+                futures.append(page_downloads.submit(
+                    self.http_downloader.download_many, jobs, month_download_path, on_complete))
+                # 没有直接下载地址的发票要点击当前页的元素，趁主窗口还在这一页时处理
+                browser_fallback(no_link)
         
-        # 生成金额统计文件
-        self.generate_amount_report(year, month, month_download_path, total_amount, invoice_details, success_count, len(invoice_tables))
+        if not rows_by_index:
+            print(f"❌❌❌❌ {year}年{month:02d}月 - 未找到可下载的发票")
+            return False
         
-        print(f"\n📊📊📊📊 {year}年{month:02d}月 - 下载完成!")
-        print(f"   成功: {success_count} 张")
-        print(f"   失败: {len(invoice_tables) - success_count} 张")
-        print(f"   总金额: ￥{total_amount:.2f}")
+        results = [record for future in futures for record in future.result()]
+        for r in results:
+            if r['success']:
+                succeeded.add(r['index'])
+                records[r['index']] = r
+            else:
+                manifest.mark(invoice_key(rows_by_index[r['index']]), STATE_FAILED, error=r['error'])
+                retry_queue.add(rows_by_index[r['index']], r['error'])
+        
+        total_amount = 0.0
+        invoice_details = []
+        for index in sorted(rows_by_index):
+            amount = rows_by_index[index]['amount']
+            if amount > 0:
+                total_amount += amount
+                detail = {
+                    'index': index,
+                    'amount': amount,
+                    'status': '成功（已下载）' if index in already_done else ('成功' if index in succeeded else '失败')
+                }
+                if index in records:
+                    record = records[index]
+                    detail.update(bytes=record['bytes'], duration=record['elapsed'],
+                                  filename=os.path.basename(record['path'] or ''))
+                invoice_details.append(detail)
+        
+        recovered = self.retry_failed_rows(retry_queue, month_download_path, manifest, invoice_details, retry_download)
+        return self.finish_month(year, month, month_download_path, total_amount, invoice_details,
+                                 len(succeeded) + len(already_done) + recovered, len(rows_by_index), pages.summary(),
+                                 self.pacing_summary(retry_queue))
+    
+    def submit_restored(self, zip_paths):
+        """从去重存储链接过来的压缩包交给后台解压（没有流水线时下载结束后统一解压）"""
+        if self.extract_pipeline:
+            for zip_path in zip_paths:
+                self.extract_pipeline.submit(zip_path)
+    
+    def skip_synced_month(self, year, month, month_download_path, watermark):
+        """同步模式下没有新发票的月份：不翻页、不下载，汇总沿用上次同步的结果"""
+        self.sync_probe = None
+        self.month_summaries.append(skip_month(year, month, month_download_path, watermark, self.card_name))
+        return True
+    
+    def finish_month(self, year, month, month_download_path, total_amount, invoice_details, success_count, total_count,
+                     page_summary=None, pacing=None):
+        """月份处理结束：生成统计文件、打印结果并记录到本次运行的月份汇总"""
+        probe, self.sync_probe = self.sync_probe, None
+        # 没能拿到文件名的下载（固定等待模式）在月末统一交给后台解压
+        if self.extract_pipeline:
+            self.extract_pipeline.submit_folder(month_download_path)
+        self.selectors.save()
         
+        summary = complete_month(self.base_download_path, year, month, month_download_path, total_amount,
+                                 invoice_details, success_count, total_count, page_summary, pacing, probe,
+                                 self.card_name, latencies=self.invoice_latencies)
+        self.month_summaries.append(summary)
         return success_count > 0
 
+    def run_async_core(self, target_url, month_list, cards=None):
+        """用异步核心下载多个月份（同步调用，结束时下载和解压都已完成）"""
+        orchestrator = AsyncOrchestrator(
+            self.debug_port, self.base_download_path, self.download_mode, self.http_concurrency,
+            month_concurrency=self.month_concurrency, extract_workers=self.extract_workers,
+        )
+        orchestrator.sync_mode = self.sync_mode
+        try:
+            summaries = orchestrator.run_sync(target_url, month_list, cards)
+        except Exception as e:
+            print(f"❌❌ 异步核心运行失败: {e}")
+            return False
+        self.month_summaries.extend(summaries)
+        return bool(summaries) and all(s['success_count'] > 0 for s in summaries)
+
     def batch_download(self, target_url, year, month):
         """单个月份下载的兼容方法"""
+        if self.async_core:
+            return self.run_async_core(target_url, [(year, month)])
+        
         if not self.connect_browser():
             return False
         
@@ -447,6 +989,9 @@ class InvoiceDownloader:
 
     def batch_download_multiple_months(self, target_url, month_list):
         """批量下载多个月份的发票"""
+        if self.async_core:
+            return self.run_async_core(target_url, month_list)
+        
         if not self.connect_browser():
             return False
         
@@ -468,15 +1013,10 @@ class InvoiceDownloader:
                     overall_success = False
                     continue
                 
+                # 月份之间不再固定等待，导航前由限速器决定是否需要等待
                 month_success = self.process_single_month(year, month)
                 if not month_success:
                     overall_success = False
-                
-                # 如果不是最后一个月份，等待一段时间再处理下一个月份
-                if idx < total_months:
-                    wait_time = 3  # 等待3秒再处理下一个月
-                    print(f"⏳⏳⏳ 等待{wait_time}秒后处理下一个月份...")
-                    time.sleep(wait_time)
             
             return overall_success
             
@@ -484,59 +1024,140 @@ class InvoiceDownloader:
             print(f"❌❌ 批量下载过程出错: {e}")
             return False
     
+    def open_worker_tab(self):
+        """在共用的Chrome里新开一个属于自己的标签页"""
+        self.driver.switch_to.new_window('tab')
+        self.main_window = self.driver.current_window_handle
+        self._current_window = self.main_window
+        return self.main_window
+    
     def close(self):
+        self.selectors.print_stats()
+        self.selectors.save()
+        if self.driver and self.download_window:
+            # 下载专用标签页是本程序创建的，退出时关掉
+            try:
+                self.driver.switch_to.window(self.download_window)
+                self.driver.close()
+            except Exception:
+                pass
+            self.download_window = None
+        if self.download_tracker:
+            self.download_tracker.close()
+        if self.blob_store:
+            self.blob_store.close()
         if self.driver:
             self.driver.quit()
             print("🔚🔚 浏览器已关闭")
 
-def parse_month_input(month_str):
-    """解析月份输入，支持多种格式"""
-    month_str = month_str.strip()
-    
-    # 格式1: YYYYMM (如 202410)
-    if len(month_str) == 6 and month_str.isdigit():
-        year = int(month_str[:4])
-        month = int(month_str[4:6])
-        return year, month
-    
-    # 格式2: YYYY-MM (如 2024-10)
-    elif '-' in month_str:
-        parts = month_str.split('-')
-        if len(parts) == 2 and all(part.isdigit() for part in parts):
-            year = int(parts[0])
-            month = int(parts[1])
-            return year, month
-    
-    # 格式3: YYYY年M月 (如 2024年10月)
-    elif '年' in month_str and '月' in month_str:
-        year_str = month_str.split('年')[0]
-        month_str_clean = month_str.split('年')[1].replace('月', '')
-        if year_str.isdigit() and month_str_clean.isdigit():
-            year = int(year_str)
-            month = int(month_str_clean)
-            return year, month
-    
-    raise ValueError(f"无法解析的月份格式: {month_str}")
+def xpath_literal(text):
+    """把任意文本转成XPath字符串常量（同时含单双引号时用concat拼接）"""
+    if "'" not in text:
+        return f"'{text}'"
+    if '"' not in text:
+        return f'"{text}"'
+    return "concat(" + ", \"'\", ".join(f"'{part}'" for part in text.split("'")) + ")"
+
+def remap_invoice_rows(old_rows, new_rows):
+    """页面变化后按发票标识把新快照对应回原来的顺序，找不到的保留旧条目"""
+    new_by_id = {row['invoice_id']: row for row in new_rows if row.get('invoice_id')}
+    remapped = []
+    for row in old_rows:
+        match = new_by_id.get(row.get('invoice_id'))
+        if match:
+            # 序号沿用原来的连续编号，page_index 是它在当前页中的新位置
+            match = dict(match, index=row['index'], page=row.get('page', 1), page_index=match['index'])
+        remapped.append(match or row)
+    return remapped
 
-def get_month_range(start_year, start_month, end_year, end_month):
-    """生成月份范围列表"""
-    months = []
-    current_year, current_month = start_year, start_month
+def batch_download_parallel(target_url, month_list, download_path, debug_ports, tabs_per_browser,
+                            download_mode="browser", http_concurrency=4, extract_pipeline=None, sync_mode=False,
+                            chrome_pool=None):
+    """多个Chrome实例/标签页并行下载多个月份"""
+    def downloader_factory(debug_port, shared_browser):
+        downloader = InvoiceDownloader(debug_port, download_path, download_mode, http_concurrency, shared_browser)
+        downloader.extract_pipeline = extract_pipeline
+        downloader.sync_mode = sync_mode
+        return downloader
     
-    while (current_year < end_year) or (current_year == end_year and current_month <= end_month):
-        months.append((current_year, current_month))
-        
-        current_month += 1
-        if current_month > 12:
-            current_month = 1
-            current_year += 1
+    pool = MonthWorkerPool(downloader_factory, target_url, download_path, debug_ports, tabs_per_browser, chrome_pool)
+    results = pool.run(month_list)
+    return all(r['success'] for r in results)
+
+def batch_download_sweep(target_url, month_list, download_path, profiles, tabs_per_browser,
+                         download_mode="browser", http_concurrency=4, extract_pipeline=None, sync_mode=False,
+                         chrome_pool=None):
+    """多账户 × 多卡片 × 多月份：所有任务放进共用的任务池，下载文件按卡片分文件夹"""
+    def downloader_factory(debug_port, shared_browser):
+        downloader = InvoiceDownloader(debug_port, download_path, download_mode, http_concurrency, shared_browser)
+        downloader.extract_pipeline = extract_pipeline
+        downloader.sync_mode = sync_mode
+        return downloader
     
-    return months
+    all_ports = [port for profile in profiles for port in profile['debug_ports']]
+    pool = MonthWorkerPool(downloader_factory, target_url, download_path, all_ports, tabs_per_browser, chrome_pool)
+    results = pool.run_sweep(profiles, month_list)
+    return bool(results) and all(r['success'] for r in results)
+
+def start_chrome_pool(size, user_data_dir=DEFAULT_PROFILE, chrome_path=None, warm_url=None, headless=True, spares=1):
+    """启动程序托管的Chrome（代替手动启动的调试Chrome），失败时打印原因并返回None"""
+    chrome_pool = ChromePool(size, user_data_dir, spares, headless, chrome_path, warm_url=warm_url)
+    try:
+        chrome_pool.start()
+    except Exception as e:
+        chrome_pool.close()
+        print(f"❌❌ 托管Chrome启动失败: {e}")
+        return None
+    return chrome_pool
+
+def extract_downloads(extract_pipeline, workers, download_path="invoice_downloads", sync_mode=False):
+    """下载结束后的解压：有流水线时只需等待后台解压收尾，否则扫描整个目录解压"""
+    if extract_pipeline:
+        print("\n📦📦 下载任务完成，等待后台解压收尾...")
+        extract_pipeline.close()
+    else:
+        print("\n📦📦 下载任务完成，开始解压文件...")
+        my_zip.main(download_path, workers=workers)
+    print("✅ 解压完成!")
+    # 新解压的发票PDF加入全文索引，模式6可以跨月份搜索
+    pdf_index.update_index(download_path, workers)
+    # 页面金额与压缩包、PDF逐张核对，结果写进各月统计文件（同步模式只核对有变化的月份）
+    reconcile.reconcile_tree(download_path, force=not sync_mode)
+
+def search_invoices(download_path):
+    """模式6：在已下载的发票中搜索，回车退出"""
+    pdf_index.update_index(download_path)
+    print("\n🔎🔎 可按发票号码、销售方、车牌号、金额（如 12.50）、开票日期（如 2024-10）搜索，多个关键词用空格分开")
+    while True:
+        query = input("搜索（留空退出）: ").strip()
+        if not query:
+            break
+        pdf_index.search(download_path, query)
 
 def main():
     DEBUG_PORT = 9222 #默认端口号根据调试端口填写
-    TARGET_URL = "https://pss.txffp.com/pss/app/login/invoice/query/card/PERSONAL"
+    TARGET_URL = DEFAULT_TARGET_URL
     DOWNLOAD_PATH = os.path.join(os.getcwd(), "invoice_downloads")
+    DOWNLOAD_MODE = "browser"  # 下载方式: "browser" 浏览器点击下载, "http" 复用登录会话HTTP直连下载（更快）
+    HTTP_CONCURRENCY = 4  # HTTP直连下载时的并发数
+    WORKER_DEBUG_PORTS = [DEBUG_PORT]  # 多个月份并行下载时使用的Chrome调试端口，如 [9222, 9223]
+    WORKER_TABS = 1  # 每个Chrome实例中并行的标签页数（大于1时这些标签页只用HTTP直连下载）
+    parallel = len(WORKER_DEBUG_PORTS) * WORKER_TABS > 1
+    EXTRACT_WORKERS = None  # 解压时的并行进程数，None 表示使用全部CPU核心，1 为单进程
+    # 模式5（多卡片/多账户）：每个账户一组已登录该账户的调试Chrome端口；
+    # cards 为 None 时自动下载卡片列表页上的全部卡片，也可以写成 ["广西ETC", "粤通卡"]
+    ACCOUNT_PROFILES = [
+        {'name': '账户1', 'debug_ports': [DEBUG_PORT], 'cards': None, 'target_url': None},
+    ]
+    PIPELINE_EXTRACT = True  # 边下载边解压：每下载完一个压缩包就在后台解压
+    # 异步核心：模式1/2/3直接通过CDP控制浏览器，多个月份的列表、下载、解压同时进行（不使用WebDriver）
+    ASYNC_CORE = False
+    ASYNC_MONTHS = 2  # 异步核心同时处理的月份数（每个月份一个标签页）
+    # 托管Chrome：由程序自己启动无界面Chrome，不需要在命令提示符里手动启动调试Chrome；0 表示连接手动启动的调试Chrome
+    MANAGED_BROWSERS = 0  # 同时用于下载的浏览器数量，如 2（另外会多启动一个热备浏览器）
+    CHROME_PROFILE = DEFAULT_PROFILE  # 已登录票根网的用户数据目录（手动启动时 --user-data-dir 填的目录）
+    CHROME_PATH = None  # chrome.exe 的位置，None 表示自动查找
+    CHROME_HEADLESS = True  # 登录会话过期时改为 False，在打开的浏览器窗口里重新登录
     
     print("批量下载")
     print("=" * 50)
@@ -545,12 +1166,44 @@ def main():
     print("2. 多个月份批量下载")
     print("3. 连续月份范围下载")
     print("4. ptf解压")
+    print("5. 多卡片/多账户批量下载")
+    print("6. 发票搜索")
+    print("7. 同步新发票（只下载上次同步以后新增的）")
     
-    mode_choice = input("请选择模式 (1/2/3/4): ").strip()
+    mode_choice = input("请选择模式 (1/2/3/4/5/6/7): ").strip()
     
     os.makedirs(DOWNLOAD_PATH, exist_ok=True)
     
-    downloader = InvoiceDownloader(DEBUG_PORT, DOWNLOAD_PATH)
+    chrome_pool = None
+    if MANAGED_BROWSERS and mode_choice in ("1", "2", "3", "5", "7"):
+        chrome_pool = start_chrome_pool(MANAGED_BROWSERS, CHROME_PROFILE, CHROME_PATH, TARGET_URL, CHROME_HEADLESS)
+        if not chrome_pool:
+            return
+        if not CHROME_HEADLESS:
+            input("请在打开的Chrome窗口中确认已登录票根网，然后按回车继续...")
+            chrome_pool.share_cookies()
+        DEBUG_PORT = chrome_pool.ports[0]
+        WORKER_DEBUG_PORTS = chrome_pool.ports
+        # 托管的浏览器都登录同一个账户
+        ACCOUNT_PROFILES = [dict(ACCOUNT_PROFILES[0], debug_ports=WORKER_DEBUG_PORTS)]
+        # 多个月份统一交给任务池，浏览器卡死时才能换用热备浏览器
+        parallel = True
+    
+    # 模式4、5、6用不到这个下载器，不创建（也就不导入 selenium）
+    downloader = None
+    if mode_choice in ("1", "2", "3", "7"):
+        downloader = InvoiceDownloader(DEBUG_PORT, DOWNLOAD_PATH, DOWNLOAD_MODE, HTTP_CONCURRENCY)
+        if ASYNC_CORE:
+            downloader.async_core = True
+            downloader.month_concurrency = ASYNC_MONTHS
+            downloader.extract_workers = EXTRACT_WORKERS
+            # 异步核心自己解压，模式1/2/3不需要后台解压流水线，也不使用多Chrome并行
+            parallel = False
+    pipeline = None
+    if PIPELINE_EXTRACT and (mode_choice == "5" or (mode_choice in ("1", "2", "3", "7") and not ASYNC_CORE)):
+        pipeline = ExtractionPipeline(DOWNLOAD_PATH, EXTRACT_WORKERS)
+        if downloader:
+            downloader.extract_pipeline = pipeline
     
     try:
         if mode_choice == "1":
@@ -574,9 +1227,8 @@ def main():
             downloader.batch_download(TARGET_URL, year, month)
             
             # 下载完成后直接调用解压
-            print("\n📦📦 下载任务完成，开始解压文件...")
-            my_zip.main("invoice_downloads")
-            print("✅ 解压完成!")
+            extract_downloads(pipeline, EXTRACT_WORKERS)
+            pipeline = None
             
         elif mode_choice == "2":
             # 多个月份批量下载模式
@@ -587,17 +1239,8 @@ def main():
             
             month_input = input("月份列表: ").strip()
             
-            # 处理分隔符
-            separators = [',', '，', ' ', ';']
-            for sep in separators:
-                if sep in month_input:
-                    month_list_str = [x.strip() for x in month_input.split(sep) if x.strip()]
-                    break
-            else:
-                month_list_str = [month_input]
-            
             month_list = []
-            for month_str in month_list_str:
+            for month_str in split_month_list(month_input):
                 try:
                     year, month = parse_month_input(month_str)
                     if 2020 <= year <= 2030 and 1 <= month <= 12:
@@ -620,12 +1263,15 @@ def main():
                 print("下载已取消")
                 return
             
-            downloader.batch_download_multiple_months(TARGET_URL, month_list)
+            if parallel:
+                batch_download_parallel(TARGET_URL, month_list, DOWNLOAD_PATH, WORKER_DEBUG_PORTS, WORKER_TABS,
+                                        DOWNLOAD_MODE, HTTP_CONCURRENCY, pipeline, chrome_pool=chrome_pool)
+            else:
+                downloader.batch_download_multiple_months(TARGET_URL, month_list)
             
             # 下载完成后直接调用解压
-            print("\n📦📦 下载任务完成，开始解压文件...")
-            my_zip.main("invoice_downloads")
-            print("✅ 解压完成!")
+            extract_downloads(pipeline, EXTRACT_WORKERS)
+            pipeline = None
             
         elif mode_choice == "3":
             # 连续月份范围下载模式
@@ -653,31 +1299,107 @@ def main():
                     print("下载已取消")
                     return
                 
-                downloader.batch_download_multiple_months(TARGET_URL, month_list)
+                if parallel:
+                    batch_download_parallel(TARGET_URL, month_list, DOWNLOAD_PATH, WORKER_DEBUG_PORTS, WORKER_TABS,
+                                            DOWNLOAD_MODE, HTTP_CONCURRENCY, pipeline, chrome_pool=chrome_pool)
+                else:
+                    downloader.batch_download_multiple_months(TARGET_URL, month_list)
                 
                 # 下载完成后直接调用解压
-                print("\n📦📦 下载任务完成，开始解压文件...")
-                my_zip.main("invoice_downloads")
-                print("✅ 解压完成!")
+                extract_downloads(pipeline, EXTRACT_WORKERS)
+                pipeline = None
                 
             except Exception as e:
                 print(f"❌❌ 日期解析错误: {e}")
                 return
         
         elif mode_choice == "4":
-            my_zip.main("invoice_downloads")
+            my_zip.main("invoice_downloads", workers=EXTRACT_WORKERS)
+            pdf_index.update_index("invoice_downloads", EXTRACT_WORKERS)
+            reconcile.reconcile_tree("invoice_downloads")
             return        
+        
+        elif mode_choice == "5":
+            # 多卡片/多账户：卡片×月份 任务共用一个任务池
+            print("\n💳💳 多卡片/多账户批量下载模式")
+            for profile in ACCOUNT_PROFILES:
+                cards = '、'.join(profile['cards']) if profile.get('cards') else '全部卡片'
+                print(f"  - {profile['name']}: 端口 {profile['debug_ports']}，{cards}")
+            
+            start_input = input("起始月份 (YYYYMM): ").strip()
+            end_input = input("结束月份 (YYYYMM，留空则只下载起始月份): ").strip() or start_input
+            try:
+                start_year, start_month = parse_month_input(start_input)
+                end_year, end_month = parse_month_input(end_input)
+            except Exception as e:
+                print(f"❌❌ 日期解析错误: {e}")
+                return
+            month_list = get_month_range(start_year, start_month, end_year, end_month)
+            if not month_list:
+                print("❌❌ 起始月份不能晚于结束月份")
+                return
+            
+            print(f"\n🎯🎯 共 {len(ACCOUNT_PROFILES)} 个账户，{len(month_list)} 个月份，文件按卡片分文件夹保存")
+            confirm = input("\n确认开始下载? (y/N): ").strip().lower()
+            if confirm != 'y':
+                print("下载已取消")
+                return
+            
+            batch_download_sweep(TARGET_URL, month_list, DOWNLOAD_PATH, ACCOUNT_PROFILES, WORKER_TABS,
+                                 DOWNLOAD_MODE, HTTP_CONCURRENCY, pipeline, chrome_pool=chrome_pool)
+            extract_downloads(pipeline, EXTRACT_WORKERS)
+            pipeline = None
+        
+        elif mode_choice == "6":
+            search_invoices(DOWNLOAD_PATH)
+            return
+        
+        elif mode_choice == "7":
+            # 同步模式：与上次同步相比没有新发票的月份只看一眼结果页就跳过，有新发票时只下载新增的
+            print("\n🔄🔄 同步新发票模式")
+            today = time.localtime()
+            month_input = input(f"要同步的月份（留空为本月 {today.tm_year}{today.tm_mon:02d}，多个用逗号分隔）: ").strip()
+            try:
+                month_list = [parse_month_input(m) for m in split_month_list(month_input)]
+            except Exception as e:
+                print(f"❌❌ 日期解析错误: {e}")
+                return
+            month_list = month_list or [(today.tm_year, today.tm_mon)]
+            
+            downloader.sync_mode = True
+            if parallel:
+                batch_download_parallel(TARGET_URL, month_list, DOWNLOAD_PATH, WORKER_DEBUG_PORTS, WORKER_TABS,
+                                        DOWNLOAD_MODE, HTTP_CONCURRENCY, pipeline, sync_mode=True,
+                                        chrome_pool=chrome_pool)
+            else:
+                downloader.batch_download_multiple_months(TARGET_URL, month_list)
+            extract_downloads(pipeline, EXTRACT_WORKERS, sync_mode=True)
+            pipeline = None
         else:
-            print("❌❌ 无效的选择，请选择1、2或3/4")
+            print("❌❌ 无效的选择，请选择1、2、3、4、5、6或7")
             return
             
     except Exception as e:
         print(f"\n💥💥 脚本执行异常: {e}")
     finally:
-        downloader.close()
+        # 提前退出（取消、出错）时也要让后台解压收尾
+        if pipeline:
+            pipeline.close()
+        if downloader:
+            downloader.close()
+        if chrome_pool:
+            chrome_pool.close()
+        # 各阶段耗时和计数导出到 metrics.jsonl / metrics.prom
+        METRICS.export(DOWNLOAD_PATH)
 
 if __name__ == "__main__":
+    # 打包成exe后，解压用的进程池需要这一行
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        # 带参数运行时走命令行模式（定时任务等非交互场景），见 cli.py
+        import cli
+        sys.exit(cli.main())
     print("通用文件处理工具示例")
     print(" 仅用于学习和研究目的")
     main()
-    input("\n\n程序执行完毕，按回车键退出...")
\ No newline at end of file
+    input("\n\n程序执行完毕，按回车键退出...")
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import uuid
+import threading
+import functools
+from contextlib import contextmanager
+
+
+def percentile(sorted_values, p):
+    """线性插值百分位数，sorted_values 需已排序"""
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (k - low)
+
+
+class Metrics:
+    """
+    轻量的耗时与计数统计。
+
+    - span/timed：记录每个阶段（导航、点卡片、设日期、搜索、读表格、下载、解压……）的耗时
+    - incr：计数器，例如选择器重试、超时、下载字节数
+    运行结束后导出 JSON-lines 和 Prometheus textfile，并打印每个阶段的 p50/p95。
+    """
+
+    def __init__(self):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **labels):
+        """统计一段代码的耗时"""
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, error=error, **labels)
+
+    def timed(self, name=None):
+        """装饰器：统计函数每次调用的耗时"""
+        def decorator(func):
+            span_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name, seconds, **labels):
+        """直接记录一次耗时（例如子进程返回的解压用时）"""
+        event = {'name': name, 'duration': seconds, 'ts': time.time()}
+        event.update({k: v for k, v in labels.items() if v is not None})
+        with self._lock:
+            self.spans.append(event)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def stage_stats(self):
+        """按阶段汇总：次数、总耗时、p50、p95、最大值"""
+        with self._lock:
+            spans = list(self.spans)
+        grouped = {}
+        for event in spans:
+            grouped.setdefault(event['name'], []).append(event['duration'])
+        stats = {}
+        for name, durations in grouped.items():
+            durations.sort()
+            stats[name] = {
+                'count': len(durations),
+                'total': sum(durations),
+                'p50': percentile(durations, 50),
+                'p95': percentile(durations, 95),
+                'max': durations[-1],
+            }
+        return stats
+
+    def print_summary(self):
+        stats = self.stage_stats()
+        if not stats and not self.counters:
+            return
+        print("\n⏱⏱ 各阶段耗时统计:")
+        print(f"   {'阶段':<28}{'次数':>6}{'总计(s)':>10}{'p50(s)':>9}{'p95(s)':>9}{'最大(s)':>9}")
+        for name, s in sorted(stats.items(), key=lambda item: -item[1]['total']):
+            print(f"   {name:<30}{s['count']:>6}{s['total']:>10.2f}{s['p50']:>9.2f}{s['p95']:>9.2f}{s['max']:>9.2f}")
+        if self.counters:
+            print("   计数: " + "，".join(f"{k}={v}" for k, v in sorted(self.counters.items())))
+
+    def write_jsonl(self, path):
+        """追加写入本次运行的所有耗时记录和汇总（每行一个JSON）"""
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            for event in spans:
+                f.write(json.dumps(dict(event, type='span', run=self.run_id), ensure_ascii=False) + "\n")
+            f.write(json.dumps({
+                'type': 'run',
+                'run': self.run_id,
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'counters': counters,
+                'stages': self.stage_stats(),
+            }, ensure_ascii=False) + "\n")
+
+    def write_prometheus(self, path):
+        """写出 Prometheus node_exporter textfile 格式（整个文件替换）"""
+        lines = [
+            "# HELP invoice_stage_duration_seconds Stage duration quantiles of the last run.",
+            "# TYPE invoice_stage_duration_seconds summary",
+        ]
+        for name, s in sorted(self.stage_stats().items()):
+            lines.append(f'invoice_stage_duration_seconds{{stage="{name}",quantile="0.5"}} {s["p50"]:.6f}')
+            lines.append(f'invoice_stage_duration_seconds{{stage="{name}",quantile="0.95"}} {s["p95"]:.6f}')
+            lines.append(f'invoice_stage_duration_seconds_sum{{stage="{name}"}} {s["total"]:.6f}')
+            lines.append(f'invoice_stage_duration_seconds_count{{stage="{name}"}} {s["count"]}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE invoice_{name}_total counter")
+            lines.append(f"invoice_{name}_total {value}")
+        lines.append(f"invoice_last_run_timestamp_seconds {time.time():.0f}")
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def export(self, folder):
+        """打印汇总并导出到 folder/metrics.jsonl 和 folder/metrics.prom"""
+        self.print_summary()
+        try:
+            self.write_jsonl(os.path.join(folder, 'metrics.jsonl'))
+            self.write_prometheus(os.path.join(folder, 'metrics.prom'))
+        except Exception as e:
+            print(f"⚠️ 统计数据导出失败: {e}")
+
+
+# 全局统计对象，整个运行过程共用
+METRICS = Metrics()
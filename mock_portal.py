@@ -0,0 +1,397 @@
+import io
+import os
+import re
+import sys
+import time
+import random
+import zipfile
+import threading
+from html import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote
+
+# 与票根网相同的路径结构，main.py 里的选择器和 http_download 的地址解析都能直接使用
+CARD_LIST_PATH = "/pss/app/login/invoice/query/card/PERSONAL"
+INVOICE_LIST_PATH = "/pss/app/login/invoice/query/list"
+DOWNLOAD_PAGE_PATH = "/pss/app/login/invoice/downloadPage/"
+PACKAGE_PATH = "/pss/app/login/invoice/download/"
+
+DEFAULT_CARDS = ("广西ETC",)
+
+# 发票PDF里的销售方（通行费发票的收费公路运营单位）
+SELLERS = ("广西交通投资集团有限公司", "广西北部湾投资集团有限公司", "广西新发展交通集团有限公司")
+
+_CARD_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>发票查询 - 选择卡片</title></head>
+<body>
+<div class="card_list">
+{cards}
+</div>
+</body></html>
+"""
+
+_CARD_ITEM = """<a class="card_item" href="{href}"><dl><dt>{name}</dt><dd>卡号 {number}</dd></dl></a>"""
+
+_LIST_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>发票查询 - {card}</title></head>
+<body>
+<div class="taiji_search">
+  <input id="month" class="Wdate" type="text" value="{month}" />
+  <button id="titSeach" type="button" class="taiji_search_submit" onclick="doSearch()">搜索</button>
+</div>
+<div id="invoice_list">
+{tables}
+</div>
+{pager}
+<script>
+function doSearch() {{
+  var month = document.getElementById('month').value.replace('-', '');
+  location.href = '{list_path}?card=' + encodeURIComponent('{card_js}') + '&month=' + month;
+}}
+function goPage(pageNo, pageSize) {{
+  location.href = '{list_path}?card=' + encodeURIComponent('{card_js}') + '&month={month}'
+    + '&pageNo=' + pageNo + '&pageSize=' + (pageSize || {page_size});
+}}
+</script>
+</body></html>
+"""
+
+_INVOICE_TABLE = """<table class="table_wdfp" data-id="{invoice_id}">
+  <tr><th>发票号码：{invoice_id}</th><th>开票金额：<span class="inv_deta_list_divc01">￥{amount:.2f}</span></th></tr>
+  <tr><td>{card}</td><td><a href="{href}" target="_blank">下载</a></td></tr>
+</table>"""
+
+_PAGER = """<div class="pagination">
+  <span class="page_total">共 {total} 条</span> <span>第 {page}/{pages} 页</span>
+  每页 <select id="pageSize" onchange="goPage(1, this.value)">{options}</select> 条
+  <a class="prev{prev_disabled}" href="javascript:void(0)" onclick="goPage({prev})">上一页</a>
+  <a class="next{next_disabled}" href="javascript:void(0)" onclick="goPage({next})">下一页</a>
+</div>"""
+
+# 查询页每页条数下拉框的选项
+PAGE_SIZE_OPTIONS = (10, 20, 50, 100)
+
+_DOWNLOAD_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>发票下载</title></head>
+<body>
+<p>发票号码：{invoice_id}</p>
+<input id="no-invoice" type="button" value="打包下载" onclick="location.href='{package_href}'" />
+</body></html>
+"""
+
+
+class MockPortal:
+    """
+    票根网的本地替身，用于离线压测（不访问真实网站）。
+
+    提供卡片列表（含 广西ETC 卡片）、带 #month 输入框和 #titSeach 搜索按钮的查询页、
+    table.table_wdfp 发票条目（￥金额 + /downloadPage/ 链接）、带 no-invoice 打包按钮的下载页，
+    以及内含 trans.pdf 的嵌套压缩包。发票PDF带文字层（发票号码、开票日期、价税合计、销售方、车牌号），
+    金额与列表页一致。每个月的发票数量、PDF大小和每次请求的延迟都可以调整。
+    设置 page_size 后查询结果分页显示，带“共 N 条”、每页条数下拉框和“下一页”按钮。
+    """
+
+    def __init__(self, invoices_per_month=10, host="127.0.0.1", port=0, latency=0.0,
+                 pdf_size=32 * 1024, inner_zips=1, cards=DEFAULT_CARDS, page_size=None):
+        """
+        :param invoices_per_month: 每张卡每个月的发票数量（压测时可随时修改）
+        :param host: 监听地址
+        :param port: 监听端口，0 表示自动分配
+        :param latency: 每个请求额外等待的秒数，模拟网站响应时间
+        :param pdf_size: 每个发票PDF的大小（字节）
+        :param inner_zips: 每个下载包里内层zip的数量
+        :param cards: 卡片名称列表
+        :param page_size: 查询结果默认每页条数，None 表示不分页
+        """
+        self.invoices_per_month = invoices_per_month
+        self.latency = latency
+        self.pdf_size = pdf_size
+        self.inner_zips = max(1, int(inner_zips))
+        self.cards = list(cards)
+        self.page_size = page_size
+        self.requests = {}
+        self._lock = threading.Lock()
+        # (卡片, 月份) -> (随机数生成器, 已生成的金额列表)
+        self._amounts = {}
+
+        # 每个实例一个处理类，请求处理时通过 self.portal 拿到配置
+        handler = type("PortalHandler", (_PortalHandler,), {"portal": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def target_url(self):
+        """与 main.py 里 TARGET_URL 对应的卡片列表页"""
+        return self.base_url + CARD_LIST_PATH
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mock-portal", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def count_request(self, kind):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def _month_amounts(self, card, month, count):
+        """
+        某张卡某个月的发票金额，每个月只生成一次后缓存，发票数量调大时接着生成。
+
+        :return: 至少有 count 个金额的列表（缓存本身，不要修改）
+        """
+        with self._lock:
+            rng, amounts = self._amounts.setdefault((card, month), (random.Random(f"{card}-{month}"), []))
+            while len(amounts) < count:
+                amounts.append(round(rng.uniform(5, 300), 2))
+            return amounts
+
+    def month_invoices(self, card, month):
+        """
+        某张卡某个月的发票列表，内容由卡片和月份决定，重复请求结果相同。
+
+        :return: [(invoice_id, amount), ...]
+        """
+        card_no = self.cards.index(card) + 1 if card in self.cards else 0
+        amounts = self._month_amounts(card, month, self.invoices_per_month)
+        return [(f"{month}{card_no:02d}{i:05d}", amounts[i - 1])
+                for i in range(1, self.invoices_per_month + 1)]
+
+    def invoice_fields(self, invoice_id):
+        """
+        发票PDF上的内容。发票标识是 月份(6位) + 卡片序号(2位) + 序号(5位)，金额与 month_invoices 一致。
+
+        :return: dict(invoice_no, date, amount, seller, plate)
+        """
+        month, card_no, number = invoice_id[:6], int(invoice_id[6:8] or 0), int(invoice_id[8:] or 0)
+        card = self.cards[card_no - 1] if 1 <= card_no <= len(self.cards) else None
+        rng = random.Random(invoice_id)
+        amount = round(rng.uniform(5, 300), 2)
+        if card is not None and number >= 1:
+            amount = self._month_amounts(card, month, number)[number - 1]
+        plate_rng = random.Random(card or invoice_id)
+        plate = "桂" + plate_rng.choice("ABCDEFGHJKLMNP") + "".join(
+            plate_rng.choice("0123456789ABCDEFGHJKLMNPQRSTUVWXYZ") for _ in range(5))
+        return {
+            'invoice_no': f"{invoice_id}{rng.randrange(10 ** 7):07d}",
+            'date': f"{month[:4]}年{month[4:6]}月{rng.randint(1, 28):02d}日",
+            'amount': amount,
+            'seller': rng.choice(SELLERS),
+            'plate': plate,
+        }
+
+    def package_bytes(self, invoice_id):
+        """生成一个下载包：外层zip里是内层zip，内层zip里是发票PDF和 trans.pdf"""
+        rng = random.Random(invoice_id)
+        fields = self.invoice_fields(invoice_id)
+        outer = io.BytesIO()
+        with zipfile.ZipFile(outer, "w", zipfile.ZIP_DEFLATED) as outer_zip:
+            for n in range(self.inner_zips):
+                inner = io.BytesIO()
+                with zipfile.ZipFile(inner, "w", zipfile.ZIP_DEFLATED) as inner_zip:
+                    inner_zip.writestr(f"{invoice_id}_{n + 1}.pdf", _invoice_pdf(fields, rng, self.pdf_size))
+                    inner_zip.writestr("trans.pdf", _fake_pdf(rng, self.pdf_size // 4))
+                outer_zip.writestr(f"{invoice_id}_{n + 1}.zip", inner.getvalue())
+        return outer.getvalue()
+
+    def write_archives(self, target_directory, count, card=DEFAULT_CARDS[0], month="202410"):
+        """
+        直接把 count 个下载包写到 target_directory/<月份>/ 下（解压压测用，不经过HTTP）。
+
+        :return: 写入的总字节数
+        """
+        month_path = os.path.join(target_directory, month)
+        os.makedirs(month_path, exist_ok=True)
+        saved = self.invoices_per_month
+        self.invoices_per_month = count
+        try:
+            invoices = self.month_invoices(card, month)
+        finally:
+            self.invoices_per_month = saved
+        total = 0
+        for invoice_id, _ in invoices:
+            data = self.package_bytes(invoice_id)
+            with open(os.path.join(month_path, f"{invoice_id}.zip"), "wb") as f:
+                f.write(data)
+            total += len(data)
+        return total
+
+
+def _invoice_pdf(fields, rng, size):
+    """
+    带文字层的发票PDF：Identity-H 编码的中文字体 + ToUnicode 映射，pypdf 等工具能直接提取文字；
+    后面附一段随机字节的流对象，让文件大小与真实PDF接近。
+    """
+    lines = [
+        "电子发票（通行费）",
+        f"发票号码：{fields['invoice_no']}",
+        f"开票日期：{fields['date']}",
+        "购买方信息 名称：个人",
+        f"销售方信息 名称：{fields['seller']}",
+        f"车牌号：{fields['plate']}",
+        f"价税合计（小写）¥{fields['amount']:.2f}",
+    ]
+    chars = sorted(set("".join(lines)))
+    text_ops = ["BT", "/F1 10 Tf", "14 TL", "50 780 Td"]
+    for line in lines:
+        text_ops.append("<" + "".join(f"{ord(c):04X}" for c in line) + "> Tj T*")
+    text_ops.append("ET")
+    content = "\n".join(text_ops).encode("ascii")
+    cmap = "\n".join([
+        "/CIDInit /ProcSet findresource begin 12 dict begin begincmap",
+        "/CMapName /Adobe-Identity-UCS def /CMapType 2 def",
+        "1 begincodespacerange <0000> <FFFF> endcodespacerange",
+        f"{len(chars)} beginbfchar",
+        *(f"<{ord(c):04X}> <{ord(c):04X}>" for c in chars),
+        "endbfchar endcmap CMapName currentdict /CMap defineresource pop end end",
+    ]).encode("ascii")
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+        b"<< /Type /Font /Subtype /Type0 /BaseFont /STSong-Light /Encoding /Identity-H "
+        b"/DescendantFonts [6 0 R] /ToUnicode 7 0 R >>",
+        b"<< /Type /Font /Subtype /CIDFontType0 /BaseFont /STSong-Light "
+        b"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(cmap), cmap),
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    padding = max(0, size - 2048 - sum(len(o) for o in objects))
+    if padding:
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (padding, rng.randbytes(padding)))
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _fake_pdf(rng, size):
+    """随机内容的PDF占位文件（随机字节压缩不了，大小与真实PDF接近）"""
+    header = b"%PDF-1.4\n"
+    return header + rng.randbytes(max(0, size - len(header)))
+
+
+class _PortalHandler(BaseHTTPRequestHandler):
+    portal = None
+    protocol_version = "HTTP/1.1"
+    # 响应头和正文分两次写出，关闭Nagle避免每个请求多等一个延迟确认
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        portal = self.portal
+        if portal.latency:
+            time.sleep(portal.latency)
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        path = parsed.path
+
+        if path == CARD_LIST_PATH:
+            portal.count_request("card_list")
+            items = "\n".join(
+                _CARD_ITEM.format(href=escape(f"{INVOICE_LIST_PATH}?card={name}"), name=escape(name),
+                                  number=f"4501{i:012d}")
+                for i, name in enumerate(portal.cards, 1)
+            )
+            return self._send_html(_CARD_PAGE.format(cards=items), session=True)
+
+        if path == INVOICE_LIST_PATH:
+            portal.count_request("invoice_list")
+            card = query.get("card", [portal.cards[0]])[0]
+            month = re.sub(r"\D", "", query.get("month", [""])[0])
+            invoices = portal.month_invoices(card, month) if len(month) == 6 else []
+            page_size = int(query.get("pageSize", [portal.page_size or 0])[0] or 0)
+            pager = ""
+            if page_size and invoices:
+                pages = max(1, -(-len(invoices) // page_size))
+                page = min(max(1, int(query.get("pageNo", ["1"])[0])), pages)
+                options = "".join(
+                    f'<option value="{size}"{" selected" if size == page_size else ""}>{size}</option>'
+                    for size in sorted(set(PAGE_SIZE_OPTIONS) | {page_size})
+                )
+                pager = _PAGER.format(total=len(invoices), page=page, pages=pages, options=options,
+                                      prev=page - 1, next=page + 1,
+                                      prev_disabled=" disabled" if page <= 1 else "",
+                                      next_disabled=" disabled" if page >= pages else "")
+                invoices = invoices[(page - 1) * page_size:page * page_size]
+            tables = "\n".join(
+                _INVOICE_TABLE.format(invoice_id=invoice_id, amount=amount, card=escape(card),
+                                      href=f"{DOWNLOAD_PAGE_PATH}{invoice_id}")
+                for invoice_id, amount in invoices
+            )
+            return self._send_html(_LIST_PAGE.format(
+                card=escape(card), card_js=card.replace("\\", "\\\\").replace("'", "\\'"),
+                month=month, tables=tables, pager=pager, page_size=page_size or 20,
+                list_path=INVOICE_LIST_PATH,
+            ))
+
+        if path.startswith(DOWNLOAD_PAGE_PATH):
+            portal.count_request("download_page")
+            invoice_id = path[len(DOWNLOAD_PAGE_PATH):].strip("/")
+            return self._send_html(_DOWNLOAD_PAGE.format(
+                invoice_id=escape(invoice_id), package_href=f"{PACKAGE_PATH}{invoice_id}.zip"
+            ))
+
+        if path.startswith(PACKAGE_PATH) and path.endswith(".zip"):
+            portal.count_request("package")
+            invoice_id = path[len(PACKAGE_PATH):-4]
+            data = portal.package_bytes(invoice_id)
+            filename = f"发票_{invoice_id}.zip"
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Content-Disposition",
+                             f"attachment; filename=\"{invoice_id}.zip\"; filename*=UTF-8''{quote(filename)}")
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_error(404)
+
+    def _send_html(self, html, session=False):
+        body = html.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if session:
+            self.send_header("Set-Cookie", "JSESSIONID=mock-session; Path=/; HttpOnly")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    # 单独运行：python mock_portal.py [端口] [每月发票数]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    portal = MockPortal(invoices_per_month=count, port=port).start()
+    print(f"🧪🧪 模拟票根网已启动: {portal.target_url}（每月 {count} 张发票），按 Ctrl+C 退出")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        portal.stop()
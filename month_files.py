@@ -0,0 +1,168 @@
+import os
+import re
+import time
+
+import invoice_records
+from metrics import METRICS
+from sync_state import save_watermark
+
+
+def card_folder_name(card_name):
+    """卡片名称作为文件夹名，去掉Windows文件名里不允许的字符"""
+    return re.sub(r'[\\/:*?"<>|]', '_', card_name).strip() or '未命名卡片'
+
+
+def unique_path(dest_dir, filename):
+    """与Chrome保持一致，重名时生成 xxx (1).zip；正在下载的 .part 文件也算重名"""
+    base, ext = os.path.splitext(filename)
+    candidate = os.path.join(dest_dir, filename)
+    counter = 1
+    while os.path.exists(candidate) or os.path.exists(candidate + '.part'):
+        candidate = os.path.join(dest_dir, f"{base} ({counter}){ext}")
+        counter += 1
+    return candidate
+
+
+def month_folder_path(base_path, year, month, card_name=None):
+    """月份下载文件夹：<下载目录>/<YYYYMM>，指定卡片时为 <下载目录>/<卡片>/<YYYYMM>"""
+    month_folder = f"{year}{month:02d}"
+    if card_name:
+        return os.path.join(base_path, card_folder_name(card_name), month_folder)
+    return os.path.join(base_path, month_folder)
+
+
+def write_amount_report(year, month, download_path, total_amount, invoice_details, success_count, total_count,
+                        page_summary=None, pacing=None):
+    """
+    生成金额统计文件
+
+    :param page_summary: ResultPageWalker.summary()，每页读取的条数
+    :param pacing: {'rate': 限速器统计, 'retried', 'retry_count', 'recovered', 'failures'}，下载速率和重试情况
+    """
+    try:
+        # 创建统计文件名
+        report_filename = f"{year}{month:02d}_发票统计.txt"
+        report_filepath = os.path.join(download_path, report_filename)
+
+        with open(report_filepath, 'w', encoding='utf-8') as f:
+            f.write(f"发票统计报告 - {year}年{month:02d}月\n")
+            f.write("=" * 50 + "\n")
+            f.write(f"统计时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+            f.write(f"发票总数: {total_count} 张\n")
+            f.write(f"下载成功: {success_count} 张\n")
+            f.write(f"下载失败: {total_count - success_count} 张\n")
+            f.write(f"开票总金额: ￥{total_amount:.2f}\n")
+            if page_summary and (len(page_summary['pages']) > 1 or page_summary['stated_total'] is not None):
+                # 每页读到的条数和页面显示的总条数，方便核对有没有漏读
+                stated = page_summary['stated_total']
+                f.write(f"结果分页: {len(page_summary['pages'])} 页，读取 {page_summary['rows']} 条，"
+                        f"页面显示共 {stated if stated is not None else '未知'} 条\n")
+                for page in page_summary['pages']:
+                    f.write(f"  第{page['page']}页: {page['rows']} 条\n")
+                if stated is not None and stated != page_summary['rows']:
+                    f.write("⚠️ 读取条数与页面显示总数不一致，可能有发票未读取\n")
+            if pacing:
+                write_pacing(f, pacing)
+            f.write("\n" + "=" * 50 + "\n")
+            f.write("发票明细:\n")
+            f.write("-" * 50 + "\n")
+
+            for detail in invoice_details:
+                line = f"第{detail['index']}张发票: ￥{detail['amount']:.2f} - {detail['status']}"
+                if detail.get('filename'):
+                    line += f" ({detail['filename']}, {detail['bytes'] / 1024:.1f} KB, 用时 {detail['duration']:.2f}s)"
+                f.write(line + "\n")
+
+        print(f"📄📄📄📄 金额统计文件已生成: {report_filepath}")
+        return True
+
+    except Exception as e:
+        print(f"❌❌❌❌ 生成金额统计文件失败: {e}")
+        return False
+
+
+def month_summary(year, month, month_path, total_count, success_count, total_amount, stated_total=None,
+                  pacing=None, card_name=None, **extra):
+    """本次运行里一个月份的汇总（月份列表、并行下载汇总文件使用）"""
+    summary = {
+        'card': card_name,
+        'year': year,
+        'month': month,
+        'path': month_path,
+        'total_count': total_count,
+        'success_count': success_count,
+        'total_amount': total_amount,
+        'stated_total': stated_total,
+        'retry_count': pacing['retry_count'] if pacing else 0,
+        'failures': pacing['failures'] if pacing else [],
+    }
+    summary.update(extra)
+    return summary
+
+
+def skip_month(year, month, month_path, watermark, card_name=None, label=""):
+    """同步模式下没有新发票的月份：不翻页、不下载，汇总沿用上次同步的结果"""
+    print(f"⏭⏭ {label}{year}年{month:02d}月 - 没有新发票（共 {watermark['total_count']} 张，"
+          f"与 {watermark['synced']} 同步时一致），跳过")
+    METRICS.incr('sync_months_skipped')
+    return month_summary(year, month, month_path, watermark['total_count'], watermark['success_count'],
+                         watermark['total_amount'], watermark['stated_total'], card_name=card_name, skipped=True)
+
+
+def complete_month(base_path, year, month, month_path, total_amount, invoice_details, success_count, total_count,
+                   page_summary=None, pacing=None, probe=None, card_name=None, label="", latencies=None):
+    """
+    月份处理结束的收尾（浏览器、HTTP直连和异步核心共用）：记录同步水位、生成统计文件、
+    写出CSV/JSON-lines明细和累计记录、打印结果。
+
+    :param base_path: 下载根目录（累计记录放在这里）
+    :param page_summary: 每页读取的条数，complete 表示最后一页也读完了
+    :param pacing: 下载速率和重试情况
+    :param probe: 第一页的快照（sync_state.sync_probe），为 None 时不记录水位
+    :param latencies: 每张发票的下载用时，用于打印平均和最慢用时
+    :return: 月份汇总（month_summary）
+    """
+    stated_total = page_summary['stated_total'] if page_summary else None
+    if probe is not None:
+        save_watermark(month_path, probe, total_count, success_count, total_amount,
+                       bool(page_summary and page_summary.get('complete')))
+    with METRICS.span("generate_amount_report"):
+        write_amount_report(year, month, month_path, total_amount, invoice_details, success_count, total_count,
+                            page_summary, pacing)
+    invoice_records.record_month(base_path, year, month, month_path, invoice_details, card_name)
+
+    METRICS.incr('invoices_total', total_count)
+    METRICS.incr('invoices_downloaded', success_count)
+    print(f"\n📊📊📊📊 {label}{year}年{month:02d}月 - 下载完成!")
+    print(f"   成功: {success_count} 张")
+    print(f"   失败: {total_count - success_count} 张")
+    print(f"   总金额: ￥{total_amount:.2f}")
+    if latencies:
+        latencies = sorted(latencies)
+        print(f"   每张发票平均用时: {sum(latencies) / len(latencies):.2f}s (最慢 {latencies[-1]:.2f}s)")
+    if pacing:
+        rate = pacing['rate']
+        print(f"   下载速率: {rate['rate']:.2f} 次/秒，退避 {rate['backoffs']} 次，"
+              f"重试 {pacing['retry_count']} 次（成功 {len(pacing['recovered'])} 张）")
+        for index, error, attempts in pacing['failures']:
+            print(f"   ❌ 第 {index} 张发票最终失败: {error}（下载 {attempts} 次）")
+    if stated_total is not None and stated_total != total_count:
+        print(f"⚠️ 读取到 {total_count} 张，页面显示共 {stated_total} 张，可能有发票未读取")
+    return month_summary(year, month, month_path, total_count, success_count, total_amount, stated_total,
+                         pacing, card_name)
+
+
+def write_pacing(f, pacing):
+    """统计文件里的下载速率、重试次数和最终失败列表"""
+    rate = pacing.get('rate')
+    if rate:
+        f.write(f"下载速率: 当前 {rate['rate']:.2f} 次/秒（本次最低 {rate['lowest_rate']:.2f}，"
+                f"最高 {rate['highest_rate']:.2f}），各请求累计限速等待 {rate['waited']:.1f}s，退避 {rate['backoffs']} 次\n")
+    if pacing.get('retried'):
+        f.write(f"重试: {len(pacing['retried'])} 张发票共重试 {pacing['retry_count']} 次，"
+                f"重试成功 {len(pacing['recovered'])} 张\n")
+    failures = pacing.get('failures') or []
+    if failures:
+        f.write(f"最终失败: {len(failures)} 张\n")
+        for index, error, attempts in failures:
+            f.write(f"  第{index}张发票: {error}（下载 {attempts} 次）\n")
@@ -0,0 +1,50 @@
+import re
+
+
+def parse_month_input(month_str):
+    """解析月份输入，支持多种格式"""
+    month_str = month_str.strip()
+    
+    # 格式1: YYYYMM (如 202410)
+    if len(month_str) == 6 and month_str.isdigit():
+        year = int(month_str[:4])
+        month = int(month_str[4:6])
+        return year, month
+    
+    # 格式2: YYYY-MM (如 2024-10)
+    elif '-' in month_str:
+        parts = month_str.split('-')
+        if len(parts) == 2 and all(part.isdigit() for part in parts):
+            year = int(parts[0])
+            month = int(parts[1])
+            return year, month
+    
+    # 格式3: YYYY年M月 (如 2024年10月)
+    elif '年' in month_str and '月' in month_str:
+        year_str = month_str.split('年')[0]
+        month_str_clean = month_str.split('年')[1].replace('月', '')
+        if year_str.isdigit() and month_str_clean.isdigit():
+            year = int(year_str)
+            month = int(month_str_clean)
+            return year, month
+    
+    raise ValueError(f"无法解析的月份格式: {month_str}")
+
+def get_month_range(start_year, start_month, end_year, end_month):
+    """生成月份范围列表"""
+    months = []
+    current_year, current_month = start_year, start_month
+    
+    while (current_year < end_year) or (current_year == end_year and current_month <= end_month):
+        months.append((current_year, current_month))
+        
+        current_month += 1
+        if current_month > 12:
+            current_month = 1
+            current_year += 1
+    
+    return months
+
+def split_month_list(month_input):
+    """把“202410,202411 202412”这样的输入按逗号、空格、分号拆开"""
+    return [part for part in re.split(r'[,，;；\s]+', month_input.strip()) if part]
@@ -1,5 +1,25 @@
 import os
+import io
+import re
+import time
+import shutil
+import tempfile
+import zlib
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from metrics import METRICS
+from extract_index import ExtractIndex, STATUS_DONE, STATUS_EXTRACTING, STATUS_FAILED
+from download_manifest import DownloadManifest, STATE_FAILED, MANIFEST_FILENAME
+
+# 写文件时使用的拷贝缓冲区大小
+COPY_BUFFER_SIZE = 1024 * 1024
+# 内层zip不超过这个大小时直接在内存中打开，超过则溢出到临时文件
+INNER_ZIP_MEMORY_LIMIT = 64 * 1024 * 1024
+# 月份文件夹名 YYYYMM；多卡片下载时的目录结构为 <卡片>/<YYYYMM>
+MONTH_FOLDER = re.compile(r'^\d{6}$')
+# 月份文件夹下存放损坏压缩包的文件夹（. 开头，扫描、建索引、对账时都会跳过）
+QUARANTINE_FOLDER = '.quarantine'
 
 def extract_zip_skip_transpdf(zip_path, extract_to_dir):
     """
@@ -40,28 +60,319 @@ def process_inner_zips(main_folder_path):
             # 解压这个内部zip文件（跳过trans.pdf）到主文件夹
             extract_zip_skip_transpdf(item_full_path, main_folder_path)
 
-def main(target_directory):
+def _member_target_path(extract_to_dir, member_name):
     """
-    主处理函数：遍历目标目录的子目录，处理每个子目录中的zip文件。
+    计算压缩包成员的落盘路径，去掉盘符、绝对路径和 '..'，防止写到目标目录之外。
+    """
+    parts = []
+    for part in member_name.replace('\\', '/').split('/'):
+        part = os.path.splitdrive(part)[1]
+        if part in ('', '.', '..'):
+            continue
+        parts.append(part)
+    if not parts:
+        return None
+    return os.path.join(extract_to_dir, *parts)
+
+def _write_member(zip_ref, file_info, extract_to_dir, stats):
+    """把一个成员用大缓冲区直接从压缩流写到磁盘"""
+    target_path = _member_target_path(extract_to_dir, file_info.filename)
+    if target_path is None:
+        return
+    if file_info.is_dir():
+        os.makedirs(target_path, exist_ok=True)
+        return
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with zip_ref.open(file_info) as src, open(target_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    stats['files'] += 1
+    stats['bytes'] += file_info.file_size
+
+def _open_inner_zip(outer_zip, file_info):
+    """
+    直接从外层压缩包里打开内层zip，不先解压到磁盘。
+    小文件读入内存，大文件溢出到临时文件，内存占用有上限。
+    """
+    if file_info.file_size <= INNER_ZIP_MEMORY_LIMIT:
+        return io.BytesIO(outer_zip.read(file_info))
+    buffer = tempfile.SpooledTemporaryFile(max_size=INNER_ZIP_MEMORY_LIMIT)
+    with outer_zip.open(file_info) as src:
+        shutil.copyfileobj(src, buffer, COPY_BUFFER_SIZE)
+    buffer.seek(0)
+    return buffer
+
+def extract_nested_zip_streaming(zip_path, extract_to_dir):
+    """
+    流式解压外层zip：内层zip直接从外层压缩流中打开并解压到目标目录，
+    不再把内层zip落盘后再读回来，也不会留下内层zip文件。所有 'trans.pdf' 都会被跳过。
     
-    :param target_directory: 需要处理的目录路径
+    :param zip_path: 外层zip文件路径（或已读入内存的文件对象）
+    :param extract_to_dir: 解压目标目录
+    :return: 统计信息 dict(files, skipped, bytes, elapsed, errors)
+    :raise zipfile.BadZipFile: 压缩包被截断或CRC不一致（内层zip里的成员也会核对）
     """
-    # 检查目标目录是否存在
-    if not os.path.exists(target_directory):
-        print(f"错误：目录 '{target_directory}' 不存在。")
+    stats = {'files': 0, 'skipped': 0, 'bytes': 0, 'elapsed': 0.0, 'errors': []}
+    started = time.perf_counter()
+    with zipfile.ZipFile(zip_path, 'r') as outer_zip:
+        for file_info in outer_zip.infolist():
+            name = os.path.basename(file_info.filename.rstrip('/'))
+            if name == 'trans.pdf':
+                stats['skipped'] += 1
+                continue
+            
+            # 外层根目录下的内层zip，和原来一样解压到目标目录根部
+            is_inner_zip = (not file_info.is_dir() and name.lower().endswith('.zip')
+                            and '/' not in file_info.filename.strip('/'))
+            if not is_inner_zip:
+                _write_member(outer_zip, file_info, extract_to_dir, stats)
+                continue
+            
+            # 读出内层zip时 zipfile 会核对它在外层的CRC，外层损坏时直接抛出 BadZipFile
+            with _open_inner_zip(outer_zip, file_info) as buffer:
+                try:
+                    inner_zip = zipfile.ZipFile(buffer)
+                except zipfile.BadZipFile:
+                    # 内层文件不是有效的zip时，按普通文件原样保存
+                    stats['errors'].append(f"内部文件不是有效的ZIP文件或已损坏 - {file_info.filename}")
+                    _write_member(outer_zip, file_info, extract_to_dir, stats)
+                    continue
+                with inner_zip:
+                    for inner_info in inner_zip.infolist():
+                        if os.path.basename(inner_info.filename) == 'trans.pdf':
+                            stats['skipped'] += 1
+                            continue
+                        _write_member(inner_zip, inner_info, extract_to_dir, stats)
+    stats['elapsed'] = time.perf_counter() - started
+    return stats
+
+def expected_outputs(zip_path):
+    """
+    列出流式解压后应当生成的文件及大小（只读目录，不解压文件内容），
+    用来判断之前留下的同名文件夹是否解压完整。
+    
+    :return: {相对路径: 文件大小}
+    """
+    outputs = {}
+    with zipfile.ZipFile(zip_path, 'r') as outer_zip:
+        for file_info in outer_zip.infolist():
+            name = os.path.basename(file_info.filename.rstrip('/'))
+            if name == 'trans.pdf' or file_info.is_dir():
+                continue
+            if name.lower().endswith('.zip') and '/' not in file_info.filename.strip('/'):
+                try:
+                    with _open_inner_zip(outer_zip, file_info) as buffer, zipfile.ZipFile(buffer) as inner_zip:
+                        for inner_info in inner_zip.infolist():
+                            if inner_info.is_dir() or os.path.basename(inner_info.filename) == 'trans.pdf':
+                                continue
+                            outputs[inner_info.filename] = inner_info.file_size
+                    continue
+                except zipfile.BadZipFile:
+                    pass
+            outputs[file_info.filename] = file_info.file_size
+    return outputs
+
+def outputs_complete(zip_path, folder_path):
+    """检查同名文件夹里是否已有全部解压结果"""
+    try:
+        for member_name, size in expected_outputs(zip_path).items():
+            target_path = _member_target_path(folder_path, member_name)
+            if target_path is None:
+                continue
+            if not os.path.isfile(target_path) or os.path.getsize(target_path) != size:
+                return False
+        return True
+    except Exception:
+        return False
+
+def _drain_member(zip_ref, file_info):
+    """读完一个成员但不写盘；读到末尾时 zipfile 会核对CRC，不一致时抛出 BadZipFile"""
+    with zip_ref.open(file_info) as src:
+        while src.read(COPY_BUFFER_SIZE):
+            pass
+
+def verify_archive(zip_path):
+    """
+    检查已下载的压缩包是否完整（verify 命令使用）：中央目录能读出来，每个成员（包括内层zip里的成员）
+    解压后的CRC都与目录一致。整个压缩包只流式读一遍，不写磁盘。
+    解压时不需要先调用它：extract_archive_task 在解压过程中就会发现同样的损坏。
+    
+    :param zip_path: 外层zip文件路径
+    :return: None 表示完好，否则为错误说明
+    """
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as outer_zip:
+            for file_info in outer_zip.infolist():
+                if file_info.is_dir():
+                    continue
+                name = os.path.basename(file_info.filename)
+                is_inner_zip = name.lower().endswith('.zip') and '/' not in file_info.filename.strip('/')
+                if not is_inner_zip:
+                    _drain_member(outer_zip, file_info)
+                    continue
+                # 读出内层zip时已经核对了它在外层的CRC
+                with _open_inner_zip(outer_zip, file_info) as buffer:
+                    try:
+                        inner_zip = zipfile.ZipFile(buffer)
+                    except zipfile.BadZipFile:
+                        # 与解压时一样，内层文件不是zip时按普通文件保存
+                        continue
+                    with inner_zip:
+                        for inner_info in inner_zip.infolist():
+                            if not inner_info.is_dir():
+                                _drain_member(inner_zip, inner_info)
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        return f"压缩包不完整或已损坏（{e}）"
+    return None
+
+def quarantine_archive(zip_path, error, store=None, digest=None):
+    """
+    隔离损坏的压缩包：移到月份文件夹下的 .quarantine/，删掉以前解压失败留下的空文件夹，
+    并把下载清单里对应的发票改回失败，下次运行（或同步）时会重新下载。
+    
+    :param zip_path: 损坏的压缩包
+    :param error: 损坏原因（verify_archive 或解压时的错误说明）
+    :param store: BlobStore；损坏的内容已经放进存储时一并删除，不会再链接到别的文件夹
+    :param digest: 压缩包的SHA-256，不知道时从下载清单里取
+    :return: 隔离后的路径，移动失败时返回 None
+    """
+    month_path = os.path.dirname(os.path.abspath(zip_path))
+    name = os.path.basename(zip_path)
+    target = os.path.join(month_path, QUARANTINE_FOLDER, f"{time.strftime('%Y%m%d%H%M%S')}_{name}")
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(zip_path, target)
+    except OSError as e:
+        print(f"错误：无法隔离损坏的压缩包 {name}: {e}")
+        return None
+    METRICS.incr('archives_quarantined')
+
+    folder_path = zip_path[:-4]
+    if os.path.isdir(folder_path) and not any(files for _, _, files in os.walk(folder_path)):
+        shutil.rmtree(folder_path, ignore_errors=True)
+
+    requeued = 0
+    if os.path.exists(os.path.join(month_path, MANIFEST_FILENAME)):
+        manifest = DownloadManifest(month_path)
+        for key, entry in list(manifest.invoices.items()):
+            if entry.get('file') != name:
+                continue
+            digest = digest or entry.get('sha256')
+            manifest.mark(key, STATE_FAILED, error=error,
+                          quarantined=os.path.relpath(target, month_path).replace('\\', '/'))
+            requeued += 1
+    if store is not None and digest:
+        store.discard(digest)
+    print(f"已隔离损坏的压缩包: {name} -> {QUARANTINE_FOLDER}/{os.path.basename(target)}"
+          + (f"，{requeued} 张发票下次运行时重新下载" if requeued else ""))
+    return target
+
+def file_crc32(path):
+    """计算整个文件的CRC32（十六进制）"""
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return f"{crc:08x}"
+
+def _format_speed(stats):
+    """格式化写盘速度"""
+    mb = stats['bytes'] / (1024 * 1024)
+    speed = mb / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+    return f"{mb:.2f} MB, {speed:.2f} MB/s"
+
+def _load_archive(zip_path):
+    """
+    读入压缩包并计算整个文件的CRC32。不超过内存上限的压缩包一次读进内存，CRC和解压都用这一份数据；
+    更大的压缩包单独算CRC（只读不解压），解压时再从文件读取。
+
+    :return: (zipfile 可以打开的路径或文件对象, CRC32十六进制)
+    """
+    if os.path.getsize(zip_path) > INNER_ZIP_MEMORY_LIMIT:
+        return zip_path, file_crc32(zip_path)
+    with open(zip_path, 'rb') as f:
+        data = f.read()
+    return io.BytesIO(data), f"{zlib.crc32(data):08x}"
+
+def _staging_folder(folder_path):
+    """解压用的临时文件夹：与目标文件夹在同一目录，. 开头（扫描、建索引、对账时都会跳过）"""
+    parent, name = os.path.split(folder_path)
+    return os.path.join(parent, f".{name}.extracting")
+
+def _move_into_place(staging, folder_path):
+    """解压成功后把临时文件夹改名为目标文件夹；目标文件夹已存在时（以前没解压完）逐个文件覆盖进去"""
+    if not os.path.isdir(folder_path):
+        os.rename(staging, folder_path)
         return
+    for dirpath, _, filenames in os.walk(staging):
+        target_dir = os.path.join(folder_path, os.path.relpath(dirpath, staging))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in filenames:
+            os.replace(os.path.join(dirpath, name), os.path.join(target_dir, name))
 
-    print(f"开始处理目录: {target_directory}")
+def extract_archive_task(zip_path, folder_path):
+    """
+    解压单个下载的压缩包（可在子进程中运行）。不打印输出，结果以dict返回，由调用方汇总。
     
+    压缩包只读一遍：文件CRC32在读入时计算，解压先写到临时文件夹，全部成功后才改名为目标文件夹。
+    下载中断、被截断或CRC不一致的压缩包在解压过程中就会发现，删掉临时文件夹，不会留下空的或不完整的文件夹。
+    
+    :param zip_path: 外层zip文件路径
+    :param folder_path: 同名目标文件夹
+    :return: dict(zip, folder, files, skipped, bytes, elapsed, errors)，
+             压缩包损坏时还有 corrupt=True，此时不会创建目标文件夹
+    """
+    result = {'zip': zip_path, 'folder': folder_path, 'crc32': None,
+              'files': 0, 'skipped': 0, 'bytes': 0, 'elapsed': 0.0, 'errors': []}
+    staging = _staging_folder(folder_path)
+    try:
+        source, result['crc32'] = _load_archive(zip_path)
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        stats = extract_nested_zip_streaming(source, staging)
+        _move_into_place(staging, folder_path)
+        result.update(stats)
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        result['errors'].append(f"压缩包不完整或已损坏（{e}） - {zip_path}")
+        result['corrupt'] = True
+    except Exception as e:
+        result['errors'].append(f"解压 {zip_path} 时发生错误: {e}")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return result
+
+def iter_archive_dirs(target_directory):
+    """
+    列出存放下载压缩包的文件夹：目标目录的每个子目录，
+    以及按卡片分开保存时卡片文件夹下的月份文件夹（<卡片>/<YYYYMM>）。
+    
+    :return: 生成器，产出 os.DirEntry
+    """
+    with os.scandir(target_directory) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            yield entry
+            if MONTH_FOLDER.match(entry.name):
+                continue
+            with os.scandir(entry.path) as children:
+                for child in sorted(children, key=lambda e: e.name):
+                    if child.is_dir() and MONTH_FOLDER.match(child.name):
+                        yield child
+
+def find_pending_archives(target_directory):
+    """
+    找出目标目录各子目录下还没有同名文件夹的zip文件。
+    
+    :return: [(zip_path, folder_path), ...]
+    """
+    tasks = []
     # 遍历目标目录下的所有子目录
-    for entry in os.listdir(target_directory):
-        entry_path = os.path.join(target_directory, entry)
-        
-        # 只处理子目录，跳过文件
-        if not os.path.isdir(entry_path):
-            continue
-            
-        print(f"处理子目录: {entry}")
+    for dir_entry in iter_archive_dirs(target_directory):
+        entry_path = dir_entry.path
+        print(f"处理子目录: {os.path.relpath(entry_path, target_directory)}")
         
         # 遍历子目录下的所有项
         for file_entry in os.listdir(entry_path):
@@ -73,28 +384,290 @@ def main(target_directory):
                 folder_name = file_entry[:-4]  # 移除 .zip 后缀
                 folder_path = os.path.join(entry_path, folder_name)
 
-                # 如果同名文件夹已存在，提示并跳过（避免覆盖）
-                if os.path.exists(folder_path):
+                # 如果同名文件夹已存在，提示并跳过（避免覆盖）；以前解压失败留下的空文件夹不算
+                if os.path.exists(folder_path) and (not os.path.isdir(folder_path) or os.listdir(folder_path)):
                     print(f"注意：文件夹已存在，跳过处理 '{file_entry}' -> '{folder_name}'")
                     continue
 
-                # 创建同名文件夹
-                os.makedirs(folder_path)
-                print(f"创建文件夹: {folder_path}")
+                tasks.append((file_entry_path, folder_path))
+    return tasks
 
-                # 首先，将外层zip文件解压到刚创建的同名文件夹
-                try:
-                    with zipfile.ZipFile(file_entry_path, 'r') as outer_zip:
-                        outer_zip.extractall(folder_path)
-                    print(f"已解压外层压缩包: {file_entry} -> {folder_name}")
-                except Exception as e:
-                    print(f"解压外层压缩包 {file_entry} 时出错: {e}")
-                    continue  # 如果外层解压失败，跳过该zip的后续处理
+def find_changed_archives(target_directory, index):
+    """
+    借助解压索引找出需要处理的压缩包：新增的、内容变化的、上次没解压完或失败的。
+    没有变化的月份文件夹直接跳过，不再 listdir。
+    
+    :return: (tasks, scanned_dirs)，tasks 为 [(zip_path, folder_path, stat_result), ...]
+    """
+    tasks = []
+    scanned_dirs = []
+    for entry in iter_archive_dirs(target_directory):
+        if index.dir_unchanged(entry.path, entry.stat().st_mtime_ns):
+            continue
+        
+        print(f"处理子目录: {os.path.relpath(entry.path, target_directory)}")
+        scanned_dirs.append(entry.path)
+        with os.scandir(entry.path) as files:
+            for file_entry in files:
+                if not file_entry.is_file() or not file_entry.name.lower().endswith('.zip'):
+                    continue
+                stat_result = file_entry.stat()
+                if index.is_done(file_entry.path, stat_result):
+                    continue
+                
+                folder_path = os.path.join(entry.path, file_entry.name[:-4])
+                record = index.get(file_entry.path)
+                if record is None and os.path.exists(folder_path):
+                    # 旧版本留下的文件夹：解压完整就直接登记，不完整则重新解压
+                    if outputs_complete(file_entry.path, folder_path):
+                        index.mark(file_entry.path, folder_path, STATUS_DONE, stat_result)
+                        continue
+                    print(f"注意：文件夹 '{file_entry.name[:-4]}' 解压不完整，重新解压")
+                elif record is not None and record['status'] != STATUS_DONE:
+                    print(f"注意：上次未完成解压，继续处理 '{file_entry.name}'")
+                tasks.append((file_entry.path, folder_path, stat_result))
+    return tasks, scanned_dirs
+
+def _extract_legacy(zip_path, folder_path):
+    """原来的两步解压：先把外层zip解压到磁盘，再解压其中的内层zip"""
+    os.makedirs(folder_path, exist_ok=True)
+    print(f"创建文件夹: {folder_path}")
+
+    # 首先，将外层zip文件解压到刚创建的同名文件夹
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as outer_zip:
+            outer_zip.extractall(folder_path)
+        print(f"已解压外层压缩包: {os.path.basename(zip_path)} -> {os.path.basename(folder_path)}")
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        # 压缩包损坏：删掉解压了一半的文件夹（find_pending_archives 只交来不存在或空的文件夹）
+        print(f"错误：压缩包不完整或已损坏（{e}） - {zip_path}")
+        shutil.rmtree(folder_path, ignore_errors=True)
+        quarantine_archive(zip_path, f"压缩包不完整或已损坏（{e}）")
+        return
+    except Exception as e:
+        print(f"解压外层压缩包 {os.path.basename(zip_path)} 时出错: {e}")
+        return  # 如果外层解压失败，跳过该zip的后续处理
+
+    # 然后，处理这个刚解压出来的同名文件夹里的内部zip文件
+    process_inner_zips(folder_path)
+
+def run_extract_tasks(tasks, workers=1):
+    """
+    执行解压任务。workers 大于1时用进程池并行解压（解压是CPU密集型，线程无法并行）。
+    
+    :param tasks: [(zip_path, folder_path), ...]
+    :param workers: 进程数，None 表示使用全部CPU核心
+    :return: 每个压缩包的结果列表
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+
+    results = []
+    if workers == 1:
+        for zip_path, folder_path in tasks:
+            results.append(extract_archive_task(zip_path, folder_path))
+            record_extract_metrics(results[-1])
+            _print_result(results[-1])
+        return results
+
+    print(f"使用 {workers} 个进程并行解压 {len(tasks)} 个压缩包")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(extract_archive_task, zip_path, folder_path) for zip_path, folder_path in tasks]
+        for future in as_completed(futures):
+            results.append(future.result())
+            record_extract_metrics(results[-1])
+            _print_result(results[-1])
+    return results
+
+def record_extract_metrics(result):
+    """子进程里的耗时在父进程汇总"""
+    METRICS.observe('extract_archive', result['elapsed'], error='failed' if result['errors'] else None)
+    METRICS.incr('archives_extracted')
+    METRICS.incr('bytes_extracted', result['bytes'])
+    METRICS.incr('extract_errors', len(result['errors']))
+
+def _print_result(result):
+    name = os.path.basename(result['zip'])
+    if result.get('reused'):
+        print(f"已复用内容相同的压缩包的解压结果: {name} -> {os.path.basename(result['folder'])}，"
+              f"{result['files']} 个文件（硬链接，未重新解压）")
+        return
+    for error in result['errors']:
+        print(f"错误：{error}")
+    if result['files'] or not result['errors']:
+        print(f"已解压（跳过trans.pdf）: {name} -> {os.path.basename(result['folder'])}，"
+              f"{result['files']} 个文件，{_format_speed(result)}")
+
+def _run_indexed(target_directory, index, store, workers):
+    """
+    按索引增量解压，并把每个压缩包的结果写回索引。内容相同的压缩包只解压一份：
+    以前已经解压过的直接链接那份结果；同一批里重复的（例如一起下载的 x.zip 和 x (1).zip）
+    先解压其中一个，其余等它登记进存储后再链接。
+    """
+    changed, scanned_dirs = find_changed_archives(target_directory, index)
+    stats_by_zip = {}
+    digests = {}
+    reused = []
+    tasks = []
+    duplicates = []
+    extracting = set()
+    for zip_path, folder_path, stat_result in changed:
+        index.mark(zip_path, folder_path, STATUS_EXTRACTING, stat_result)
+        stats_by_zip[zip_path] = stat_result
+        digests[zip_path], result = store.reuse_extraction(zip_path, folder_path)
+        if result:
+            _print_result(result)
+            reused.append(result)
+        elif digests[zip_path] in extracting:
+            duplicates.append((zip_path, folder_path))
+        else:
+            extracting.add(digests[zip_path])
+            tasks.append((zip_path, folder_path))
+
+    failed_dirs = set()
+
+    def finish(result):
+        status = STATUS_FAILED if result['errors'] and not result['files'] else STATUS_DONE
+        stat_result = stats_by_zip[result['zip']]
+        if store.add_extraction(digests[result['zip']], result):
+            stat_result = None
+        index.mark(result['zip'], result['folder'], status, stat_result,
+                   crc32=result['crc32'], files=result['files'],
+                   error='; '.join(result['errors']) or None)
+        if status == STATUS_FAILED:
+            failed_dirs.add(os.path.dirname(result['zip']))
+        if result.get('corrupt'):
+            quarantine_archive(result['zip'], result['errors'][0], store, digests[result['zip']])
+
+    results = reused + run_extract_tasks(tasks, workers)
+    for result in results:
+        finish(result)
+
+    # 同一批里的重复压缩包：链接刚解压好的那份；那份解压失败时各自解压
+    retry = []
+    for zip_path, folder_path in duplicates:
+        _, result = store.reuse_extraction(zip_path, folder_path, digests[zip_path])
+        if result:
+            _print_result(result)
+            results.append(result)
+            finish(result)
+        else:
+            retry.append((zip_path, folder_path))
+    for result in run_extract_tasks(retry, workers):
+        results.append(result)
+        finish(result)
+
+    # 文件夹里全部成功后才记录修改时间；有失败的下次继续扫描
+    for dir_path in scanned_dirs:
+        if dir_path in failed_dirs:
+            index.forget_dir(dir_path)
+        else:
+            index.mark_dir(dir_path)
+    return results
+
+def _verify_task(zip_path):
+    return zip_path, verify_archive(zip_path)
+
+@METRICS.timed('verify_tree')
+def verify_tree(target_directory, workers=None):
+    """
+    用进程池并行检查目标目录下所有下载的压缩包（不写磁盘），隔离损坏的，下次运行时重新下载。
+    用于检查以前下载的目录：新下载的压缩包在解压过程中已经会自动检查。
+    
+    :param workers: 进程数，None 表示使用全部CPU核心
+    :return: [(zip_path, error), ...] 损坏的压缩包
+    """
+    zip_paths = []
+    for entry in iter_archive_dirs(target_directory):
+        with os.scandir(entry.path) as files:
+            zip_paths += sorted(f.path for f in files if f.is_file() and f.name.lower().endswith('.zip'))
+    if not zip_paths:
+        print("没有需要检查的压缩包")
+        return []
+
+    started = time.perf_counter()
+    workers = max(1, min(workers or os.cpu_count() or 1, len(zip_paths)))
+    print(f"使用 {workers} 个进程检查 {len(zip_paths)} 个压缩包")
+    corrupt = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for zip_path, error in pool.map(_verify_task, zip_paths, chunksize=8):
+            if error:
+                print(f"错误：{error} - {zip_path}")
+                corrupt.append((zip_path, error))
+
+    if corrupt:
+        # blob_store 依赖本模块，用到时才导入，避免两个模块互相导入
+        from blob_store import BlobStore
+        index = ExtractIndex(target_directory)
+        store = BlobStore(target_directory)
+        try:
+            for zip_path, error in corrupt:
+                index.mark(zip_path, zip_path[:-4], STATUS_FAILED, error=error)
+                index.forget_dir(os.path.dirname(zip_path))
+                quarantine_archive(zip_path, error, store)
+        finally:
+            index.close()
+            store.close()
+    print(f"检查完成: {len(zip_paths)} 个压缩包，损坏 {len(corrupt)} 个，"
+          f"用时 {time.perf_counter() - started:.1f}s")
+    return corrupt
+
+@METRICS.timed('extract_tree')
+def main(target_directory, streaming=True, workers=1, use_index=True):
+    """
+    主处理函数：遍历目标目录的子目录，处理每个子目录中的zip文件。
+    
+    :param target_directory: 需要处理的目录路径
+    :param streaming: True 时使用流式解压（内层zip不落盘），False 时使用原来的两步解压
+    :param workers: 流式解压时的并行进程数，None 表示使用全部CPU核心
+    :param use_index: 流式解压时使用解压索引，只处理新增、变化或未完成的压缩包；
+                      同时使用去重存储，内容相同的压缩包和PDF只保留一份（硬链接）
+    :return: 流式解压时返回每个压缩包的结果列表
+    """
+    # 检查目标目录是否存在
+    if not os.path.exists(target_directory):
+        print(f"错误：目录 '{target_directory}' 不存在。")
+        return []
+
+    print(f"开始处理目录: {target_directory}")
+    started = time.perf_counter()
 
-                # 然后，处理这个刚解压出来的同名文件夹里的内部zip文件
-                process_inner_zips(folder_path)
+    if not streaming:
+        for zip_path, folder_path in find_pending_archives(target_directory):
+            _extract_legacy(zip_path, folder_path)
+        print("处理完成。")
+        return []
 
+    if not use_index:
+        results = run_extract_tasks(find_pending_archives(target_directory), workers)
+        for result in results:
+            if result.get('corrupt'):
+                quarantine_archive(result['zip'], result['errors'][0])
+    else:
+        from blob_store import BlobStore
+        index = ExtractIndex(target_directory)
+        store = BlobStore(target_directory)
+        try:
+            results = _run_indexed(target_directory, index, store, workers)
+        finally:
+            index.close()
+            store.close()
+    totals = {
+        'files': sum(r['files'] for r in results),
+        'skipped': sum(r['skipped'] for r in results),
+        'bytes': sum(r['bytes'] for r in results),
+        # 并行时按墙钟时间计算吞吐量
+        'elapsed': time.perf_counter() - started,
+    }
+    errors = sum(len(r['errors']) for r in results)
+    if not results:
+        print(f"没有需要解压的新压缩包（用时 {totals['elapsed'] * 1000:.0f} ms）")
+    else:
+        print(f"共处理 {len(results)} 个压缩包，写入 {totals['files']} 个文件，"
+              f"跳过 {totals['skipped']} 个trans.pdf，错误 {errors} 个，{_format_speed(totals)}")
     print("处理完成。")
+    return results
 
 # 使用示例
 if __name__ == "__main__":
@@ -102,4 +675,5 @@ if __name__ == "__main__":
     path_to_scan = input("请输入要处理的目录路径（留空则为当前目录）: ").strip()
     if not path_to_scan:
         path_to_scan = os.getcwd()
-    main(path_to_scan)
\ No newline at end of file
+    main(path_to_scan)
+    METRICS.export(path_to_scan)
@@ -0,0 +1,183 @@
+import json
+
+# 页面脚本：selenium 的 execute_script 和异步核心的 CDP Runtime.evaluate 共用。
+# 脚本按 execute_script 的写法编写（用 arguments 取参数、用 return 返回结果），
+# 通过 CDP 执行时用 call_js 包装成立即执行的函数。
+
+
+def call_js(script, *args):
+    """把 execute_script 风格的脚本和参数包装成 Runtime.evaluate 可以执行的表达式"""
+    return f"(function () {{\n{script}\n}}).apply(null, {json.dumps(list(args), ensure_ascii=False)})"
+
+
+# 读取卡片列表页上所有卡片的名称：卡片通常是 <a><dl><dt>卡片名</dt>...</dl></a>
+LIST_CARDS_JS = """
+function textOf(el) { return el ? (el.innerText || el.textContent || '').trim() : ''; }
+var names = [];
+var anchors = document.querySelectorAll('a');
+for (var i = 0; i < anchors.length; i++) {
+    var dt = anchors[i].querySelector('dt');
+    var name = dt ? textOf(dt) : '';
+    if (!name && /ETC/i.test(textOf(anchors[i]))) name = textOf(anchors[i]).split('\\n')[0].trim();
+    if (name && names.indexOf(name) < 0) names.push(name);
+}
+return names;
+"""
+
+# 发票表格的候选选择器
+INVOICE_TABLE_SELECTORS = [
+    "table.table_wdfp",
+    "table.table",
+    ".table_wdfp",
+    "table"
+]
+
+# 一次性读取整页发票条目：金额、下载地址、发票标识
+SCRAPE_INVOICE_ROWS_JS = """
+var selectors = arguments[0];
+var tables = [];
+var matched = null;
+for (var s = 0; s < selectors.length && !tables.length; s++) {
+    tables = Array.prototype.slice.call(document.querySelectorAll(selectors[s]));
+    if (tables.length) matched = selectors[s];
+}
+
+function textOf(el) { return el ? (el.innerText || el.textContent || '').trim() : ''; }
+
+function findAmount(table) {
+    var ths = table.querySelectorAll('th');
+    var i, span;
+    for (i = 0; i < ths.length; i++) {
+        if (textOf(ths[i]).indexOf('开票金额') >= 0 && (span = ths[i].querySelector('span'))) return textOf(span);
+    }
+    span = table.querySelector("span[class*='inv_deta_list_divc01']");
+    if (span && textOf(span).indexOf('￥') >= 0) return textOf(span);
+    var spans = table.querySelectorAll('span');
+    for (i = 0; i < spans.length; i++) {
+        if (textOf(spans[i]).indexOf('￥') >= 0) return textOf(spans[i]);
+    }
+    for (i = 0; i < ths.length; i++) {
+        if (textOf(ths[i]).indexOf('金额') >= 0 && (span = ths[i].querySelector('span'))) return textOf(span);
+    }
+    return '';
+}
+
+function findLink(table) {
+    var link = table.querySelector("a[href*='/downloadPage/']");
+    if (link) return link;
+    var anchors = table.querySelectorAll('a');
+    for (var i = 0; i < anchors.length; i++) {
+        if (textOf(anchors[i]).indexOf('下载') >= 0) return anchors[i];
+    }
+    return table.querySelector("a[onclick*='download']");
+}
+
+function findInvoiceId(table, href) {
+    if (href) {
+        var m = href.match(/\\/downloadPage\\/([^?#]+)/);
+        if (m) return m[1].replace(/\\/+$/, '');
+    }
+    var attr = table.getAttribute('data-id') || table.getAttribute('id');
+    if (attr) return attr;
+    var text = textOf(table).match(/发票号码[:：\\s]*(\\d+)/);
+    return text ? text[1] : null;
+}
+
+var rows = tables.map(function (table, i) {
+    var link = findLink(table);
+    var href = null;
+    if (link && link.href && link.getAttribute('href').indexOf('javascript') !== 0) href = link.href;
+    return {
+        index: i + 1,
+        amount_text: findAmount(table),
+        href: href,
+        invoice_id: findInvoiceId(table, href)
+    };
+});
+return {selector: matched, rows: rows};
+"""
+
+# 结果页指纹：条目数量 + 首尾下载地址
+PAGE_SIGNATURE_JS = """
+var links = document.querySelectorAll("a[href*='/downloadPage/']");
+var first = links.length ? links[0].href : '';
+var last = links.length ? links[links.length - 1].href : '';
+return links.length + '|' + first + '|' + last;
+"""
+
+# 未指定卡片时点击的默认卡片（selenium 和异步核心共用）
+DEFAULT_CARD = "广西ETC"
+
+# 点击卡片列表页上的卡片：名称完全一致的优先，其次是包含该名称的（与 click_etc_card 的顺序一致）
+CLICK_CARD_JS = """
+var name = arguments[0];
+function textOf(el) { return el ? (el.innerText || el.textContent || '').trim() : ''; }
+var anchors = Array.prototype.slice.call(document.querySelectorAll('a'));
+function exact(a) {
+    var dt = a.querySelector('dt');
+    return (dt && textOf(dt) === name) || textOf(a) === name;
+}
+function partial(a) {
+    var dt = a.querySelector('dt');
+    return (dt && textOf(dt).indexOf(name) >= 0) || textOf(a).indexOf(name) >= 0
+        || (a.getAttribute('href') || '').indexOf(name) >= 0;
+}
+var card = anchors.filter(exact)[0] || anchors.filter(partial)[0];
+if (!card) return false;
+card.click();
+return true;
+"""
+
+# 设置查询月份（WdatePicker 输入框），参数为 YYYYMM
+SET_MONTH_JS = """
+var monthInput = document.getElementById('month');
+if (!monthInput) return false;
+monthInput.value = arguments[0];
+
+// 触发所有必要的事件
+['input', 'change', 'blur'].forEach(function (eventType) {
+    monthInput.dispatchEvent(new Event(eventType, {bubbles: true}));
+});
+
+// 调用可能的回调函数
+if (window.WdatePicker && window.WdatePicker.onpicked) {
+    window.WdatePicker.onpicked.call(monthInput);
+}
+return true;
+"""
+
+# 点击搜索按钮
+SEARCH_BUTTON_JS = """
+var searchBtn = document.getElementById('titSeach') ||
+                document.getElementById('seach') ||
+                document.querySelector('.taiji_search_submit');
+if (searchBtn) {
+    searchBtn.click();
+    return true;
+}
+return false;
+"""
+
+# 下载页上的打包下载按钮；参数为 true 时点击它
+PACK_BUTTON_JS = """
+var button = document.getElementById('no-invoice') || document.querySelector("input[value*='打包']");
+if (!button) {
+    var buttons = document.querySelectorAll('button');
+    for (var i = 0; i < buttons.length && !button; i++) {
+        if ((buttons[i].innerText || buttons[i].textContent || '').indexOf('打包') >= 0) button = buttons[i];
+    }
+}
+if (!button) return false;
+if (arguments[0]) button.click();
+return true;
+"""
+
+
+def parse_amount(amount_text):
+    """把 '￥123.45' 这样的文本转成金额，无法解析时返回0"""
+    if not amount_text or '￥' not in amount_text:
+        return 0.0
+    try:
+        return float(amount_text.replace('￥', '').replace(',', '').strip())
+    except ValueError:
+        return 0.0
@@ -0,0 +1,275 @@
+import os
+import time
+import queue
+import threading
+
+
+class MonthWorkerPool:
+    """
+    多个下载任务并行处理月份队列。
+
+    - 多个调试端口：每个端口是一个独立的Chrome实例，各自拥有自己的CDP下载目录，
+      可以使用浏览器点击下载或HTTP直连下载。
+    - 每个Chrome多个标签页：同一个Chrome的下载目录是全局的，
+      这些标签页只负责列出发票，压缩包一律通过HTTP直接写入各自的 YYYYMM 文件夹。
+    - 多卡片/多账户（run_sweep）：每个账户是一组登录了该账户的调试端口，
+      任务是 卡片×月份，同一账户的所有标签页共用一个任务队列。
+    - 使用程序托管的Chrome（chrome_pool）时，浏览器卡死或崩溃的任务换用热备浏览器，
+      正在处理的月份放回队列重新处理（每个任务最多重新处理一次）。
+    """
+
+    def __init__(self, downloader_factory, target_url, download_path, debug_ports, tabs_per_browser=1,
+                 chrome_pool=None):
+        """
+        :param downloader_factory: downloader_factory(debug_port, shared_browser) -> InvoiceDownloader
+        :param target_url: 发票卡片列表页地址
+        :param download_path: 下载根目录，汇总文件也写在这里
+        :param debug_ports: Chrome调试端口列表，每个端口一个Chrome实例
+        :param tabs_per_browser: 每个Chrome实例中并行的标签页数量
+        :param chrome_pool: ChromePool，debug_ports 是它托管的浏览器时传入，用于浏览器故障时自动切换
+        """
+        self.downloader_factory = downloader_factory
+        self.target_url = target_url
+        self.download_path = download_path
+        self.debug_ports = list(debug_ports)
+        self.tabs_per_browser = max(1, int(tabs_per_browser))
+        self.chrome_pool = chrome_pool
+
+        self.results = []
+        self._lock = threading.Lock()
+
+    def _record(self, result):
+        with self._lock:
+            self.results.append(result)
+
+    def _make_group(self, account, target_url, debug_ports, cards, month_list):
+        """
+        一个账户的任务组。cards 为 None 时由第一个连上浏览器的任务读取卡片列表页上的全部卡片，
+        其余任务等它把 卡片×月份 放进队列后再开始。
+        """
+        group = {
+            'account': account,
+            'target_url': target_url,
+            'debug_ports': list(debug_ports),
+            'cards': None if cards is None else list(cards),
+            'months': list(month_list),
+            'work': queue.Queue(),
+            'ready': threading.Event(),
+            'discovering': False,
+            'lock': threading.Lock(),
+            'requeued': set(),  # 因为浏览器故障放回队列过的任务
+        }
+        if cards is not None:
+            self._fill(group)
+        return group
+
+    def _fill(self, group):
+        # 按卡片为主序排列，同一张卡的月份尽量由同一个任务连续处理
+        for card in group['cards'] or [None]:
+            for year, month in group['months']:
+                group['work'].put((card, year, month))
+        group['ready'].set()
+
+    def _ensure_work(self, group, downloader, worker_name):
+        """需要自动读取卡片时，由第一个任务读取并填充队列"""
+        with group['lock']:
+            leader = group['cards'] is None and not group['discovering']
+            if leader:
+                group['discovering'] = True
+        if not leader:
+            group['ready'].wait()
+            return
+
+        cards = []
+        try:
+            if downloader.navigate_to_page(group['target_url']):
+                cards = downloader.list_cards()
+            label = f"账户 {group['account']}" if group['account'] else worker_name
+            print(f"💳💳 [{label}] 找到 {len(cards)} 张卡片: {', '.join(cards) or '无'}")
+        finally:
+            group['cards'] = cards
+            if cards:
+                self._fill(group)
+            else:
+                group['ready'].set()
+
+    def _connect(self, debug_port, shared_browser):
+        """
+        创建下载任务并连接浏览器；托管的浏览器连不上时换一个再试。
+
+        :return: (downloader, 实际连接的端口, 自己的标签页)，连接失败时 downloader 为 None
+        """
+        for attempt in range(2 if self.chrome_pool else 1):
+            if attempt:
+                debug_port = self.chrome_pool.recover(debug_port)
+            downloader = self.downloader_factory(debug_port, shared_browser)
+            if downloader.connect_browser():
+                own_tab = downloader.open_worker_tab() if shared_browser else None
+                return downloader, debug_port, own_tab
+        return None, debug_port, None
+
+    def _release(self, downloader, own_tab):
+        if own_tab:
+            try:
+                downloader.driver.switch_to.window(own_tab)
+                downloader.driver.close()
+            except Exception:
+                pass
+        downloader.close()
+
+    def _worker(self, worker_name, group, debug_port, shared_browser):
+        downloader, debug_port, own_tab = self._connect(debug_port, shared_browser)
+        if downloader is None:
+            print(f"❌❌ [{worker_name}] 浏览器连接失败，该任务退出，剩余任务由其他任务处理")
+            return
+
+        try:
+            self._ensure_work(group, downloader, worker_name)
+
+            while True:
+                try:
+                    task = group['work'].get_nowait()
+                except queue.Empty:
+                    break
+
+                card, year, month = task
+                label = f"{card} " if card else ""
+                print(f"\n🧵🧵 [{worker_name}] 领取 {label}{year}年{month:02d}月")
+                started = time.time()
+                summaries_before = len(downloader.month_summaries)
+                success = False
+                error = None
+                try:
+                    # 指定卡片时下载文件按卡片分文件夹保存：<下载目录>/<卡片>/<YYYYMM>
+                    downloader.card_name = card
+                    if not downloader.navigate_to_page(group['target_url']):
+                        error = '页面导航失败'
+                    elif not (downloader.click_etc_card(card) if card else downloader.click_etc_card()):
+                        error = '卡片点击失败'
+                    else:
+                        success = downloader.process_single_month(year, month)
+                except Exception as e:
+                    error = str(e)
+
+                if (not success and self.chrome_pool and task not in group['requeued']
+                        and not self.chrome_pool.healthy(debug_port)):
+                    # 托管的浏览器卡死或崩溃：月份放回队列，换用热备浏览器继续（下载清单会跳过已下载的发票）
+                    group['requeued'].add(task)
+                    group['work'].put(task)
+                    print(f"🔁🔁 [{worker_name}] 浏览器无响应，{label}{year}年{month:02d}月放回队列")
+                    self._release(downloader, own_tab)
+                    downloader, debug_port, own_tab = self._connect(self.chrome_pool.recover(debug_port),
+                                                                    shared_browser)
+                    if downloader is None:
+                        print(f"❌❌ [{worker_name}] 没有可用的浏览器，该任务退出")
+                        return
+                    continue
+
+                summary = (downloader.month_summaries[summaries_before:] or [{}])[0]
+                self._record({
+                    'account': group['account'],
+                    'card': card,
+                    'year': year,
+                    'month': month,
+                    'worker': worker_name,
+                    'success': success,
+                    'error': error,
+                    'elapsed': time.time() - started,
+                    'total_count': summary.get('total_count', 0),
+                    'success_count': summary.get('success_count', 0),
+                    'total_amount': summary.get('total_amount', 0.0),
+                })
+        finally:
+            if downloader is not None:
+                self._release(downloader, own_tab)
+
+    def run(self, month_list):
+        """并行处理所有月份（固定的默认卡片），返回按月份排序的结果列表"""
+        group = self._make_group(None, self.target_url, self.debug_ports, [None], month_list)
+        return self._run_groups([group], f"{len(month_list)} 个月份")
+
+    def run_sweep(self, profiles, month_list):
+        """
+        多账户、多卡片批量下载。
+
+        :param profiles: [{'name': 账户名, 'debug_ports': [端口...], 'cards': [卡片...] 或 None,
+                           'target_url': 可选，卡片列表页地址}, ...]；cards 为 None 表示下载该账户的全部卡片
+        :param month_list: [(year, month), ...]
+        :return: 按账户、卡片、月份排序的结果列表
+        """
+        groups = [
+            self._make_group(profile.get('name'), profile.get('target_url') or self.target_url,
+                             profile.get('debug_ports') or self.debug_ports, profile.get('cards'), month_list)
+            for profile in profiles
+        ]
+        return self._run_groups(groups, f"{len(groups)} 个账户 × {len(month_list)} 个月份")
+
+    def _run_groups(self, groups, description):
+        shared_browser = self.tabs_per_browser > 1
+        workers = []
+        for group in groups:
+            for port in group['debug_ports']:
+                for tab in range(self.tabs_per_browser):
+                    name = f"{port}-{tab + 1}" if shared_browser else str(port)
+                    if group['account']:
+                        name = f"{group['account']}/{name}"
+                    workers.append(threading.Thread(
+                        target=self._worker, args=(name, group, port, shared_browser), name=f"month-worker-{name}"
+                    ))
+
+        ports = sum(len(group['debug_ports']) for group in groups)
+        print(f"🚀🚀 并行下载: {description}，{len(workers)} 个任务"
+              f"（{ports} 个Chrome实例 × {self.tabs_per_browser} 个标签页）")
+        started = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # 所有任务都没连上浏览器时，剩余任务记为失败
+        for group in groups:
+            leftovers = []
+            while not group['work'].empty():
+                leftovers.append(group['work'].get_nowait())
+            error = '没有可用的浏览器'
+            if group['cards'] is None:
+                leftovers = [(None, year, month) for year, month in group['months']]
+            elif not group['cards']:
+                leftovers = [(None, year, month) for year, month in group['months']]
+                error = '卡片列表页上没有找到卡片'
+            for card, year, month in leftovers:
+                self._record({'account': group['account'], 'card': card, 'year': year, 'month': month,
+                              'worker': None, 'success': False, 'error': error, 'elapsed': 0.0,
+                              'total_count': 0, 'success_count': 0, 'total_amount': 0.0})
+
+        self.results.sort(key=lambda r: (r['account'] or '', r['card'] or '', r['year'], r['month']))
+        self.write_summary(time.time() - started)
+        return self.results
+
+    def write_summary(self, elapsed):
+        """打印并写出所有月份的合并汇总"""
+        lines = [
+            f"并行下载汇总 - {time.strftime('%Y-%m-%d %H:%M:%S')}",
+            "=" * 50,
+            f"任务数: {len(self.results)}，总用时: {elapsed:.1f}s",
+            f"发票总数: {sum(r['total_count'] for r in self.results)} 张",
+            f"下载成功: {sum(r['success_count'] for r in self.results)} 张",
+            f"开票总金额: ￥{sum(r['total_amount'] for r in self.results):.2f}",
+            "-" * 50,
+        ]
+        for r in self.results:
+            status = '成功' if r['success'] else f"失败({r['error'] or '无成功下载'})"
+            prefix = ''.join(f"{name} " for name in (r['account'], r['card']) if name)
+            lines.append(f"{prefix}{r['year']}年{r['month']:02d}月: {r['success_count']}/{r['total_count']} 张, "
+                         f"￥{r['total_amount']:.2f}, {status}, 用时 {r['elapsed']:.1f}s, 任务 {r['worker']}")
+
+        print("\n📊📊 " + "\n".join(lines))
+        if self.download_path:
+            summary_path = os.path.join(self.download_path, f"并行下载汇总_{time.strftime('%Y%m%d_%H%M%S')}.txt")
+            try:
+                os.makedirs(self.download_path, exist_ok=True)
+                with open(summary_path, 'w', encoding='utf-8') as f:
+                    f.write("\n".join(lines) + "\n")
+                print(f"📄📄 汇总文件已生成: {summary_path}")
+            except Exception as e:
+                print(f"❌❌ 汇总文件写入失败: {e}")
@@ -0,0 +1,375 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import METRICS
+from my_zip import MONTH_FOLDER
+from download_manifest import file_sha256
+
+INDEX_FILENAME = '.invoice_index.db'
+
+# 发票上的字段（全角、半角冒号都有）
+_INVOICE_NO = re.compile(r'发票号码\s*[:：]?\s*(\d{8,20})')
+_INVOICE_DATE = re.compile(r'开票日期\s*[:：]?\s*(\d{4})\s*[年\-/.]\s*(\d{1,2})\s*[月\-/.]\s*(\d{1,2})')
+_TOTAL_AMOUNT = re.compile(r'小写\s*[)）]?\s*[¥￥]\s*([\d,]+\.\d{2})')
+_ANY_AMOUNT = re.compile(r'[¥￥]\s*([\d,]+\.\d{2})')
+_SELLER = re.compile(r'销售方(?:信息)?[\s\S]{0,20}?名\s*称\s*[:：]\s*(\S+)')
+_NAME = re.compile(r'名\s*称\s*[:：]\s*(\S+)')
+_PLATE = re.compile(r'[京津沪渝冀豫云辽黑湘皖鲁新苏浙赣鄂桂甘晋蒙陕吉闽贵粤青藏川宁琼][A-HJ-NP-Z][A-HJ-NP-Z0-9]{4,5}[A-HJ-NP-Z0-9挂学警港澳]')
+
+
+def parse_invoice_text(text):
+    """
+    从发票PDF的文字中提取 发票号码、开票日期、金额（价税合计）、销售方、车牌号，取不到的字段为 None。
+
+    :return: dict(invoice_no, invoice_date, amount, seller, plate)
+    """
+    fields = {'invoice_no': None, 'invoice_date': None, 'amount': None, 'seller': None, 'plate': None}
+
+    match = _INVOICE_NO.search(text)
+    if match:
+        fields['invoice_no'] = match.group(1)
+
+    match = _INVOICE_DATE.search(text)
+    if match:
+        year, month, day = match.groups()
+        fields['invoice_date'] = f"{year}-{int(month):02d}-{int(day):02d}"
+
+    # 优先取“价税合计（小写）”，没有时取页面上最大的金额
+    match = _TOTAL_AMOUNT.search(text)
+    amounts = [match.group(1)] if match else _ANY_AMOUNT.findall(text)
+    if amounts:
+        fields['amount'] = max(float(a.replace(',', '')) for a in amounts)
+
+    match = _SELLER.search(text)
+    if match:
+        fields['seller'] = match.group(1)
+    else:
+        # 没有“销售方”字样时，第二个“名称”一般是销售方
+        names = _NAME.findall(text)
+        if len(names) >= 2:
+            fields['seller'] = names[1]
+
+    match = _PLATE.search(text)
+    if match:
+        fields['plate'] = match.group(0)
+    return fields
+
+
+def load_pdf_reader():
+    """
+    pypdf 导入要约0.1秒，只在需要解析新PDF时才导入。
+
+    :return: pypdf.PdfReader；没装 pypdf 时返回 None（只能查询已有索引，不能解析新的PDF）
+    """
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    return PdfReader
+
+
+def parse_pdf_task(path):
+    """
+    读取一个PDF的文字并提取字段（可在子进程中运行）。
+
+    :return: dict(path, text, error, 以及 parse_invoice_text 的字段)
+    """
+    result = {'path': path, 'text': '', 'error': None}
+    try:
+        reader = load_pdf_reader()(path)
+        result['text'] = "\n".join(page.extract_text() or '' for page in reader.pages)
+        if not result['text'].strip():
+            result['error'] = 'PDF没有文字层'
+    except Exception as e:
+        result['error'] = f"PDF读取失败: {e}"
+    result.update(parse_invoice_text(result['text']))
+    return result
+
+
+class PdfIndex:
+    """
+    已解压发票PDF的全文索引（SQLite FTS5），可以按发票号码、销售方、车牌号、金额、日期跨月份搜索。
+
+    - files 表：PDF相对路径、大小、修改时间、SHA-256、所属月份和卡片
+    - documents 表：按内容哈希保存提取的字段；同一张发票在不同文件夹里只解析一次
+    - documents_fts 表：发票号码、销售方、车牌号和全文，trigram 分词，中文子串也能查
+    重复运行时大小和修改时间都没变的PDF直接跳过，新的内容才用进程池解析。
+    """
+
+    def __init__(self, root, filename=INDEX_FILENAME):
+        self.root = os.path.abspath(root)
+        self.db_path = os.path.join(self.root, filename)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        try:
+            self._create_tables()
+        except sqlite3.OperationalError:
+            self.conn.close()
+            raise
+
+    def _create_tables(self):
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                month TEXT,
+                card TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+            CREATE TABLE IF NOT EXISTS documents (
+                sha256 TEXT PRIMARY KEY,
+                invoice_no TEXT,
+                invoice_date TEXT,
+                amount REAL,
+                seller TEXT,
+                plate TEXT,
+                error TEXT,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS documents_invoice_no ON documents (invoice_no);
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                sha256 UNINDEXED, invoice_no, seller, plate, text, tokenize='trigram'
+            );
+        """)
+        self.conn.commit()
+
+    def _rel(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root).replace('\\', '/')
+
+    def iter_pdfs(self):
+        """
+        列出下载目录下所有解压出来的发票PDF（跳过 trans.pdf 和 . 开头的文件夹）。
+
+        :return: 生成器，产出 (path, stat_result, month, card)
+        """
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            parts = self._rel(dirpath).split('/')
+            month_at = next((i for i, part in enumerate(parts) if MONTH_FOLDER.match(part)), None)
+            if month_at is None:
+                continue
+            month = parts[month_at]
+            card = parts[month_at - 1] if month_at > 0 else None
+            for name in sorted(filenames):
+                if not name.lower().endswith('.pdf') or name.lower() == 'trans.pdf':
+                    continue
+                path = os.path.join(dirpath, name)
+                yield path, os.stat(path), month, card
+
+    def update(self, workers=None):
+        """
+        增量更新索引：新增或变化的PDF计算哈希，没见过的内容用进程池解析；已删除的文件从索引中移除。
+
+        :param workers: 解析PDF的进程数，None 表示使用全部CPU核心
+        :return: dict(files, changed, parsed, removed, errors, elapsed)
+        """
+        started = time.perf_counter()
+        with self.lock:
+            known = {row[0]: (row[1], row[2]) for row in
+                     self.conn.execute("SELECT path, size, mtime_ns FROM files")}
+            parsed_hashes = {row[0] for row in self.conn.execute("SELECT sha256 FROM documents")}
+
+        seen = set()
+        changed = []
+        for path, stat_result, month, card in self.iter_pdfs():
+            rel = self._rel(path)
+            seen.add(rel)
+            if known.get(rel) == (stat_result.st_size, stat_result.st_mtime_ns):
+                continue
+            changed.append((rel, path, stat_result, month, card))
+
+        # 先按哈希去重，同样内容的PDF只解析一次
+        to_parse = {}
+        file_rows = []
+        for rel, path, stat_result, month, card in changed:
+            digest = file_sha256(path)
+            file_rows.append((rel, digest, stat_result.st_size, stat_result.st_mtime_ns, month, card))
+            if digest not in parsed_hashes and digest not in to_parse:
+                to_parse[digest] = path
+
+        results = []
+        if to_parse and load_pdf_reader() is None:
+            print("⚠️ 未安装 pypdf，无法解析新的PDF（pip install pypdf），只能查询已有的索引")
+            to_parse = {}
+            file_rows = [row for row in file_rows if row[1] in parsed_hashes]
+        if len(to_parse) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(parse_pdf_task, to_parse.values(), chunksize=8))
+        else:
+            results = [parse_pdf_task(path) for path in to_parse.values()]
+
+        removed = set(known) - seen
+        with self.lock:
+            for digest, result in zip(to_parse, results):
+                self.conn.execute("""
+                    INSERT OR REPLACE INTO documents
+                        (sha256, invoice_no, invoice_date, amount, seller, plate, error, updated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (digest, result['invoice_no'], result['invoice_date'], result['amount'],
+                      result['seller'], result['plate'], result['error'], time.time()))
+                self.conn.execute("DELETE FROM documents_fts WHERE sha256 = ?", (digest,))
+                self.conn.execute(
+                    "INSERT INTO documents_fts (sha256, invoice_no, seller, plate, text) VALUES (?, ?, ?, ?, ?)",
+                    (digest, result['invoice_no'] or '', result['seller'] or '', result['plate'] or '',
+                     result['text'])
+                )
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", file_rows)
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(rel,) for rel in removed])
+            # 没有文件再引用的内容一并删除
+            self.conn.execute("DELETE FROM documents WHERE sha256 NOT IN (SELECT sha256 FROM files)")
+            self.conn.execute("DELETE FROM documents_fts WHERE sha256 NOT IN (SELECT sha256 FROM files)")
+            self.conn.commit()
+            total = self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+        errors = sum(1 for r in results if r['error'])
+        METRICS.incr('pdf_indexed', len(results))
+        return {'files': total, 'changed': len(changed), 'parsed': len(results), 'removed': len(removed),
+                'errors': errors, 'elapsed': time.perf_counter() - started}
+
+    def search(self, query, limit=20):
+        """
+        搜索发票。多个关键词之间是“并且”关系：
+        3个字及以上的关键词走全文索引（发票号码、销售方、车牌号、PDF全文），
+        更短的关键词按子串匹配；像金额的关键词（如 12.50）同时匹配金额，像日期的（2024-10）匹配开票日期。
+
+        :return: [dict(path, month, card, invoice_no, invoice_date, amount, seller, plate), ...]
+        """
+        conditions = []
+        params = []
+        for term in query.split():
+            options = []
+            if len(term) >= 3:
+                options.append("d.sha256 IN (SELECT sha256 FROM documents_fts WHERE documents_fts MATCH ?)")
+                params.append('"' + term.replace('"', '""') + '"')
+            else:
+                options.append("(d.seller LIKE ? OR d.plate LIKE ? OR d.invoice_no LIKE ?)")
+                params += [f"%{term}%"] * 3
+            if re.fullmatch(r'[¥￥]?\d+(\.\d{1,2})?', term):
+                options.append("ROUND(d.amount, 2) = ?")
+                params.append(round(float(term.lstrip('¥￥')), 2))
+            if re.fullmatch(r'\d{4}-\d{2}(-\d{2})?', term):
+                options.append("d.invoice_date LIKE ?")
+                params.append(f"{term}%")
+            conditions.append("(" + " OR ".join(options) + ")")
+
+        sql = """
+            SELECT f.path, f.month, f.card, d.invoice_no, d.invoice_date, d.amount, d.seller, d.plate
+            FROM files f JOIN documents d ON d.sha256 = f.sha256
+        """
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY f.month DESC, f.path LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        keys = ('path', 'month', 'card', 'invoice_no', 'invoice_date', 'amount', 'seller', 'plate')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def documents_under(self, folder):
+        """
+        某个文件夹（如一个月份文件夹）下所有已索引的PDF，一次查询取出。
+
+        :return: [(相对路径, invoice_no, amount, error), ...]
+        """
+        prefix = self._rel(folder).rstrip('/') + '/'
+        with self.lock:
+            return self.conn.execute("""
+                SELECT f.path, d.invoice_no, d.amount, d.error
+                FROM files f JOIN documents d ON d.sha256 = f.sha256
+                WHERE f.path >= ? AND f.path < ?
+            """, (prefix, prefix[:-1] + '0')).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+def open_index(root):
+    """
+    打开发票索引。FTS5 的 trigram 分词需要 SQLite 3.34 以上并且编译了 FTS5，
+    一些 Windows 版 Python 自带的 SQLite 太旧，这时只打印提示，不影响下载和解压。
+
+    :return: PdfIndex，不支持时返回 None
+    """
+    try:
+        return PdfIndex(root)
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ 当前Python自带的SQLite {sqlite3.sqlite_version} 不支持发票全文索引"
+              f"（需要3.34以上并支持FTS5），跳过发票索引和搜索: {e}")
+        return None
+
+
+def update_index(root, workers=None):
+    """解压之后更新发票全文索引，并打印统计"""
+    if not os.path.isdir(root):
+        return None
+    index = open_index(root)
+    if index is None:
+        return None
+    try:
+        stats = index.update(workers)
+    finally:
+        index.close()
+    print(f"🔎🔎 发票索引: 共 {stats['files']} 个PDF，本次新增/变化 {stats['changed']} 个，"
+          f"解析 {stats['parsed']} 个，移除 {stats['removed']} 个，"
+          f"无法识别 {stats['errors']} 个，用时 {stats['elapsed'] * 1000:.0f} ms")
+    return stats
+
+
+def print_results(results, elapsed):
+    """打印搜索结果"""
+    print(f"🔎🔎 找到 {len(results)} 张发票（{elapsed * 1000:.1f} ms）")
+    for r in results:
+        amount = f"￥{r['amount']:.2f}" if r['amount'] is not None else '-'
+        prefix = f"{r['card']} " if r['card'] else ''
+        print(f"  {prefix}{r['month']}  {r['invoice_no'] or '-'}  {r['invoice_date'] or '-'}  {amount}  "
+              f"{r['seller'] or '-'}  {r['plate'] or '-'}\n    {r['path']}")
+
+
+def search(root, query, limit=20):
+    """在下载目录的发票索引中搜索并打印结果"""
+    index = open_index(root)
+    if index is None:
+        return []
+    try:
+        started = time.perf_counter()
+        results = index.search(query, limit)
+        print_results(results, time.perf_counter() - started)
+    finally:
+        index.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="发票PDF全文索引：更新索引，或按发票号码、销售方、车牌号、金额、日期搜索")
+    parser.add_argument('query', nargs='*', help="搜索关键词，多个关键词同时满足；不填则只更新索引")
+    parser.add_argument('--root', default='invoice_downloads', help="下载目录")
+    parser.add_argument('--limit', type=int, default=20, help="最多显示的结果数")
+    parser.add_argument('--workers', type=int, default=None, help="解析PDF的进程数")
+    parser.add_argument('--no-update', action='store_true', help="搜索前不更新索引")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.root):
+        print(f"❌❌ 目录不存在: {args.root}")
+        return 1
+    if not args.query or not args.no_update:
+        update_index(args.root, args.workers)
+    if args.query:
+        search(args.root, ' '.join(args.query), args.limit)
+    return 0
+
+
+if __name__ == "__main__":
+    # 解析PDF会用到进程池
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import time
+import threading
+
+from metrics import METRICS
+
+
+class AdaptiveRateLimiter:
+    """
+    自适应令牌桶，代替固定的“每张发票等2秒、每个月份等3秒”。
+
+    - 每次请求前取一个令牌，令牌按 rate（次/秒）补充，最多攒 burst 个
+    - 网站响应快（用时低于 fast_latency）时逐步提速，最高 max_rate
+    - 超时或出错页面时速率减半，并按 2、4、8……秒指数退避，最长 max_backoff 秒；
+      成功一次后退避清零。退避期间陆续返回的失败（并发请求同时出错）不再重复减速
+    同一个限速器可以被多个下载线程共用。
+    """
+
+    def __init__(self, rate=1.0, min_rate=0.2, max_rate=10.0, burst=3, fast_latency=2.0,
+                 increase=1.2, base_backoff=2.0, max_backoff=60.0):
+        """
+        :param rate: 初始速率（次/秒）
+        :param min_rate: 连续出错时的最低速率
+        :param max_rate: 响应很快时的最高速率
+        :param burst: 令牌桶容量，空闲后最多可以连续发出的请求数
+        :param fast_latency: 用时低于它的成功请求会让速率提高
+        :param increase: 每次提速的倍数
+        :param base_backoff: 第一次出错后的退避时间（秒），之后每次翻倍
+        :param max_backoff: 退避时间上限（秒）
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.fast_latency = fast_latency
+        self.increase = increase
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._backoff_until = 0.0
+        self._consecutive_failures = 0
+        self._lock = threading.Lock()
+
+        self.successes = 0
+        self.failures = 0
+        self.backoffs = 0
+        self.waited = 0.0
+        self.lowest_rate = rate
+        self.highest_rate = rate
+
+    def reserve(self):
+        """预定一个令牌，返回调用方还需要等待的秒数（异步调用方用 asyncio.sleep 等待）"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            # 令牌不够时等到补齐为止；退避期间至少等到退避结束
+            wait = max(0.0, -self._tokens / self.rate, self._backoff_until - now)
+            self.waited += wait
+            return wait
+
+    def acquire(self):
+        """取一个令牌，必要时阻塞等待"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def success(self, latency=None):
+        """报告一次成功的请求，响应快时提速"""
+        with self._lock:
+            self.successes += 1
+            self._consecutive_failures = 0
+            if latency is not None and latency < self.fast_latency:
+                self.rate = min(self.max_rate, self.rate * self.increase)
+                self.highest_rate = max(self.highest_rate, self.rate)
+
+    def failure(self):
+        """报告一次超时或出错：速率减半并指数退避"""
+        with self._lock:
+            self.failures += 1
+            now = time.monotonic()
+            if now < self._backoff_until:
+                # 同一波出错，已经在退避了
+                return
+            self._consecutive_failures += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.lowest_rate = min(self.lowest_rate, self.rate)
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self._consecutive_failures - 1))
+            self._backoff_until = now + backoff
+            # 退避结束后从空桶开始，不会一下子补发一批请求
+            self._tokens = min(self._tokens, 0.0)
+            self.backoffs += 1
+        METRICS.incr('rate_limit_backoffs')
+        print(f"🐢🐢 网站响应异常，{backoff:.1f}s 后继续，速率降到 {self.rate:.2f} 次/秒")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'lowest_rate': self.lowest_rate,
+                'highest_rate': self.highest_rate,
+                'successes': self.successes,
+                'failures': self.failures,
+                'backoffs': self.backoffs,
+                'waited': self.waited,
+            }
+
+
+class RetryQueue:
+    """
+    一个月份内下载失败的发票。月份结束前统一重试（每次重试前经过限速器），
+    仍然失败的发票和最后一次的错误写进统计文件。
+    """
+
+    def __init__(self, max_attempts=3):
+        """
+        :param max_attempts: 每张发票最多下载的次数（包括第一次）
+        """
+        self.max_attempts = max_attempts
+        self.pending = {}
+        self.attempts = {}
+        self.not_retryable = set()
+        self.recovered = []
+        self.failures = {}
+
+    def add(self, row, error=None, retryable=True):
+        """记录一次失败（第一次下载失败时调用）；retryable 为 False 的发票不重试，只记入最终失败列表"""
+        index = row['index']
+        self.pending[index] = row
+        self.attempts.setdefault(index, 1)
+        if not retryable:
+            self.not_retryable.add(index)
+        self.failures[index] = error or '下载失败'
+
+    def __len__(self):
+        return len(self.pending)
+
+    def next_round(self):
+        """取出下一轮要重试的发票（未达到最多次数的），并计入下载次数"""
+        rows = [row for index, row in sorted(self.pending.items())
+                if self.attempts[index] < self.max_attempts and index not in self.not_retryable]
+        for row in rows:
+            self.attempts[row['index']] += 1
+            METRICS.incr('download_retries')
+        if rows:
+            print(f"🔁🔁 重试 {len(rows)} 张下载失败的发票")
+        return rows
+
+    def record(self, row, success, error=None):
+        """记录一次重试的结果"""
+        index = row['index']
+        if success:
+            self.pending.pop(index, None)
+            self.failures.pop(index, None)
+            self.recovered.append(index)
+        else:
+            self.failures[index] = error or '下载失败'
+
+    def drain(self, download, limiter=None):
+        """
+        逐轮重试队列里的发票，直到全部成功或达到最多次数。
+
+        :param download: download(row) -> (success, error)
+        :param limiter: 可选的 AdaptiveRateLimiter，每次重试前取令牌，并报告结果
+        :return: 本次重试成功的发票序号列表
+        """
+        recovered_before = len(self.recovered)
+        while True:
+            rows = self.next_round()
+            if not rows:
+                break
+            for row in rows:
+                if limiter:
+                    limiter.acquire()
+                started = time.time()
+                success, error = download(row)
+                if limiter:
+                    if success:
+                        limiter.success(time.time() - started)
+                    else:
+                        limiter.failure()
+                self.record(row, success, error)
+        return self.recovered[recovered_before:]
+
+    def summary(self):
+        """统计文件使用：重试了哪些发票、总共重试几次、最终仍失败的发票和原因"""
+        retried = {index: attempts - 1 for index, attempts in self.attempts.items() if attempts > 1}
+        return {
+            'retried': retried,
+            'retry_count': sum(retried.values()),
+            'recovered': sorted(self.recovered),
+            'failures': [(index, error, self.attempts.get(index, 1))
+                         for index, error in sorted(self.failures.items())],
+        }
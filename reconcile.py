@@ -0,0 +1,251 @@
+import os
+import time
+
+from my_zip import iter_archive_dirs, MONTH_FOLDER
+from pdf_index import open_index, INDEX_FILENAME
+from download_manifest import DownloadManifest, file_sha256, STATE_DONE, MANIFEST_FILENAME
+
+# 统计文件里对账部分的标题，重新对账时从这一行开始替换
+SECTION_TITLE = "对账结果（页面发票 / 压缩包 / 发票PDF）:"
+
+# 金额允许的误差（元）
+AMOUNT_TOLERANCE = 0.005
+
+
+def reconcile_month(month_path, index=None):
+    """
+    核对一个月份文件夹：页面上读到的每张发票（下载清单）→ 下载的压缩包 → 解压出来的发票PDF。
+    全部用字典关联（文件名、内容哈希、解压文件夹、发票号码），不做两两比较，几千张发票也很快。
+
+    :param month_path: 月份文件夹
+    :param index: PdfIndex，用来取PDF上的发票号码和金额；为 None 时只核对压缩包和PDF是否齐全
+    :return: dict(rows, zips, pdfs, matched, missing_zip, not_extracted, unknown_file,
+                  amount_mismatch, duplicate_zips, duplicate_invoices, orphan_zips, unreadable)
+    """
+    manifest = DownloadManifest(month_path)
+    zips = {}
+    with os.scandir(month_path) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith('.zip'):
+                zips[entry.name] = entry.path
+
+    # 解压文件夹 -> 其中的发票PDF（相对月份文件夹的第一级目录就是压缩包同名文件夹）
+    pdfs_by_folder = {}
+    if index is not None:
+        month_rel = os.path.relpath(os.path.abspath(month_path), index.root).replace('\\', '/')
+        for path, invoice_no, amount, error in index.documents_under(month_path):
+            folder = path[len(month_rel) + 1:].split('/', 1)[0]
+            pdfs_by_folder.setdefault(folder, []).append((path, invoice_no, amount, error))
+    else:
+        for name in zips:
+            folder = os.path.join(month_path, name[:-4])
+            if os.path.isdir(folder):
+                pdfs_by_folder[name[:-4]] = [
+                    (os.path.join(dirpath, f), None, None, None)
+                    for dirpath, _, files in os.walk(folder)
+                    for f in files if f.lower().endswith('.pdf') and f.lower() != 'trans.pdf'
+                ]
+
+    result = {
+        'rows': 0, 'zips': len(zips), 'pdfs': sum(len(p) for p in pdfs_by_folder.values()), 'matched': 0,
+        'missing_zip': [], 'not_extracted': [], 'unknown_file': [], 'amount_mismatch': [],
+        'duplicate_zips': [], 'duplicate_invoices': [], 'orphan_zips': [], 'unreadable': [],
+        'amounts_checked': index is not None,
+    }
+
+    referenced = {}
+    rows = sorted(manifest.invoices.items(), key=lambda item: item[1].get('index') or 0)
+    for key, entry in rows:
+        result['rows'] += 1
+        row = {'key': key, 'index': entry.get('index'), 'amount': entry.get('amount') or 0.0,
+               'file': entry.get('file'), 'state': entry.get('state')}
+        filename = entry.get('file')
+        if not filename:
+            # 固定等待模式的旧记录没有文件名，无法对应到压缩包
+            (result['unknown_file'] if entry.get('state') == STATE_DONE else result['missing_zip']).append(row)
+            continue
+        if filename not in zips:
+            result['missing_zip'].append(row)
+            continue
+        referenced.setdefault(filename, []).append(row)
+
+        pdfs = pdfs_by_folder.get(filename[:-4])
+        if not pdfs:
+            result['not_extracted'].append(row)
+            continue
+        result['unreadable'] += [(row, path, error) for path, _, _, error in pdfs if error]
+        if index is None:
+            result['matched'] += 1
+            continue
+
+        # 一个压缩包里可能有多张发票（同一发票的多份PDF只算一次），页面金额应等于它们的合计
+        amounts = {}
+        for path, invoice_no, amount, error in pdfs:
+            if amount is not None:
+                amounts[invoice_no or path] = amount
+        pdf_amount = round(sum(amounts.values()), 2)
+        if not amounts or abs(pdf_amount - row['amount']) > AMOUNT_TOLERANCE:
+            result['amount_mismatch'].append((row, pdf_amount if amounts else None))
+        else:
+            result['matched'] += 1
+
+    # 同一个压缩包被多张发票引用
+    for filename, owners in sorted(referenced.items()):
+        if len(owners) > 1:
+            result['duplicate_zips'].append((filename, [owner['index'] for owner in owners]))
+
+    # 清单里没有记录的压缩包（例如手动放进来的、清单丢失的）
+    result['orphan_zips'] = sorted(name for name in zips if name not in referenced)
+
+    # 内容相同的压缩包：清单里有哈希的直接用，没有的才现算
+    known_hashes = {entry.get('file'): entry.get('sha256') for entry in manifest.invoices.values() if entry.get('file')}
+    by_hash = {}
+    for name, path in zips.items():
+        digest = known_hashes.get(name) or file_sha256(path)
+        by_hash.setdefault(digest, []).append(name)
+    for names in by_hash.values():
+        if len(names) > 1:
+            result['duplicate_zips'].append((' = '.join(sorted(names)), None))
+
+    # 同一个发票号码出现在不同的压缩包里
+    folders_by_invoice = {}
+    for folder, pdfs in pdfs_by_folder.items():
+        for _, invoice_no, _, _ in pdfs:
+            if invoice_no:
+                folders_by_invoice.setdefault(invoice_no, set()).add(folder)
+    for invoice_no, folders in sorted(folders_by_invoice.items()):
+        if len(folders) > 1:
+            result['duplicate_invoices'].append((invoice_no, sorted(f"{folder}.zip" for folder in folders)))
+    return result
+
+
+def problem_count(result):
+    return (len(result['missing_zip']) + len(result['not_extracted']) + len(result['amount_mismatch'])
+            + len(result['duplicate_zips']) + len(result['duplicate_invoices']) + len(result['orphan_zips']))
+
+
+def format_section(result, elapsed=None):
+    """对账结果写进统计文件的内容"""
+    lines = [
+        "=" * 50,
+        SECTION_TITLE,
+        "-" * 50,
+        f"对账时间: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+        f"页面发票 {result['rows']} 张，压缩包 {result['zips']} 个，发票PDF {result['pdfs']} 个，"
+        f"核对一致 {result['matched']} 张" + (f"（用时 {elapsed * 1000:.0f} ms）" if elapsed is not None else ""),
+    ]
+    if not result['amounts_checked']:
+        lines.append("⚠️ 没有发票索引（未安装 pypdf），只核对了压缩包和PDF是否齐全，没有核对金额")
+    if not problem_count(result):
+        lines.append("✅ 全部一致")
+
+    def row_label(row):
+        return f"第{row['index']}张发票（￥{row['amount']:.2f}）"
+
+    if result['missing_zip']:
+        lines.append(f"缺少压缩包: {len(result['missing_zip'])} 张")
+        lines += [f"  {row_label(row)}: {row['file'] or '没有下载记录'}" for row in result['missing_zip']]
+    if result['not_extracted']:
+        lines.append(f"没有解压出发票PDF: {len(result['not_extracted'])} 张")
+        lines += [f"  {row_label(row)}: {row['file']}" for row in result['not_extracted']]
+    if result['amount_mismatch']:
+        lines.append(f"金额不一致: {len(result['amount_mismatch'])} 张")
+        for row, pdf_amount in result['amount_mismatch']:
+            found = f"￥{pdf_amount:.2f}" if pdf_amount is not None else "未识别到金额"
+            lines.append(f"  {row_label(row)}: PDF上为 {found}（{row['file']}）")
+    if result['duplicate_zips']:
+        lines.append(f"重复的压缩包: {len(result['duplicate_zips'])} 组")
+        for names, indexes in result['duplicate_zips']:
+            owners = f"，被第{'、'.join(str(i) for i in indexes)}张发票共用" if indexes else "，内容相同"
+            lines.append(f"  {names}{owners}")
+    if result['duplicate_invoices']:
+        lines.append(f"重复的发票号码: {len(result['duplicate_invoices'])} 个")
+        lines += [f"  {invoice_no}: {', '.join(names)}" for invoice_no, names in result['duplicate_invoices']]
+    if result['orphan_zips']:
+        lines.append(f"下载清单中没有的压缩包: {len(result['orphan_zips'])} 个")
+        lines += [f"  {name}" for name in result['orphan_zips']]
+    if result['unknown_file']:
+        lines.append(f"下载记录没有文件名、无法核对: {len(result['unknown_file'])} 张")
+    if result['unreadable']:
+        lines.append(f"无法识别的PDF: {len(result['unreadable'])} 个")
+        lines += [f"  {path}: {error}" for _, path, error in result['unreadable']]
+    return "\n".join(lines) + "\n"
+
+
+def report_path_for(month_path):
+    month = os.path.basename(os.path.normpath(month_path))
+    return os.path.join(month_path, f"{month}_发票统计.txt")
+
+
+def up_to_date(month_path):
+    """上次对账之后月份文件夹（新增压缩包、解压文件夹）和下载清单都没有变化"""
+    report_path = report_path_for(month_path)
+    try:
+        report_mtime = os.stat(report_path).st_mtime_ns
+        changed = max(os.stat(month_path).st_mtime_ns,
+                      os.stat(os.path.join(month_path, MANIFEST_FILENAME)).st_mtime_ns)
+    except OSError:
+        return False
+    if report_mtime < changed:
+        return False
+    with open(report_path, 'r', encoding='utf-8') as f:
+        return SECTION_TITLE in f.read()
+
+
+def write_section(month_path, result, elapsed=None):
+    """把对账结果写进月份统计文件末尾；已有对账结果时替换掉旧的"""
+    report_path = report_path_for(month_path)
+    content = ""
+    if os.path.exists(report_path):
+        with open(report_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        marker = content.find("\n" + "=" * 50 + "\n" + SECTION_TITLE)
+        if marker >= 0:
+            content = content[:marker + 1]
+        elif content and not content.endswith("\n"):
+            content += "\n"
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write(content + ("\n" if content else "") + format_section(result, elapsed))
+    return report_path
+
+
+def reconcile_tree(root, force=True):
+    """
+    核对下载目录下有下载清单的每个月份文件夹，对账结果写进各月统计文件，有问题的月份打印出来。
+    需要先解压并更新发票索引（pdf_index.update_index）。
+
+    :param force: False 时跳过上次对账后没有任何变化的月份（同步模式下大部分月份都没有变化）
+
+    :return: {月份文件夹: 对账结果}
+    """
+    if not os.path.isdir(root):
+        return {}
+    index = open_index(root) if os.path.exists(os.path.join(root, INDEX_FILENAME)) else None
+    results = {}
+    started = time.perf_counter()
+    try:
+        for entry in iter_archive_dirs(root):
+            if not MONTH_FOLDER.match(entry.name) or not os.path.exists(os.path.join(entry.path, MANIFEST_FILENAME)):
+                continue
+            if not force and up_to_date(entry.path):
+                continue
+            month_started = time.perf_counter()
+            result = reconcile_month(entry.path, index)
+            write_section(entry.path, result, time.perf_counter() - month_started)
+            results[entry.path] = result
+            problems = problem_count(result)
+            if problems:
+                print(f"⚠️ 对账 {os.path.relpath(entry.path, root)}: {problems} 处不一致"
+                      f"（缺少压缩包 {len(result['missing_zip'])}，未解压 {len(result['not_extracted'])}，"
+                      f"金额不一致 {len(result['amount_mismatch'])}，"
+                      f"重复 {len(result['duplicate_zips']) + len(result['duplicate_invoices'])}，"
+                      f"清单外压缩包 {len(result['orphan_zips'])}），详见统计文件")
+    finally:
+        if index is not None:
+            index.close()
+    if results:
+        matched = sum(r['matched'] for r in results.values())
+        rows = sum(r['rows'] for r in results.values())
+        print(f"🧾🧾 对账完成: {len(results)} 个月份，{matched}/{rows} 张发票与压缩包、PDF一致，"
+              f"用时 {(time.perf_counter() - started) * 1000:.0f} ms")
+    return results
@@ -0,0 +1,224 @@
+import time
+
+from metrics import METRICS
+
+# 发票多的月份一次最多翻这么多页，防止翻页按钮失灵时死循环
+MAX_PAGES = 500
+
+# 分页栏通常所在的容器；找不到时在整个页面里找
+_PAGER_CONTAINERS_JS = """
+function textOf(el) { return el ? (el.innerText || el.textContent || '').trim() : ''; }
+
+function pagerContainers() {
+    var found = Array.prototype.slice.call(document.querySelectorAll(
+        "[class*='page'], [class*='Page'], [id*='page'], [id*='Page'], .layui-laypage"
+    )).filter(function (el) {
+        return el.tagName !== 'BODY' && el.tagName !== 'HTML' && el.tagName !== 'SELECT';
+    });
+    return found.length ? found : [document.body];
+}
+
+function findNext() {
+    var containers = pagerContainers();
+    for (var c = 0; c < containers.length; c++) {
+        var items = containers[c].querySelectorAll('a, button, span, li, input[type=button]');
+        for (var i = 0; i < items.length; i++) {
+            var el = items[i];
+            var text = textOf(el) || el.value || '';
+            var cls = (el.className || '') + '';
+            if (text === '下一页' || text === '下页' || text === '>' || text === '»' || /(^|\\s)next(\\s|$)/i.test(cls)) {
+                var disabled = el.disabled || /disabled|unable|forbid/i.test(cls)
+                    || (el.parentElement && /disabled/i.test(el.parentElement.className || ''));
+                return disabled ? null : el;
+            }
+        }
+    }
+    return null;
+}
+"""
+
+# 读取分页信息：页面上显示的总条数、当前页、总页数、是否还有下一页
+PAGE_INFO_JS = _PAGER_CONTAINERS_JS + """
+var text = pagerContainers().map(textOf).join(' ');
+var info = {total: null, page: null, pages: null, has_next: false};
+var m = text.match(/共\\s*(\\d+)\\s*(条|张|笔|项|记录)/);
+if (m) info.total = parseInt(m[1], 10);
+m = text.match(/共\\s*(\\d+)\\s*页/);
+if (m) info.pages = parseInt(m[1], 10);
+m = text.match(/第\\s*(\\d+)\\s*(?:\\/\\s*(\\d+)\\s*)?页/);
+if (m) {
+    info.page = parseInt(m[1], 10);
+    if (m[2]) info.pages = parseInt(m[2], 10);
+}
+info.has_next = !!findNext() && !(info.page && info.pages && info.page >= info.pages);
+return info;
+"""
+
+# 点击“下一页”，不等待页面加载（由调用方决定何时等待）
+NEXT_PAGE_JS = _PAGER_CONTAINERS_JS + """
+var next = findNext();
+if (!next) return false;
+next.click();
+return true;
+"""
+
+# 把每页条数调到最大：在分页栏里找选项全是数字的下拉框（10/20/50/100），选最大的一项
+PAGE_SIZE_JS = _PAGER_CONTAINERS_JS + """
+var containers = pagerContainers();
+var selects = Array.prototype.slice.call(document.querySelectorAll('select')).filter(function (select) {
+    var name = (select.id || '') + ' ' + (select.name || '') + ' ' + (select.className || '');
+    if (/size|limit|rows|num|page/i.test(name)) return true;
+    return containers.some(function (c) { return c !== document.body && c.contains(select); });
+});
+for (var s = 0; s < selects.length; s++) {
+    var select = selects[s];
+    var options = Array.prototype.slice.call(select.options);
+    if (options.length < 2) continue;
+    var sizes = options.map(function (o) { return parseInt((o.value || o.text).replace(/\\D/g, ''), 10); });
+    // 年份之类的下拉框不是每页条数
+    if (sizes.some(function (n) { return isNaN(n) || n < 1 || n > 1000; })) continue;
+    var best = 0;
+    for (var i = 1; i < sizes.length; i++) if (sizes[i] > sizes[best]) best = i;
+    var current = sizes[select.selectedIndex];
+    if (sizes[best] <= current) return {from: current, to: current, changed: false};
+    select.selectedIndex = best;
+    select.dispatchEvent(new Event('change', {bubbles: true}));
+    return {from: current, to: sizes[best], changed: true};
+}
+return null;
+"""
+
+
+class ResultPageWalker:
+    """
+    逐页读取搜索结果。发票多的月份结果是分页的，只读当前页会漏掉后面的发票。
+
+    - 先尝试把每页条数调到最大，尽量减少翻页次数
+    - 每页用一次 execute_script 读取快照，发票序号在各页之间连续编号
+    - prefetch 时，当前页的发票都有直接下载地址，就在下载开始前点击“下一页”，
+      下一页在主窗口里加载的同时，下载标签页在下载当前页的发票
+    - 记录每页读到的条数和页面上显示的总条数，写进统计报告
+    """
+
+    def __init__(self, downloader, timeout=15):
+        """
+        :param downloader: InvoiceDownloader，使用它的 driver、scrape_invoice_rows、page_signature
+        :param timeout: 翻页后等待新结果出现的超时（秒）
+        """
+        self.downloader = downloader
+        self.timeout = timeout
+        self.page_stats = []
+        self.stated_total = None
+        self.current_page = 1
+        # 最后一页也读完了（没有因为翻页失败、超时、页数上限提前停止）
+        self.complete = False
+        # 当前页下载期间主窗口是否已经翻到了下一页
+        self.prefetched = False
+
+    @property
+    def driver(self):
+        return self.downloader.driver
+
+    def page_info(self):
+        try:
+            return self.driver.execute_script(PAGE_INFO_JS) or {}
+        except Exception:
+            return {}
+
+    def maximize_page_size(self):
+        """把每页条数调到最大，改动后等待结果重新加载。返回调整后的每页条数，没有下拉框时返回None"""
+        signature = self.downloader.page_signature()
+        try:
+            result = self.driver.execute_script(PAGE_SIZE_JS)
+        except Exception as e:
+            print(f"⚠️ 调整每页条数失败: {e}")
+            return None
+        if not result:
+            return None
+        if result.get('changed'):
+            print(f"📄📄 每页条数: {result['from']} -> {result['to']}")
+            self.wait_for_change(signature)
+        return result.get('to')
+
+    def request_next(self):
+        """在主窗口点击“下一页”，成功点击返回True"""
+        try:
+            return bool(self.driver.execute_script(NEXT_PAGE_JS))
+        except Exception as e:
+            print(f"⚠️ 点击下一页失败: {e}")
+            return False
+
+    def wait_for_change(self, old_signature):
+        """等待结果页指纹变化（新一页的发票已经渲染出来）"""
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            signature = self.downloader.page_signature()
+            if signature and signature != old_signature and not signature.startswith('0|'):
+                return True
+            time.sleep(0.2)
+        return False
+
+    def pages(self, prefetch=True):
+        """
+        逐页产出发票快照。调用方可以在两页之间切换窗口，翻页前会自动切回主窗口。
+
+        :param prefetch: 下载当前页时主窗口提前翻到下一页
+        :return: 生成器，每次产出一页的发票列表
+        """
+        downloader = self.downloader
+        index_offset = 0
+        seen_signatures = set()
+        rows = downloader.scrape_invoice_rows()
+
+        while rows:
+            info = self.page_info()
+            if self.stated_total is None:
+                self.stated_total = info.get('total')
+            for row in rows:
+                row['page'] = self.current_page
+                row['page_index'] = row['index']
+                row['index'] = index_offset + row['index']
+            self.page_stats.append({'page': self.current_page, 'rows': len(rows)})
+
+            signature = downloader.page_signature()
+            seen_signatures.add(signature)
+            has_next = bool(info.get('has_next')) and self.current_page < MAX_PAGES
+            if not info.get('has_next'):
+                self.complete = True
+            if has_next:
+                print(f"📄📄 第 {self.current_page} 页: {len(rows)} 条"
+                      + (f"（页面显示共 {self.stated_total} 条）" if self.stated_total is not None else ""))
+
+            # 只有整页都有直接下载地址时才能提前翻页，否则回退下载还要用到当前页的元素
+            self.prefetched = False
+            if has_next and prefetch and all(row.get('href') for row in rows):
+                self.prefetched = self.request_next()
+
+            yield rows
+
+            if not has_next:
+                return
+            downloader.switch_window(downloader.main_window)
+            if not self.prefetched and not self.request_next():
+                return
+            with METRICS.span("next_page"):
+                changed = self.wait_for_change(signature)
+            if not changed:
+                print(f"⚠️ 第 {self.current_page + 1} 页加载超时，停止翻页")
+                return
+
+            index_offset += len(rows)
+            self.current_page += 1
+            rows = downloader.scrape_invoice_rows()
+            if downloader.page_signature() in seen_signatures:
+                print("⚠️ 翻页后仍是已读过的结果页，停止翻页")
+                return
+
+    def summary(self):
+        """每页读取条数和页面显示的总条数，供统计报告使用"""
+        return {
+            'pages': list(self.page_stats),
+            'rows': sum(page['rows'] for page in self.page_stats),
+            'stated_total': self.stated_total,
+            'complete': self.complete,
+        }
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from metrics import METRICS
+
+STAT_KEYS = ('hits', 'misses', 'failures')
+# 锁文件超过这个时间还在，视为上次保存时异常退出留下的
+LOCK_TIMEOUT = 10
+
+# 同一进程里多个下载任务（线程）保存时先排队，再用锁文件和其他进程互斥
+_save_lock = threading.Lock()
+
+
+@contextmanager
+def _locked(lock_path, timeout=LOCK_TIMEOUT):
+    """持有锁文件期间其他线程/进程不能保存；等待超过 timeout 秒时抛出 TimeoutError"""
+    with _save_lock:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    stale = time.time() - os.path.getmtime(lock_path) > timeout
+                except OSError:
+                    continue
+                if stale:
+                    try:
+                        os.remove(lock_path)
+                    except OSError:
+                        pass
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"等待锁文件超时: {lock_path}")
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+
+class SelectorCache:
+    """
+    记住每个步骤（搜索按钮、发票表格、金额、下载链接、打包按钮）上次成功的选择器。
+
+    下次先用短超时尝试上次成功的选择器；失败时再在一次等待里轮询所有候选选择器，
+    不再对每个候选都等满20秒。命中/未命中次数会写进缓存文件，
+    网站改版时表现为未命中突然增多，而不是莫名其妙地变慢。
+    """
+
+    def __init__(self, cache_path, fast_timeout=2, slow_timeout=20):
+        """
+        :param cache_path: 缓存文件路径（JSON）
+        :param fast_timeout: 尝试上次成功选择器时的超时（秒）
+        :param slow_timeout: 轮询所有候选选择器时的总超时（秒）
+        """
+        self.cache_path = cache_path
+        self.fast_timeout = fast_timeout
+        self.slow_timeout = slow_timeout
+        self.winners = {}
+        self.totals = {}
+        # 本次运行的统计
+        self.stats = {}
+        # 已经写进缓存文件的那部分统计，以及本次运行学到新选择器的步骤
+        self._saved = {}
+        self._learned = set()
+        self.load()
+
+    def _read(self):
+        """读取缓存文件，返回 (winners, totals)；文件不存在或损坏时返回空的"""
+        if not os.path.exists(self.cache_path):
+            return {}, {}
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            winners = {step: tuple(value) for step, value in data.get('winners', {}).items()}
+            return winners, data.get('totals', {})
+        except Exception as e:
+            print(f"⚠️ 选择器缓存读取失败，将重新学习: {e}")
+            return {}, {}
+
+    def load(self):
+        self.winners, self.totals = self._read()
+
+    def save(self):
+        """
+        把上次保存之后新增的统计合并进缓存文件。
+
+        并行下载时每个任务各有一个 SelectorCache，都会在月份结束时保存：写之前在锁文件保护下重新读取文件，
+        只加上自己新增的次数、只更新自己学到新选择器的步骤，不会覆盖别的任务刚保存的内容，也不会重复累加。
+        """
+        delta = {}
+        for step, step_stats in self.stats.items():
+            saved = self._saved.get(step, {})
+            delta[step] = {key: step_stats.get(key, 0) - saved.get(key, 0) for key in STAT_KEYS}
+        try:
+            folder = os.path.dirname(self.cache_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            with _locked(f"{self.cache_path}.lock"):
+                winners, totals = self._read()
+                for step, counts in delta.items():
+                    old = totals.get(step, {})
+                    totals[step] = {key: old.get(key, 0) + counts[key] for key in STAT_KEYS}
+                winners.update({step: self.winners[step] for step in self._learned})
+                data = {
+                    'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'winners': {step: list(value) for step, value in winners.items()},
+                    'totals': totals,
+                }
+                tmp_path = f"{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.cache_path)
+            self._saved = {step: dict(step_stats) for step, step_stats in self.stats.items()}
+            self.totals = totals
+        except Exception as e:
+            print(f"⚠️ 选择器缓存保存失败: {e}")
+
+    def ordered(self, step, candidates):
+        """上次成功的选择器排在最前面"""
+        winner = self.winners.get(step)
+        if winner in candidates:
+            return [winner] + [c for c in candidates if c != winner]
+        return list(candidates)
+
+    def record(self, step, locator):
+        step_stats = self.stats.setdefault(step, {'hits': 0, 'misses': 0, 'failures': 0})
+        if locator is None:
+            step_stats['failures'] += 1
+            METRICS.incr('selector_failures')
+        elif locator == self.winners.get(step):
+            step_stats['hits'] += 1
+        else:
+            step_stats['misses'] += 1
+            METRICS.incr('selector_retries')
+            self.winners[step] = locator
+            self._learned.add(step)
+
+    def find(self, driver, step, candidates, condition='clickable', timeout=None):
+        """
+        在页面上查找一个元素。
+
+        :param candidates: [(By.xxx, value), ...]，按优先级排列
+        :param condition: 'clickable' 等待可点击，'present' 等待出现
+        :return: 找到的元素，全部失败时返回None
+        """
+        # 在用到时才导入 selenium，解压、搜索等不需要浏览器的命令启动更快
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
+        candidates = [tuple(c) for c in candidates]
+        expected = EC.element_to_be_clickable if condition == 'clickable' else EC.presence_of_element_located
+        timeout = self.slow_timeout if timeout is None else timeout
+
+        winner = self.winners.get(step)
+        if winner in candidates:
+            try:
+                element = WebDriverWait(driver, min(self.fast_timeout, timeout)).until(expected(winner))
+                self.record(step, winner)
+                return element
+            except Exception:
+                pass
+
+        ordered = self.ordered(step, candidates)
+
+        def any_candidate(d):
+            for locator in ordered:
+                try:
+                    element = expected(locator)(d)
+                except Exception:
+                    continue
+                if element:
+                    return locator, element
+            return False
+
+        try:
+            locator, element = WebDriverWait(driver, timeout, poll_frequency=0.3).until(any_candidate)
+        except Exception:
+            self.record(step, None)
+            return None
+        self.record(step, locator)
+        return element
+
+    def find_all(self, driver, step, candidates):
+        """查找一组元素（不等待），返回第一个有结果的选择器找到的全部元素"""
+        for locator in self.ordered(step, [tuple(c) for c in candidates]):
+            try:
+                elements = driver.find_elements(*locator)
+            except Exception:
+                continue
+            if elements:
+                self.record(step, locator)
+                return elements
+        self.record(step, None)
+        return []
+
+    def find_in(self, context, step, candidates, accept=None):
+        """
+        在某个元素内部查找子元素（不等待）。
+
+        :param accept: 可选的校验函数，返回False时继续尝试下一个选择器
+        """
+        for locator in self.ordered(step, [tuple(c) for c in candidates]):
+            try:
+                element = context.find_element(*locator)
+                if accept is not None and not accept(element):
+                    continue
+            except Exception:
+                continue
+            self.record(step, locator)
+            return element
+        self.record(step, None)
+        return None
+
+    def print_stats(self):
+        """打印本次运行的命中统计，未命中突增通常意味着网站改版"""
+        if not self.stats:
+            return
+        print("\n🎯🎯 选择器缓存统计:")
+        suspicious = []
+        for step, step_stats in sorted(self.stats.items()):
+            total = sum(step_stats.values())
+            hit_rate = step_stats['hits'] / total * 100 if total else 0
+            print(f"   {step}: 命中 {step_stats['hits']}，未命中 {step_stats['misses']}，"
+                  f"失败 {step_stats['failures']}（命中率 {hit_rate:.0f}%）")
+            if total >= 3 and step_stats['hits'] < step_stats['misses'] + step_stats['failures']:
+                suspicious.append(step)
+        if suspicious:
+            print(f"⚠️ 以下步骤未命中较多，网站页面可能已改版: {', '.join(suspicious)}")
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import hashlib
+
+from download_manifest import DownloadManifest, invoice_key
+
+# 每个月份文件夹一个水位文件（与下载清单放在一起，卡片×月份天然分开）
+WATERMARK_FILENAME = '.sync_watermark.json'
+
+
+def rows_checksum(rows):
+    """发票快照的校验和：发票标识和金额，与顺序无关"""
+    digest = hashlib.sha1()
+    for item in sorted(f"{invoice_key(row)}|{row.get('amount') or 0:.2f}" for row in rows):
+        digest.update(item.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def sync_probe(rows, page_info):
+    """
+    结果页的轻量快照：只看第一页的发票和分页栏上的总条数，不翻页、不下载。
+
+    :param rows: 第一页的发票快照（scrape_invoice_rows）
+    :param page_info: 分页信息（PAGE_INFO_JS）
+    :return: dict(stated_total, first_page_rows, checksum, has_next, newest_invoice_id)
+    """
+    page_info = page_info or {}
+    ids = [row['invoice_id'] for row in rows if row.get('invoice_id')]
+    return {
+        'stated_total': page_info.get('total'),
+        'first_page_rows': len(rows),
+        'checksum': rows_checksum(rows),
+        'has_next': bool(page_info.get('has_next')),
+        'newest_invoice_id': max(ids) if ids else None,
+    }
+
+
+def load_watermark(month_path):
+    path = os.path.join(month_path, WATERMARK_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def save_watermark(month_path, probe, total_count, success_count, total_amount, listing_complete=True):
+    """
+    月份处理结束后记录水位。全部发票都读到并下载成功才算同步完成，下次同步才可能跳过这个月份：
+    翻页中途停止（listing_complete 为 False）或读到的条数与页面显示的总条数不一致时，都不算完成。
+    """
+    stated_total = probe.get('stated_total')
+    complete = (listing_complete and success_count >= total_count
+                and (stated_total is None or stated_total == total_count))
+    watermark = dict(probe, total_count=total_count, success_count=success_count,
+                     total_amount=round(total_amount, 2), complete=complete,
+                     synced=time.strftime('%Y-%m-%d %H:%M:%S'))
+    path = os.path.join(month_path, WATERMARK_FILENAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(watermark, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    return watermark
+
+
+def month_unchanged(month_path, probe):
+    """
+    结果页与上次同步完成时一致，并且下载的文件都还在：这个月份没有新发票，可以整体跳过。
+
+    总条数未知又有多页时无法确认后面的页有没有变化，不跳过。
+
+    :return: 上次的水位（可以跳过时），否则 None
+    """
+    watermark = load_watermark(month_path)
+    if not watermark or not watermark.get('complete'):
+        return None
+    if probe['stated_total'] is None and probe['has_next']:
+        return None
+    for key in ('stated_total', 'first_page_rows', 'checksum'):
+        if watermark.get(key) != probe[key]:
+            return None
+    manifest = DownloadManifest(month_path)
+    if not all(manifest.is_done(key) for key in manifest.invoices):
+        return None
+    return watermark
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# 模块都在仓库根目录，不是包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_portal import MockPortal
+
+
+@pytest.fixture
+def portal():
+    """不启动服务的票根网模拟，只用来生成压缩包和发票数据"""
+    mock = MockPortal(invoices_per_month=3, pdf_size=4 * 1024)
+    yield mock
+    mock.server.server_close()
+
+
+@pytest.fixture
+def month_path(tmp_path):
+    path = tmp_path / "202410"
+    path.mkdir()
+    return str(path)
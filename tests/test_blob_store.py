@@ -0,0 +1,118 @@
+import io
+import os
+import shutil
+import zipfile
+
+import blob_store
+import my_zip
+from download_manifest import DownloadManifest, STATE_DONE
+
+
+def _inode(path):
+    return os.stat(path).st_ino
+
+
+def _files(folder):
+    return {os.path.relpath(os.path.join(dirpath, name), folder): os.path.join(dirpath, name)
+            for dirpath, _, files in os.walk(folder) for name in files}
+
+
+def _package(pdf_name, pdf_data, marker):
+    """外层zip里一个内层zip，内层里是发票PDF和内容为 marker 的 trans.pdf"""
+    inner = io.BytesIO()
+    with zipfile.ZipFile(inner, 'w') as inner_zip:
+        inner_zip.writestr(pdf_name, pdf_data)
+        inner_zip.writestr("trans.pdf", marker)
+    outer = io.BytesIO()
+    with zipfile.ZipFile(outer, 'w') as outer_zip:
+        outer_zip.writestr("inner.zip", inner.getvalue())
+    return outer.getvalue()
+
+
+def test_identical_archive_in_another_month_reuses_extraction(portal, tmp_path):
+    root = str(tmp_path)
+    portal.write_archives(root, 1)
+    my_zip.main(root)
+    name = portal.month_invoices(portal.cards[0], "202410")[0][0] + ".zip"
+    original = os.path.join(root, "202410", name)
+    os.makedirs(os.path.join(root, "202411"))
+    copy = os.path.join(root, "202411", name)
+    shutil.copy(original, copy)
+
+    results = my_zip.main(root)
+    assert len(results) == 1 and results[0]['reused']
+    assert _inode(copy) == _inode(original)
+    reused, extracted = _files(copy[:-4]), _files(original[:-4])
+    assert reused.keys() == extracted.keys()
+    assert all(_inode(reused[rel]) == _inode(extracted[rel]) for rel in reused)
+
+
+def test_identical_pdfs_in_two_months_share_one_blob(tmp_path):
+    root = str(tmp_path)
+    pdf = b"%PDF-1.4 same invoice" * 100
+    for month, marker in (("202410", b"a"), ("202411", b"b")):
+        os.makedirs(os.path.join(root, month))
+        with open(os.path.join(root, month, "inv.zip"), 'wb') as f:
+            f.write(_package("inv.pdf", pdf, marker))
+
+    results = my_zip.main(root)
+    assert len(results) == 2 and not any(r.get('reused') for r in results)
+    first = os.path.join(root, "202410", "inv", "inv.pdf")
+    second = os.path.join(root, "202411", "inv", "inv.pdf")
+    assert _inode(first) == _inode(second)
+    pdf_blobs = [p for p in _files(os.path.join(root, blob_store.BLOB_FOLDER)).values() if p.endswith('.pdf')]
+    assert len(pdf_blobs) == 1 and _inode(pdf_blobs[0]) == _inode(first)
+
+
+def test_duplicate_downloads_in_one_batch_are_extracted_once(portal, tmp_path, monkeypatch):
+    root = str(tmp_path)
+    portal.write_archives(root, 1)
+    month_path = os.path.join(root, "202410")
+    name = os.listdir(month_path)[0]
+    shutil.copy(os.path.join(month_path, name), os.path.join(month_path, name[:-4] + " (1).zip"))
+
+    extracted = []
+    extract = my_zip.extract_archive_task
+
+    def counting(zip_path, folder_path):
+        extracted.append(zip_path)
+        return extract(zip_path, folder_path)
+
+    monkeypatch.setattr(my_zip, "extract_archive_task", counting)
+    results = my_zip.main(root)
+    assert len(extracted) == 1
+    assert sorted(bool(r.get('reused')) for r in results) == [False, True]
+    assert all(os.path.isdir(r['folder']) and r['files'] == 1 for r in results)
+
+
+def test_restore_invoice_downloaded_for_another_card(portal, tmp_path):
+    root = str(tmp_path)
+    portal.write_archives(root, 1)
+    month_path = os.path.join(root, "202410")
+    name = os.listdir(month_path)[0]
+    store = blob_store.BlobStore(root)
+    try:
+        DownloadManifest(month_path, store).mark(name[:-4], STATE_DONE, os.path.join(month_path, name))
+        other = os.path.join(root, "卡2", "202410")
+        os.makedirs(other)
+        manifest = DownloadManifest(other, store)
+        restored = manifest.sync_rows([{'index': 1, 'invoice_id': name[:-4], 'amount': 1.0}])
+    finally:
+        store.close()
+    assert restored == [os.path.join(other, name)]
+    assert manifest.is_done(name[:-4])
+    assert _inode(restored[0]) == _inode(os.path.join(month_path, name))
+
+
+def test_compact_links_existing_duplicates(portal, tmp_path):
+    root = str(tmp_path)
+    portal.write_archives(root, 2)
+    shutil.copytree(os.path.join(root, "202410"), os.path.join(root, "202411"))
+    my_zip.main(root, use_index=False)
+
+    stats = blob_store.compact(root)
+    # 两个月份各 2 个压缩包和 2 个PDF，第二个月份的 4 个文件改为硬链接
+    assert stats['files'] == 8 and stats['linked'] == 4
+    for path in _files(os.path.join(root, "202411")).values():
+        twin = os.path.join(root, "202410", os.path.relpath(path, os.path.join(root, "202411")))
+        assert _inode(path) == _inode(twin)
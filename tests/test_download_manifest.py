@@ -0,0 +1,76 @@
+import os
+
+from download_manifest import (DownloadManifest, STATE_DONE, STATE_FAILED, STATE_PENDING, STATE_DOWNLOADING,
+                               invoice_key)
+
+
+def _rows(count):
+    return [{'index': i, 'invoice_id': f"2024100100{i:03d}", 'amount': 10.0 * i, 'href': f"/d/{i}"}
+            for i in range(1, count + 1)]
+
+
+def _write(path, data=b"PK\x05\x06" + b"\0" * 18):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_resume_skips_done_invoices_and_retries_the_rest(month_path):
+    rows = _rows(3)
+    manifest = DownloadManifest(month_path)
+    manifest.sync_rows(rows)
+    first = invoice_key(rows[0])
+    manifest.mark(first, STATE_DOWNLOADING)
+    manifest.mark(first, STATE_DONE, _write(os.path.join(month_path, f"{first}.zip")))
+    manifest.mark(invoice_key(rows[1]), STATE_FAILED, error="超时")
+
+    # 中途退出后重新运行：重新登记页面上的发票不会改掉已完成的状态
+    resumed = DownloadManifest(month_path)
+    resumed.sync_rows(rows)
+    assert resumed.is_done(first)
+    assert resumed.get(first)['attempts'] == 1
+    assert resumed.get(first)['sha256']
+    assert resumed.get(invoice_key(rows[1]))['state'] == STATE_FAILED
+    assert resumed.counts() == {STATE_DONE: 1, STATE_FAILED: 1, STATE_PENDING: 1}
+
+    # 文件被删掉的发票需要重新下载
+    os.remove(os.path.join(month_path, f"{first}.zip"))
+    assert not DownloadManifest(month_path).is_done(first)
+
+
+def test_invoice_key_falls_back_to_index():
+    assert invoice_key({'index': 7, 'invoice_id': None}) == "#7"
+    assert invoice_key({'index': 7, 'invoice_id': "X1"}) == "X1"
+
+
+def test_collapse_identical_duplicate_download(month_path):
+    manifest = DownloadManifest(month_path)
+    base = _write(os.path.join(month_path, "a.zip"))
+    duplicate = _write(os.path.join(month_path, "a (1).zip"))
+    os.makedirs(os.path.join(month_path, "a (1)"))
+    manifest.mark("A", STATE_DONE, duplicate)
+
+    assert manifest.collapse_duplicates() == 1
+    assert not os.path.exists(duplicate)
+    assert not os.path.exists(os.path.join(month_path, "a (1)"))
+    assert os.path.exists(base)
+    assert DownloadManifest(month_path).get("A")['file'] == "a.zip"
+
+
+def test_collapse_renames_duplicate_without_original(month_path):
+    manifest = DownloadManifest(month_path)
+    duplicate = _write(os.path.join(month_path, "b (2).zip"))
+    manifest.mark("B", STATE_DONE, duplicate)
+
+    assert manifest.collapse_duplicates() == 0
+    assert sorted(os.listdir(month_path)) == [".manifest.json", "b.zip"]
+    assert DownloadManifest(month_path).is_done("B")
+
+
+def test_collapse_keeps_duplicate_with_different_content(month_path):
+    manifest = DownloadManifest(month_path)
+    _write(os.path.join(month_path, "c.zip"), b"one")
+    _write(os.path.join(month_path, "c (1).zip"), b"two")
+
+    assert manifest.collapse_duplicates() == 0
+    assert os.path.exists(os.path.join(month_path, "c (1).zip"))
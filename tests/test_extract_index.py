@@ -0,0 +1,82 @@
+import os
+import shutil
+
+import my_zip
+from extract_index import ExtractIndex, STATUS_DONE, STATUS_EXTRACTING
+
+
+def _pdfs(folder):
+    return sorted(name for _, _, files in os.walk(folder) for name in files)
+
+
+def _status(root, zip_path):
+    index = ExtractIndex(root)
+    try:
+        return index.get(zip_path)['status']
+    finally:
+        index.close()
+
+
+def test_second_run_skips_extracted_archives(portal, tmp_path):
+    root = str(tmp_path)
+    portal.write_archives(root, 3)
+    first = my_zip.main(root)
+    assert len(first) == 3
+    assert all(not r['errors'] and r['files'] == 1 for r in first)
+    assert all(_status(root, r['zip']) == STATUS_DONE for r in first)
+
+    assert my_zip.main(root) == []
+
+
+def test_new_and_changed_archives_are_extracted(portal, tmp_path):
+    root = str(tmp_path)
+    portal.write_archives(root, 2)
+    my_zip.main(root)
+
+    month_path = os.path.join(root, "202410")
+    names = sorted(n for n in os.listdir(month_path) if n.endswith('.zip'))
+    # 换成另一个月份的压缩包内容：大小或修改时间变了，需要重新解压
+    portal.write_archives(root, 1, month="202411")
+    other = os.path.join(root, "202411", os.listdir(os.path.join(root, "202411"))[0])
+    os.remove(os.path.join(month_path, names[0]))
+    shutil.copy(other, os.path.join(month_path, names[0]))
+
+    results = my_zip.main(root)
+    assert sorted(os.path.basename(r['zip']) for r in results) == sorted([names[0], os.path.basename(other)])
+
+
+def test_interrupted_extraction_is_resumed(portal, tmp_path):
+    root = str(tmp_path)
+    portal.write_archives(root, 2)
+    results = my_zip.main(root)
+    zip_path = results[0]['zip']
+    folder_path = zip_path[:-4]
+    expected = _pdfs(folder_path)
+
+    # 模拟解压到一半时进程被杀：索引停在 extracting，文件夹里只剩一部分文件
+    index = ExtractIndex(root)
+    index.mark(zip_path, folder_path, STATUS_EXTRACTING)
+    index.forget_dir(os.path.dirname(zip_path))
+    index.close()
+    for dirpath, _, files in os.walk(folder_path):
+        for name in files:
+            os.remove(os.path.join(dirpath, name))
+
+    rerun = my_zip.main(root)
+    assert [r['zip'] for r in rerun] == [zip_path]
+    assert _pdfs(folder_path) == expected
+    assert _status(root, zip_path) == STATUS_DONE
+    assert my_zip.main(root) == []
+
+
+def test_complete_folder_from_older_version_is_registered(portal, tmp_path):
+    root = str(tmp_path)
+    portal.write_archives(root, 2)
+    my_zip.main(root, use_index=False)
+
+    # 没有索引时，已经完整解压的文件夹直接登记，不再解压
+    assert my_zip.main(root) == []
+    month_path = os.path.join(root, "202410")
+    for name in os.listdir(month_path):
+        if name.endswith('.zip'):
+            assert _status(root, os.path.join(month_path, name)) == STATUS_DONE
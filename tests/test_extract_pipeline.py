@@ -0,0 +1,94 @@
+import os
+import threading
+
+import my_zip
+from extract_index import ExtractIndex, STATUS_DONE, STATUS_FAILED
+from extract_pipeline import ExtractionPipeline
+
+
+def _archives(portal, root, count=3):
+    portal.write_archives(root, count)
+    month_path = os.path.join(root, "202410")
+    return month_path, sorted(os.path.join(month_path, n) for n in os.listdir(month_path))
+
+
+def test_close_drains_submitted_archives(portal, tmp_path):
+    root = str(tmp_path)
+    month_path, zips = _archives(portal, root)
+    pipeline = ExtractionPipeline(root, workers=2, max_pending=1)
+    assert pipeline.submit(zips[0])
+    assert not pipeline.submit(zips[0])
+    assert pipeline.submit_folder(month_path) == 2
+    results = pipeline.close()
+
+    assert sorted(r['zip'] for r in results) == zips
+    assert all(r['files'] == 1 and not r['errors'] for r in results)
+    assert all(os.path.isdir(z[:-4]) for z in zips)
+
+
+def test_already_extracted_archives_are_skipped(portal, tmp_path):
+    root = str(tmp_path)
+    month_path, zips = _archives(portal, root)
+    my_zip.main(root)
+
+    pipeline = ExtractionPipeline(root)
+    pipeline.submit_folder(month_path)
+    assert pipeline.close() == []
+
+
+def test_worker_survives_unexpected_error(portal, tmp_path, monkeypatch):
+    root = str(tmp_path)
+    month_path, zips = _archives(portal, root)
+    extract = my_zip.extract_archive_task
+
+    def flaky(zip_path, folder_path):
+        if zip_path == zips[0]:
+            raise OSError("磁盘已满")
+        return extract(zip_path, folder_path)
+
+    monkeypatch.setattr(my_zip, "extract_archive_task", flaky)
+    # 只有一个线程、队列只能放一个：线程退出的话后面的 submit 会一直卡住
+    pipeline = ExtractionPipeline(root, workers=1, max_pending=1)
+    submitter = threading.Thread(target=lambda: [pipeline.submit(z) for z in zips], daemon=True)
+    submitter.start()
+    submitter.join(timeout=10)
+    assert not submitter.is_alive()
+    results = {r['zip']: r for r in pipeline.close()}
+
+    assert "磁盘已满" in results[zips[0]]['errors'][0]
+    assert all(results[z]['files'] == 1 for z in zips[1:])
+    index = ExtractIndex(root)
+    try:
+        assert index.get(zips[0])['status'] == STATUS_FAILED
+        assert index.get(zips[1])['status'] == STATUS_DONE
+    finally:
+        index.close()
+
+    # 下次运行重新解压失败的那个
+    monkeypatch.setattr(my_zip, "extract_archive_task", extract)
+    assert [r['zip'] for r in my_zip.main(root)] == [zips[0]]
+
+
+def test_corrupt_archive_is_quarantined(portal, tmp_path):
+    root = str(tmp_path)
+    month_path, zips = _archives(portal, root, count=2)
+    with open(zips[0], 'rb') as f:
+        data = f.read()
+    with open(zips[0], 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    pipeline = ExtractionPipeline(root)
+    pipeline.submit_folder(month_path)
+    results = {r['zip']: r for r in pipeline.close()}
+
+    assert results[zips[0]]['corrupt']
+    assert not os.path.exists(zips[0]) and not os.path.exists(zips[0][:-4])
+    assert len(os.listdir(os.path.join(month_path, my_zip.QUARANTINE_FOLDER))) == 1
+    assert results[zips[1]]['files'] == 1
+
+
+def test_workers_none_uses_every_cpu(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 3)
+    pipeline = ExtractionPipeline(str(tmp_path), None)
+    assert len(pipeline._threads) == 3
+    pipeline.close()
@@ -0,0 +1,52 @@
+from http_download import parse_package_url, filename_from_response, is_archive_response
+
+PAGE_URL = "https://pss.txffp.com/pss/app/login/invoice/downloadPage/123"
+
+
+class Response:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_package_url_from_onclick():
+    html = """<input id="no-invoice" type="button" value="打包下载"
+              onclick="location.href='/pss/app/login/invoice/download/123?type=zip&amp;a=1'" />"""
+    assert parse_package_url(html, PAGE_URL) == "https://pss.txffp.com/pss/app/login/invoice/download/123?type=zip&a=1"
+
+
+def test_package_url_from_attribute():
+    html = '<a id="no-invoice" class="btn" data-url="../download/9">打包</a>'
+    assert parse_package_url(html, PAGE_URL) == "https://pss.txffp.com/pss/app/login/invoice/download/9"
+
+
+def test_package_url_from_bound_script():
+    html = """<button id='no-invoice'>打包</button>
+    <script>$('#no-invoice').click(function () { window.open("/files/2024/invoice.zip"); });</script>"""
+    assert parse_package_url(html, PAGE_URL) == "https://pss.txffp.com/files/2024/invoice.zip"
+
+
+def test_package_url_missing():
+    assert parse_package_url("<html><body>登录已过期</body></html>", PAGE_URL) is None
+
+
+def test_filename_from_utf8_disposition():
+    resp = Response({'Content-Disposition': "attachment; filename*=UTF-8''%E5%8F%91%E7%A5%A8%2001.zip"})
+    assert filename_from_response(resp, PAGE_URL, 1) == "发票 01.zip"
+
+
+def test_filename_from_latin1_decoded_header():
+    raw = "发票/02".encode('utf-8').decode('latin-1')
+    resp = Response({'Content-Disposition': f'attachment; filename="{raw}"'})
+    assert filename_from_response(resp, PAGE_URL, 2) == "发票_02.zip"
+
+
+def test_filename_falls_back_to_url_and_index():
+    assert filename_from_response(Response({}), "https://x/download/abc.zip?t=1", 3) == "abc.zip"
+    assert filename_from_response(Response({}), "https://x/", 4) == "invoice_4.zip"
+
+
+def test_archive_response_detection():
+    assert is_archive_response(Response({'Content-Type': 'application/zip'}))
+    assert is_archive_response(Response({'Content-Type': 'application/octet-stream'}))
+    assert is_archive_response(Response({'Content-Type': 'text/plain', 'Content-Disposition': 'attachment'}))
+    assert not is_archive_response(Response({'Content-Type': 'text/html; charset=utf-8'}))
@@ -0,0 +1,123 @@
+import os
+import zlib
+
+import my_zip
+from download_manifest import DownloadManifest, STATE_DONE, STATE_FAILED
+from extract_index import ExtractIndex, STATUS_FAILED
+
+
+def _archives(portal, root, count=2):
+    portal.write_archives(root, count)
+    month_path = os.path.join(root, "202410")
+    return month_path, sorted(os.path.join(month_path, n) for n in os.listdir(month_path))
+
+
+def _truncate(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+
+def _flip_byte(path):
+    """改掉压缩数据中间的一个字节：中央目录完好，解压时才会发现数据或CRC不对"""
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    data[len(data) // 3] ^= 0xff
+    with open(path, 'wb') as f:
+        f.write(bytes(data))
+
+
+def _leftovers(month_path):
+    return sorted(n for n in os.listdir(month_path) if n.endswith('.extracting'))
+
+
+def test_extract_reports_crc_of_whole_file(portal, tmp_path):
+    _, zips = _archives(portal, str(tmp_path), count=1)
+    result = my_zip.extract_archive_task(zips[0], zips[0][:-4])
+    with open(zips[0], 'rb') as f:
+        assert result['crc32'] == f"{zlib.crc32(f.read()):08x}"
+    assert result['files'] == 1 and result['skipped'] == 1 and not result['errors']
+
+
+def test_truncated_archive_leaves_no_folder(portal, tmp_path):
+    month_path, zips = _archives(portal, str(tmp_path), count=1)
+    _truncate(zips[0])
+    result = my_zip.extract_archive_task(zips[0], zips[0][:-4])
+    assert result['corrupt']
+    assert not os.path.exists(zips[0][:-4])
+    assert _leftovers(month_path) == []
+
+
+def test_crc_mismatch_is_detected_while_extracting(portal, tmp_path):
+    month_path, zips = _archives(portal, str(tmp_path), count=1)
+    _flip_byte(zips[0])
+    result = my_zip.extract_archive_task(zips[0], zips[0][:-4])
+    assert result['corrupt']
+    assert not os.path.exists(zips[0][:-4])
+    assert _leftovers(month_path) == []
+
+
+def test_corrupt_download_is_quarantined_and_requeued(portal, tmp_path):
+    root = str(tmp_path)
+    month_path, zips = _archives(portal, root)
+    manifest = DownloadManifest(month_path)
+    for zip_path in zips:
+        manifest.mark(os.path.basename(zip_path)[:-4], STATE_DONE, zip_path)
+    good = open(zips[0], 'rb').read()
+    _truncate(zips[0])
+
+    results = {r['zip']: r for r in my_zip.main(root)}
+    assert results[zips[0]]['corrupt']
+    assert results[zips[1]]['files'] == 1
+    assert not os.path.exists(zips[0]) and not os.path.exists(zips[0][:-4])
+    quarantined = os.listdir(os.path.join(month_path, my_zip.QUARANTINE_FOLDER))
+    assert len(quarantined) == 1 and quarantined[0].endswith(os.path.basename(zips[0]))
+
+    entry = DownloadManifest(month_path).get(os.path.basename(zips[0])[:-4])
+    assert entry['state'] == STATE_FAILED
+    assert entry['quarantined'] == f"{my_zip.QUARANTINE_FOLDER}/{quarantined[0]}"
+    index = ExtractIndex(root)
+    try:
+        assert index.get(zips[0])['status'] == STATUS_FAILED
+    finally:
+        index.close()
+
+    # 重新下载后正常解压
+    with open(zips[0], 'wb') as f:
+        f.write(good)
+    assert [r['zip'] for r in my_zip.main(root)] == [zips[0]]
+    assert os.path.isdir(zips[0][:-4])
+
+
+def test_rerun_after_interrupted_extraction(portal, tmp_path):
+    month_path, zips = _archives(portal, str(tmp_path), count=1)
+    folder_path = zips[0][:-4]
+    expected = my_zip.extract_archive_task(zips[0], folder_path)['files']
+
+    # 进程在解压途中退出：临时文件夹留了一半，目标文件夹里有以前的文件
+    staging = os.path.join(month_path, f".{os.path.basename(folder_path)}.extracting")
+    os.makedirs(staging)
+    with open(os.path.join(staging, "half.pdf"), 'wb') as f:
+        f.write(b"half")
+    with open(os.path.join(folder_path, "note.txt"), 'w') as f:
+        f.write("自己放的文件")
+
+    result = my_zip.extract_archive_task(zips[0], folder_path)
+    assert result['files'] == expected and not result['errors']
+    names = sorted(name for _, _, files in os.walk(folder_path) for name in files)
+    assert "note.txt" in names and "half.pdf" not in names
+    assert _leftovers(month_path) == []
+
+
+def test_verify_tree_quarantines_only_corrupt_archives(portal, tmp_path):
+    root = str(tmp_path)
+    month_path, zips = _archives(portal, root, count=3)
+    _truncate(zips[1])
+
+    corrupt = my_zip.verify_tree(root, workers=2)
+    assert [zip_path for zip_path, _ in corrupt] == [zips[1]]
+    assert os.path.exists(zips[0]) and os.path.exists(zips[2])
+    assert not os.path.exists(zips[1])
+    assert len(os.listdir(os.path.join(month_path, my_zip.QUARANTINE_FOLDER))) == 1
+    assert my_zip.verify_tree(root) == []
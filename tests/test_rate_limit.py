@@ -0,0 +1,97 @@
+from rate_limit import AdaptiveRateLimiter, RetryQueue
+
+
+def test_fast_responses_raise_rate_up_to_max():
+    limiter = AdaptiveRateLimiter(rate=1.0, max_rate=2.0, increase=1.5, fast_latency=1.0)
+    limiter.success(0.1)
+    assert limiter.rate == 1.5
+    limiter.success(5.0)
+    assert limiter.rate == 1.5
+    for _ in range(5):
+        limiter.success(0.1)
+    assert limiter.rate == 2.0
+    assert limiter.stats()['highest_rate'] == 2.0
+
+
+def test_failure_halves_rate_and_backs_off_exponentially():
+    limiter = AdaptiveRateLimiter(rate=4.0, min_rate=0.5, base_backoff=10.0, max_backoff=25.0)
+    limiter.failure()
+    assert limiter.rate == 2.0
+    assert limiter.reserve() > 9.0
+
+    # 同一波并发请求的失败不再重复减速
+    limiter.failure()
+    assert limiter.rate == 2.0
+    assert limiter.backoffs == 1
+
+    limiter._backoff_until = 0.0
+    limiter.failure()
+    assert limiter.rate == 1.0
+    assert 19.0 < limiter.reserve() <= 20.0
+
+    limiter._backoff_until = 0.0
+    limiter.failure()
+    limiter._backoff_until = 0.0
+    limiter.failure()
+    assert limiter.rate == 0.5
+    stats = limiter.stats()
+    assert stats['failures'] == 5 and stats['backoffs'] == 4 and stats['lowest_rate'] == 0.5
+
+
+def test_success_after_backoff_resets_backoff():
+    limiter = AdaptiveRateLimiter(base_backoff=10.0)
+    limiter.failure()
+    limiter._backoff_until = 0.0
+    limiter.success(0.1)
+    limiter.failure()
+    # 成功之后重新从第一次退避开始，而不是 20 秒
+    assert limiter.reserve() <= 10.0
+
+
+def test_tokens_allow_burst_then_wait():
+    limiter = AdaptiveRateLimiter(rate=1.0, burst=2)
+    assert limiter.reserve() == 0.0
+    assert limiter.reserve() == 0.0
+    assert limiter.reserve() > 0.9
+
+
+def _row(index):
+    return {'index': index, 'invoice_id': f"ID{index}"}
+
+
+def test_retry_queue_rounds_and_final_failures():
+    queue = RetryQueue(max_attempts=3)
+    for index in (1, 2, 3, 4):
+        queue.add(_row(index), error=f"第一次失败 {index}")
+    queue.add(_row(5), error="文件已损坏", retryable=False)
+
+    calls = []
+
+    def download(row):
+        calls.append(row['index'])
+        # 1 第一次重试就成功，2 第二次重试成功，3 和 4 一直失败
+        if row['index'] == 1 or (row['index'] == 2 and calls.count(2) == 2):
+            return True, None
+        return False, f"重试失败 {row['index']}"
+
+    recovered = queue.drain(download)
+    assert recovered == [1, 2]
+    assert calls == [1, 2, 3, 4, 2, 3, 4]
+    assert len(queue) == 3
+
+    summary = queue.summary()
+    assert summary['retried'] == {1: 1, 2: 2, 3: 2, 4: 2}
+    assert summary['retry_count'] == 7
+    assert summary['recovered'] == [1, 2]
+    assert summary['failures'] == [(3, "重试失败 3", 3), (4, "重试失败 4", 3), (5, "文件已损坏", 1)]
+
+
+def test_retry_queue_reports_results_to_limiter():
+    limiter = AdaptiveRateLimiter(rate=100.0, burst=10, base_backoff=0.0)
+    queue = RetryQueue(max_attempts=2)
+    queue.add(_row(1))
+    queue.add(_row(2))
+    queue.drain(lambda row: (row['index'] == 1, None if row['index'] == 1 else "超时"), limiter)
+    assert limiter.successes == 1
+    assert limiter.failures == 1
+    assert queue.summary()['failures'] == [(2, "超时", 2)]
@@ -0,0 +1,87 @@
+import os
+import shutil
+
+import pytest
+
+import my_zip
+from download_manifest import DownloadManifest, STATE_DONE
+from reconcile import reconcile_month, problem_count
+
+
+def _download_month(portal, root, month="202410"):
+    """模拟下载完并解压好的月份：压缩包、同名文件夹和下载清单"""
+    portal.write_archives(root, portal.invoices_per_month, month=month)
+    month_path = os.path.join(root, month)
+    invoices = portal.month_invoices(portal.cards[0], month)
+    rows = [{'index': i, 'invoice_id': invoice_id, 'amount': amount}
+            for i, (invoice_id, amount) in enumerate(invoices, 1)]
+    manifest = DownloadManifest(month_path)
+    manifest.sync_rows(rows)
+    for row in rows:
+        zip_path = os.path.join(month_path, f"{row['invoice_id']}.zip")
+        manifest.mark(row['invoice_id'], STATE_DONE, zip_path)
+        result = my_zip.extract_archive_task(zip_path, zip_path[:-4])
+        assert not result['errors']
+    return month_path, rows
+
+
+def test_complete_month_has_no_problems(portal, tmp_path):
+    month_path, rows = _download_month(portal, str(tmp_path))
+    result = reconcile_month(month_path)
+    assert result['rows'] == result['zips'] == result['matched'] == len(rows)
+    assert problem_count(result) == 0
+
+
+def test_missing_zip_not_extracted_and_orphan(portal, tmp_path):
+    month_path, rows = _download_month(portal, str(tmp_path))
+    os.remove(os.path.join(month_path, f"{rows[0]['invoice_id']}.zip"))
+    shutil.rmtree(os.path.join(month_path, rows[1]['invoice_id']))
+    shutil.copy(os.path.join(month_path, f"{rows[2]['invoice_id']}.zip"), os.path.join(month_path, "extra.zip"))
+
+    result = reconcile_month(month_path)
+    assert [row['index'] for row in result['missing_zip']] == [1]
+    assert [row['index'] for row in result['not_extracted']] == [2]
+    assert result['orphan_zips'] == ["extra.zip"]
+    # extra.zip 与第三张发票的压缩包内容相同
+    assert result['duplicate_zips'] == [(f"{rows[2]['invoice_id']}.zip = extra.zip", None)]
+
+
+def test_two_rows_pointing_at_one_zip(portal, tmp_path):
+    month_path, rows = _download_month(portal, str(tmp_path))
+    manifest = DownloadManifest(month_path)
+    manifest.invoices[rows[1]['invoice_id']]['file'] = f"{rows[0]['invoice_id']}.zip"
+    manifest.save()
+
+    result = reconcile_month(month_path)
+    assert (f"{rows[0]['invoice_id']}.zip", [1, 2]) in result['duplicate_zips']
+    assert result['orphan_zips'] == [f"{rows[1]['invoice_id']}.zip"]
+
+
+def test_amount_mismatch_and_duplicate_invoice(portal, tmp_path):
+    pytest.importorskip("pypdf")
+    from pdf_index import open_index
+
+    month_path, rows = _download_month(portal, str(tmp_path))
+    manifest = DownloadManifest(month_path)
+    manifest.invoices[rows[0]['invoice_id']]['amount'] = rows[0]['amount'] + 1
+    manifest.save()
+    # 第三张发票的PDF又出现在第二张发票的压缩包文件夹里
+    pdf = f"{rows[2]['invoice_id']}_1.pdf"
+    shutil.copy(os.path.join(month_path, rows[2]['invoice_id'], pdf),
+                os.path.join(month_path, rows[1]['invoice_id'], pdf))
+
+    index = open_index(str(tmp_path))
+    if index is None:
+        pytest.skip("SQLite 不支持 FTS5 trigram")
+    try:
+        index.update(workers=1)
+        result = reconcile_month(month_path, index)
+    finally:
+        index.close()
+
+    assert result['amounts_checked']
+    assert [(row['index'], amount) for row, amount in result['amount_mismatch']] == [
+        (1, rows[0]['amount']), (2, round(rows[1]['amount'] + rows[2]['amount'], 2))]
+    assert len(result['duplicate_invoices']) == 1
+    assert result['duplicate_invoices'][0][1] == [f"{rows[1]['invoice_id']}.zip", f"{rows[2]['invoice_id']}.zip"]
+    assert result['matched'] == 1
@@ -0,0 +1,75 @@
+import os
+
+from download_manifest import DownloadManifest, STATE_DONE, invoice_key
+from sync_state import sync_probe, save_watermark, load_watermark, month_unchanged
+
+
+ROWS = [{'index': i, 'invoice_id': f"ID{i:03d}", 'amount': 10.0 + i} for i in range(1, 4)]
+
+
+def _probe(rows=ROWS, total=3, has_next=False):
+    return sync_probe(rows, {'total': total, 'has_next': has_next})
+
+
+def _download_all(month_path, rows=ROWS):
+    manifest = DownloadManifest(month_path)
+    manifest.sync_rows(rows)
+    for row in rows:
+        path = os.path.join(month_path, f"{row['invoice_id']}.zip")
+        with open(path, 'wb') as f:
+            f.write(row['invoice_id'].encode())
+        manifest.mark(invoice_key(row), STATE_DONE, path)
+
+
+def test_watermark_complete_when_everything_downloaded(month_path):
+    watermark = save_watermark(month_path, _probe(), 3, 3, 36.0)
+    assert watermark['complete']
+    assert load_watermark(month_path) == watermark
+
+
+def test_watermark_incomplete_when_stated_total_differs(month_path):
+    # 页面显示 5 条，只读到 3 条：下次同步不能跳过这个月份
+    watermark = save_watermark(month_path, _probe(total=5), 3, 3, 36.0)
+    assert not watermark['complete']
+    assert not load_watermark(month_path)['complete']
+
+
+def test_watermark_incomplete_when_listing_stopped(month_path):
+    assert not save_watermark(month_path, _probe(total=None), 3, 3, 36.0, listing_complete=False)['complete']
+
+
+def test_watermark_incomplete_when_downloads_failed(month_path):
+    assert not save_watermark(month_path, _probe(), 3, 2, 24.0)['complete']
+
+
+def test_month_unchanged_after_complete_sync(month_path):
+    _download_all(month_path)
+    save_watermark(month_path, _probe(), 3, 3, 36.0)
+    assert month_unchanged(month_path, _probe())
+
+
+def test_month_changed_when_new_invoice_appears(month_path):
+    _download_all(month_path)
+    save_watermark(month_path, _probe(), 3, 3, 36.0)
+    rows = ROWS + [{'index': 4, 'invoice_id': "ID004", 'amount': 1.0}]
+    assert month_unchanged(month_path, _probe(rows, total=4)) is None
+
+
+def test_month_changed_when_downloaded_file_missing(month_path):
+    _download_all(month_path)
+    save_watermark(month_path, _probe(), 3, 3, 36.0)
+    os.remove(os.path.join(month_path, "ID002.zip"))
+    assert month_unchanged(month_path, _probe()) is None
+
+
+def test_month_not_skipped_when_watermark_incomplete(month_path):
+    _download_all(month_path)
+    save_watermark(month_path, _probe(total=5), 3, 3, 36.0)
+    assert month_unchanged(month_path, _probe(total=5)) is None
+
+
+def test_month_not_skipped_when_total_unknown_with_more_pages(month_path):
+    _download_all(month_path)
+    probe = _probe(total=None, has_next=True)
+    save_watermark(month_path, probe, 3, 3, 36.0)
+    assert month_unchanged(month_path, probe) is None